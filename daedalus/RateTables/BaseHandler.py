@@ -1,7 +1,22 @@
+import hashlib
+import inspect
+import json
+import logging
 import pandas as pd
 import numpy as np
-from os.path import exists
-from os import remove
+from os.path import basename, dirname, exists, join, splitext
+from os import getpid, remove, replace
+
+from daedalus.RateTables.CacheManifest import CacheManifest
+from daedalus.RateTables.FileLock import FileLock
+from daedalus.RateTables.RateCube import RateCube
+from daedalus.RateTables.RateTableCache import get_cache_backend, to_compact_dtypes, to_lookup_dtypes
+
+logger = logging.getLogger(__name__)
+
+# config values the rate tables of the population components are built from (the population section also holds the
+# population_size of the simulated LAD, which must not change the cache key)
+AGE_RANGE_KEYS = ['population.age_start', 'population.age_end']
 
 
 class BaseHandler:
@@ -11,23 +26,124 @@ class BaseHandler:
         self.rate_table_dir = 'persistent_data/'
         self.rate_table_path = None
         self.rate_table = None
+        self.cache_backend = get_cache_backend(self._config_option('rate_tables', 'cache_format', default='npz'))
+        self.cache_name = None
+        self.cache_key = None
+        self.scale_component = None
 
     def set_rate_table(self):
+        self._load_rate_table()
+        if self._config_option('rate_tables', 'compact_dtypes', default=False):
+            self.rate_table = to_compact_dtypes(self.rate_table,
+                                                self._config_option('rate_tables', 'float32_rates', default=False))
+        logger.info('Rate table %s uses %.1f MB in memory', self.filename, self.memory_footprint() / 2 ** 20)
+
+    def _load_rate_table(self):
         if not exists(self.rate_table_path):
-            self._build()
-            self.cache()
-        else:
-            print('Fetching rate table from catch {}'.format(self.rate_table_path))
-            self.rate_table = pd.read_csv(self.rate_table_path, index_col=[0])
+            # only one process builds a missing rate table, the others wait for it and then read the cache
+            with FileLock(self.rate_table_path + '.lock'):
+                if not exists(self.rate_table_path):
+                    if exists(self.legacy_csv_path()):
+                        # nothing tells which sources, config and code it was built from, so it is rebuilt
+                        print('Removing rate table cached as CSV by a previous version {}'.format(
+                            self.legacy_csv_path()))
+                        remove(self.legacy_csv_path())
+                    self._build()
+                    self.cache()
+                    return
+
+        print('Fetching rate table from cache {}'.format(self.rate_table_path))
+        self.rate_table = self.cache_backend.read(self.rate_table_path,
+                                                  compact=self._config_option('rate_tables', 'compact_dtypes',
+                                                                              default=False))
+        self._cache_manifest().record(basename(self.rate_table_path), self.cache_name, self.cache_key)
+
+    def memory_footprint(self):
+        """Memory used by the rate table in bytes, strings included, with the dtypes it is handed to the simulation."""
+        rate_table = self.rate_table
+        if self._config_option('rate_tables', 'compact_dtypes', default=False):
+            rate_table = to_lookup_dtypes(rate_table)
+        return int(rate_table.memory_usage(deep=True).sum())
+
+    def scaled_rate_table(self):
+        """Rate table with the scale_rates factor of this component applied.
+
+        The cached rate table is never scaled, so every scaling scenario shares the same cache entry and the
+        scaling is a multiplication in memory when the table is handed to the simulation. A table kept with
+        compact_dtypes is handed over with its small integers and float32 rates, and its locations and ethnicities as
+        strings, as vivarium lookup tables do not support categorical columns.
+        """
+        method = self.configuration["scale_rates"]["method"]
+        scale = getattr(self, '_scale_' + method, None)
+        if scale is None:
+            raise ValueError('Unknown scale_rates method {}'.format(method))
+        rate_table = scale(self.rate_table, self.configuration["scale_rates"][method][self.scale_component])
+        if self._config_option('rate_tables', 'compact_dtypes', default=False):
+            rate_table = to_lookup_dtypes(rate_table)
+        return rate_table
+
+    def hand_over_rate_table(self):
+        """Scaled rate table to write to the simulation data, the handler then drops its own copy so that only the
+        table held by the simulation stays in memory.
+        """
+        rate_table = self.scaled_rate_table()
+        self.rate_table = None
+        return rate_table
+
+    def _scale_constant(self, rate_table, factor):
+        """All rates regardless of age/sex/... are multiplied by the same factor."""
+        if factor == 1:
+            return rate_table
+        print(f'Scaling the {self.scale_component} rates by a factor of {factor}')
+        return rate_table.assign(mean_value=rate_table['mean_value'] * float(factor))
+
+    def rate_cube(self, scaled=True):
+        """Dense RateCube of the (by default scaled) rate table, for fast vectorized lookups."""
+        return RateCube.from_rate_table(self.scaled_rate_table() if scaled else self.rate_table)
 
     def set_matrix_tables(self):
         self._build()
 
+    def set_cache_key(self, name, source_files, config_keys):
+        """Name the cached rate table after a hash of everything it is built from, so that a change in any of them
+        leads to a new cache entry instead of silently reusing a stale one.
+
+        Parameters:
+        name (str): Name of the rate table, used as prefix of the cached file
+        source_files (list of str): Files the rate table is built from
+        config_keys (list of str): Config values or subtrees the rate table depends on, nested keys separated by
+            dots (eg 'population.age_start', not the whole population section whose population_size changes with
+            the LAD)
+        """
+        source_files = list(source_files) + [self._config_option('path_to_ethnic_lookup')]
+        configuration = {}
+        for key in config_keys:
+            value = self._config_option(*key.split('.'))
+            configuration[key] = value.to_dict() if hasattr(value, 'to_dict') else value
+
+        description = {'name': name,
+                       'source_files': CacheManifest(self.rate_table_dir).file_hashes(source_files),
+                       'configuration': configuration,
+                       'code': self._code_version()}
+        self.cache_name = name
+        self.cache_key = hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.filename = '{}_{}{}'.format(name, self.cache_key, self.cache_backend.extension)
+        self.rate_table_path = self.rate_table_dir + self.filename
+
     def cache(self, overwrite=False):
         if not exists(self.rate_table_path) or overwrite:
             print('Caching rate table...')
-            self.rate_table.to_csv(self.rate_table_path)
+            # write to a temporary file and rename, so that other processes never read a half-written cache
+            root, extension = splitext(self.rate_table_path)
+            tmp_path = '{}.{}.tmp{}'.format(root, getpid(), extension)
+            self.cache_backend.write(self.rate_table, tmp_path)
+            replace(tmp_path, self.rate_table_path)
             print('Cached to {}'.format(self.rate_table_path))
+            self._cache_manifest().record(basename(self.rate_table_path), self.cache_name, self.cache_key)
+
+            max_entries = self._config_option('rate_tables', 'max_cache_entries')
+            if max_entries is not None:
+                self.clean_cache(max_entries)
         else:
             print('File already exists at {}'.format(self.rate_table_path))
 
@@ -37,6 +153,46 @@ class BaseHandler:
             remove(self.rate_table_path)
         else:
             print('No file at {} found, did not remove'.format(self.rate_table_path))
+        self._cache_manifest().remove(basename(self.rate_table_path))
+
+    def clean_cache(self, max_entries):
+        """Keep only the max_entries most recently used rate tables in the cache directory."""
+        return self._cache_manifest().clean(max_entries)
+
+    def export_csv(self, path=None):
+        """Write the rate table as CSV, by default next to the cache with a .csv extension."""
+        if path is None:
+            path = splitext(self.rate_table_path)[0] + '.csv'
+        self.rate_table.to_csv(path)
+        print('Exported rate table to {}'.format(path))
+
+    def legacy_csv_path(self):
+        """Path where the unscaled rate table was cached before binary and content-addressed caches were introduced."""
+        if self.cache_name is None:
+            return splitext(self.rate_table_path)[0] + '.csv'
+        return join(dirname(self.rate_table_path), self.cache_name + '_1.csv')
+
+    def _cache_manifest(self):
+        return CacheManifest(dirname(self.rate_table_path))
+
+    def _code_version(self):
+        """Hash of the source of the daedalus classes building this rate table."""
+        sha = hashlib.sha1()
+        for cls in type(self).__mro__:
+            if cls.__module__.startswith('daedalus'):
+                with open(inspect.getsourcefile(cls), 'rb') as source_file:
+                    sha.update(source_file.read())
+        return sha.hexdigest()
+
+    def _config_option(self, *keys, default=None):
+        """Get an optional value from the configuration, returning default if any of the keys is missing."""
+        value = self.configuration
+        try:
+            for key in keys:
+                value = value[key]
+        except KeyError:
+            return default
+        return value
 
     def _build(self):
         pass
@@ -59,53 +215,94 @@ class BaseHandler:
             df (dataframe): A dataframe with the right vph format.
             """
 
-        # get the unique values observed on the rate data
         if unique_sex is None:
             unique_sex = [1, 2]
-        unique_locations = np.unique(df['LAD.code'])
-        unique_ethnicity = np.unique(df['ETH.group'])
+        sexes, ages, columns = BaseHandler._leeds_rate_columns(unique_sex, age_start, age_end)
 
-        # loop over the observed values to fill the ne dataframe
-        list_dic = []
-        for loc in unique_locations:
+        full_index, values, observed_once = BaseHandler._leeds_category_values(df, columns)
 
-            sub_loc_df = df[df['LAD.code'] == loc]
+        problems = (~observed_once).sum()
+        if problems > 0:
+            print('Problem, more or less than one value in {} location/ethnicity categories'.format(problems))
 
-            for eth in unique_ethnicity:
+        return BaseHandler._long_rate_table(full_index, sexes, ages, values, year_start, year_end)
 
-                sub_loc_eth_df = sub_loc_df[sub_loc_df['ETH.group'] == eth]
+    @staticmethod
+    def _leeds_rate_columns(unique_sex, age_start, age_end):
+        """Map every (sex, age) pair of a rate table to its column in the wide LEEDS files.
 
-                for sex in unique_sex:
+            Parameters:
+            unique_sex (list of ints): Sex of indivuals to be considered
+            age_start (int): Minimum age observed in the rate table
+            age_end (int): Maximum age observed in the rate table
 
-                    # columns are separated for male and female rates
-                    if sex == 1:
-                        column_suffix = 'M'
-                    else:
-                        column_suffix = 'F'
+            Returns:
+            sexes (array), ages (array), columns (list): Sex, age and LEEDS column name of each rate,
+            ordered by sex and then age.
+            """
+        ages = np.arange(age_start, age_end)
+        sexes = np.repeat(np.asarray(unique_sex, dtype=np.int64), len(ages))
+        ages = np.tile(ages, len(unique_sex))
+
+        columns = []
+        for sex, age in zip(sexes, ages):
+            # columns are separated for male and female rates
+            column_suffix = 'M' if sex == 1 else 'F'
+
+            # cater for particular cases (age less than 1 and more than 100).
+            if age == -1:
+                columns.append(column_suffix + 'B.0')
+            elif age == 100:
+                columns.append(column_suffix + '100.101p')
+            else:
+                # columns parsed to the rigth name (eg 'M.50.51' for a male between 50 and 51 yo)
+                columns.append(column_suffix + str(age) + '.' + str(age + 1))
+
+        return sexes, ages, columns
 
-                    for age in range(age_start, age_end):
+    @staticmethod
+    def _leeds_category_values(df, columns):
+        """Arrange the LEEDS columns of a wide rate dataframe as one row per location/ethnicity category.
 
-                        # cater for particular cases (age less than 1 and more than 100).
-                        if age == -1:
-                            column = column_suffix + 'B.0'
-                        elif age == 100:
-                            column = column_suffix + '100.101p'
-                        else:
-                            # columns parsed to the rigth name (eg 'M.50.51' for a male between 50 and 51 yo)
-                            column = column_suffix + str(age) + '.' + str(age + 1)
+            Parameters:
+            df (dataframe): Input dataframe produced by LEEDS
+            columns (list): LEEDS columns to extract
 
-                        if sub_loc_eth_df[column].shape[0] == 1:
-                            value = sub_loc_eth_df[column].values[0]
-                        else:
-                            value = 0
-                            print('Problem, more or less than one value in this category')
+            Returns:
+            full_index (MultiIndex): Every combination of the locations and ethnicities observed in df
+            values (array): Values of the columns for each category, 0 where the category is not observed exactly once
+            observed_once (array of bools): Whether each category is observed exactly once
+            """
+        unique_locations = np.unique(df['LAD.code'])
+        unique_ethnicity = np.unique(df['ETH.group'])
+        full_index = pd.MultiIndex.from_product([unique_locations, unique_ethnicity], names=['LAD.code', 'ETH.group'])
+
+        counts = df.groupby(['LAD.code', 'ETH.group']).size()
+        observed_once = counts.reindex(full_index, fill_value=0).values == 1
 
-                        # create the rate row.
-                        dict = {'location': loc, 'ethnicity': eth, 'age_start': age, 'age_end': age + 1, 'sex': sex,
-                                'year_start': year_start, 'year_end': year_end, 'mean_value': value}
-                        list_dic.append(dict)
+        unique_rows = df.set_index(['LAD.code', 'ETH.group'])[columns]
+        unique_rows = unique_rows[~unique_rows.index.duplicated(keep=False)]
+        values = unique_rows.reindex(full_index, fill_value=0).values
 
-        return pd.DataFrame(list_dic)
+        return full_index, values, observed_once
+
+    @staticmethod
+    def _long_rate_table(full_index, sexes, ages, values, year_start, year_end):
+        """Build the vivarium rate table with one row per location/ethnicity category and LEEDS column,
+            in location/ethnicity/sex/age order.
+            """
+        n_groups = len(full_index)
+        n_columns = len(ages)
+        return pd.DataFrame({'location': np.repeat(full_index.get_level_values(0).values, n_columns),
+                             'ethnicity': np.repeat(full_index.get_level_values(1).values, n_columns),
+                             'age_start': np.tile(ages, n_groups),
+                             'age_end': np.tile(ages + 1, n_groups),
+                             'sex': np.tile(sexes, n_groups),
+                             'year_start': year_start,
+                             'year_end': year_end,
+                             'mean_value': values.ravel()},
+                            columns=['location', 'ethnicity', 'age_start', 'age_end', 'sex', 'year_start',
+                                     'year_end', 'mean_value'])
 
     @staticmethod
     def compute_migration_rates(df_migration_numbers, df_population_total, year_start, year_end, age_start, age_end,
@@ -129,55 +326,32 @@ class BaseHandler:
           df (dataframe): A dataframe with the right vph format.
           """
 
-        # get the unique values observed on the rate data
-        unique_locations = np.unique(df_migration_numbers['LAD.code'])
-        unique_ethnicity = np.unique(df_migration_numbers['ETH.group'])
-
-        # loop over the observed values to fill the ne dataframe
-        list_dic = []
-        for loc in unique_locations:
-
-            sub_loc_df = df_migration_numbers[df_migration_numbers['LAD.code'] == loc]
-            sub_loc_df_total = df_population_total[df_population_total['LAD'] == loc]
-
-            for eth in unique_ethnicity:
-
-                sub_loc_eth_df = sub_loc_df[sub_loc_df['ETH.group'] == eth]
-                sub_loc_eth_df_total = sub_loc_df_total[
-                    (sub_loc_df_total['ETH'] == eth + "_UK") | (sub_loc_df_total['ETH'] == eth + "_NonUK")]
-
-                for sex in unique_sex:
-
-                    # columns are separated for male and female rates
-                    if sex == 1:
-                        column_suffix = 'M'
-                    else:
-                        column_suffix = 'F'
-
-                    for age in range(age_start, age_end):
-
-                        # cater for particular cases (age less than 1 and more than 100).
-                        if age == -1:
-                            column = column_suffix + 'B.0'
-                            colum_total = 'B'
-                        elif age == 100:
-                            column = column_suffix + '100.101p'
-                        else:
-                            # columns parsed to the rigth name (eg 'M.50.51' for a male between 50 and 51 yo)
-                            column = column_suffix + str(age) + '.' + str(age + 1)
-                            colum_total = column_suffix + str(age)
-
-                        if sub_loc_eth_df[column].shape[0] == 1 and sub_loc_eth_df_total[colum_total].sum() != 0:
-                            if normalize:
-                                value = sub_loc_eth_df[column].values[0] / sub_loc_eth_df_total[colum_total].sum()
-                            else:
-                                value = sub_loc_eth_df[column].values[0]
-                        else:
-                            value = 0
-
-                        # create the rate row.
-                        dict = {'location': loc, 'ethnicity': eth, 'age_start': age, 'age_end': age + 1, 'sex': sex,
-                                'year_start': year_start, 'year_end': year_end, 'mean_value': value}
-                        list_dic.append(dict)
-
-        return pd.DataFrame(list_dic)
+        sexes, ages, columns = BaseHandler._leeds_rate_columns(unique_sex, age_start, age_end)
+
+        # columns of the total population file used as denominator (eg 'M50' for a male of 50 yo, 'B' for births).
+        # As before, the open-ended 100+ band is divided by the total of the previous age.
+        total_columns = []
+        for sex, age in zip(sexes, ages):
+            if age == -1:
+                total_columns.append('B')
+            elif age != 100:
+                total_columns.append(('M' if sex == 1 else 'F') + str(age))
+            else:
+                total_columns.append(total_columns[-1])
+
+        full_index, values, observed_once = BaseHandler._leeds_category_values(df_migration_numbers, columns)
+
+        # population totals of each ethnicity are the sum of its '_UK' and '_NonUK' groups
+        ethnicity_split = df_population_total['ETH'].str.extract(r'^(.*)_(?:UK|NonUK)$', expand=False)
+        totals = df_population_total[ethnicity_split.notnull()] \
+            .groupby([df_population_total['LAD'], ethnicity_split])[sorted(set(total_columns))].sum()
+        totals.index.names = full_index.names
+        denominators = totals.reindex(full_index, fill_value=0)[total_columns].values
+
+        valid = observed_once[:, None] & (denominators != 0)
+        if normalize:
+            values = np.where(valid, values / np.where(valid, denominators, 1), 0)
+        else:
+            values = np.where(valid, values, 0)
+
+        return BaseHandler._long_rate_table(full_index, sexes, ages, values, year_start, year_end)
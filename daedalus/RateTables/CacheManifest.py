@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+
+from daedalus.RateTables.FileLock import FileLock
+
+
+class CacheManifest:
+    """Small JSON manifest kept next to the cached rate tables.
+
+    It records every cached table (cache key and last time it was used), so that old entries can be removed in
+    least recently used order, and the content hash of the source files, so that a source file is only hashed
+    again when its size or modification time changes.
+    """
+    filename = 'rate_table_manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as manifest_file:
+                    return json.load(manifest_file)
+            except ValueError:
+                print('Ignoring unreadable rate table manifest {}'.format(self.path))
+        return {'entries': {}, 'files': {}}
+
+    def save(self, manifest):
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file and rename, so that readers never see a half-written manifest
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def file_hashes(self, paths):
+        """Content hash of each source file (None if missing), only hashed again when its size or mtime changed."""
+        with self._lock():
+            manifest = self.load()
+            hashes = []
+            for path in paths:
+                if path is None or not os.path.exists(path):
+                    hashes.append(None)
+                    continue
+                stat = os.stat(path)
+                record = manifest['files'].get(os.path.abspath(path))
+                if record is None or record['size'] != stat.st_size or record['mtime'] != stat.st_mtime:
+                    sha = hashlib.sha1()
+                    with open(path, 'rb') as source_file:
+                        for block in iter(lambda: source_file.read(1 << 20), b''):
+                            sha.update(block)
+                    record = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha.hexdigest()}
+                    manifest['files'][os.path.abspath(path)] = record
+                hashes.append(record['sha1'])
+            self.save(manifest)
+            return hashes
+
+    def record(self, filename, name, key):
+        """Register a cached table, or mark it as used now if it is already registered."""
+        with self._lock():
+            manifest = self.load()
+            now = time.time()
+            entry = manifest['entries'].setdefault(filename, {'name': name, 'key': key, 'created': now})
+            entry['last_used'] = now
+            self.save(manifest)
+
+    def remove(self, filename):
+        """Forget a cached table, the manifest itself is removed with the last entry."""
+        with self._lock():
+            manifest = self.load()
+            manifest['entries'].pop(filename, None)
+            if manifest['entries']:
+                self.save(manifest)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+
+    def clean(self, max_entries):
+        """Remove the least recently used cached tables, keeping at most max_entries of them.
+
+        Returns:
+        -------
+        The list of removed files.
+        """
+        with self._lock():
+            manifest = self.load()
+            # entries whose file has been removed by hand are forgotten
+            for filename in list(manifest['entries']):
+                if not os.path.exists(os.path.join(self.directory, filename)):
+                    del manifest['entries'][filename]
+
+            by_last_use = sorted(manifest['entries'], key=lambda f: manifest['entries'][f]['last_used'], reverse=True)
+            removed = []
+            for filename in by_last_use[max_entries:]:
+                print('Removing least recently used rate table {}'.format(filename))
+                os.remove(os.path.join(self.directory, filename))
+                del manifest['entries'][filename]
+                removed.append(filename)
+            self.save(manifest)
+            return removed
+
+    def _lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return FileLock(self.path + '.lock')
@@ -0,0 +1,60 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, an exclusively created lock file is used instead
+    fcntl = None
+
+
+class FileLock:
+    """Inter-process lock held on a lock file, to be used as a context manager.
+
+    Processes trying to take a lock held by another process block until it is released. The lock file is removed
+    when the lock is released.
+    """
+
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def acquire(self):
+        while True:
+            if fcntl is not None:
+                fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # the previous holder may have removed the file while we were waiting, lock the new one instead
+                try:
+                    if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                        self._fd = fd
+                        return
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+            else:
+                try:
+                    self._fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                    return
+                except FileExistsError:
+                    time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+from daedalus.RateTables.ODMatrixBundle import age_band
+
+
+class GravityODModel:
+    """Destination model of internal migration computed from the MSOA centroids instead of the OD matrices.
+
+    The probability of moving from an origin MSOA to one of its n_neighbours nearest MSOAs (the origin itself
+    excluded) is proportional to mass * max(distance, min_distance) ** -exponent, where the mass of a destination
+    (its share of the arrivals) and the exponent are fitted to each sex/age band OD matrix. Only the centroids and
+    masses are kept, O(MSOAs) memory, the neighbours being found with a KD-tree when destinations are drawn.
+    """
+
+    def __init__(self, coordinates, exponents, masses, n_neighbours, min_distance=1000.0):
+        """
+        Parameters
+        ----------
+        coordinates : ndarray
+            Centroid (X, Y) in metres of every OD index, shape (MSOAs, 2)
+        exponents : dict
+            Distance decay exponent of each matrix (eg 'M_16to19')
+        masses : dict
+            Mass of every destination for each matrix
+        n_neighbours : int
+            Number of nearest MSOAs that can be reached from an origin
+        min_distance : float
+            Distances are floored to this value in metres
+        """
+        self.coordinates = coordinates
+        self.exponents = exponents
+        self.masses = masses
+        self.n_neighbours = n_neighbours
+        self.min_distance = min_distance
+        self.tree = cKDTree(coordinates)
+
+    @staticmethod
+    def read_centroids(path_to_centroids, od_location_index):
+        """Coordinates of the population weighted centroid of every OD index (nan for MSOAs without centroid)."""
+        centroids = pd.read_csv(path_to_centroids, encoding='utf-8-sig')
+        od_indices = od_location_index.od_index(centroids['msoa11cd'].values)
+        coordinates = np.full((len(od_location_index.msoa_ids), 2), np.nan)
+        coordinates[od_indices[od_indices >= 0]] = centroids[['X', 'Y']].values[od_indices >= 0]
+        if np.isnan(coordinates).any():
+            raise ValueError('{} MSOAs of the OD matrices have no centroid in {}'.format(
+                np.isnan(coordinates).any(axis=1).sum(), path_to_centroids))
+        return coordinates
+
+    @classmethod
+    def calibrate(cls, od_matrices, coordinates, n_neighbours, min_distance=1000.0, sample_origins=1000, seed=0):
+        """Fit a model to the OD matrices.
+
+        The mass of each destination is its share of the arrivals of the matrix and the exponent minimises the mean
+        total variation distance between the OD rows and the model, over a sample of origins.
+
+        Parameters
+        ----------
+        od_matrices : dict
+            Sparse OD matrix of each name (eg 'M_16to19')
+        coordinates : ndarray
+            Centroid (X, Y) of every OD index
+        n_neighbours : int
+            Number of nearest MSOAs that can be reached from an origin
+        min_distance : float
+            Distances are floored to this value in metres
+        sample_origins : int
+            Number of origins (with at least one move) used to fit the exponents, None for all of them
+        seed : int
+            Seed of the origin sample
+
+        Returns:
+        -------
+        The GravityODModel and a dataframe with, for each matrix, the fitted exponent, the mean total variation
+        distance to the OD rows and the mean share of the OD row mass within the neighbours of the origins.
+        """
+        model = cls(coordinates, {}, {}, n_neighbours, min_distance)
+        rng = np.random.default_rng(seed)
+        report = []
+        for name, matrix in od_matrices.items():
+            matrix = scipy.sparse.csr_matrix(matrix)
+            arrivals = np.asarray(matrix.sum(axis=0)).ravel()
+            model.masses[name] = arrivals / arrivals.sum()
+
+            origins = np.flatnonzero(np.diff(matrix.indptr) > 0)
+            if sample_origins is not None and len(origins) > sample_origins:
+                origins = np.sort(rng.choice(origins, sample_origins, replace=False))
+            rows = matrix[origins].toarray()
+            rows /= rows.sum(axis=1, keepdims=True)
+            neighbours, distances = model.neighbours(origins)
+            observed = np.take_along_axis(rows, neighbours, axis=1)
+
+            def distance_to_od(exponent):
+                weights = cls._weights(model.masses[name][neighbours], distances, exponent, min_distance)
+                # mass outside of the neighbours is always missed
+                return 0.5 * (np.abs(observed - weights).sum(axis=1) + 1 - observed.sum(axis=1)).mean()
+
+            fit = scipy.optimize.minimize_scalar(distance_to_od, bounds=(0.0, 6.0), method='bounded')
+            model.exponents[name] = float(fit.x)
+            report.append({'matrix': name, 'n_neighbours': n_neighbours, 'exponent': float(fit.x),
+                           'total_variation_distance': float(fit.fun),
+                           'neighbour_mass_share': float(observed.sum(axis=1).mean())})
+        return model, pd.DataFrame(report)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            names = [str(name) for name in arrays['names']]
+            return cls(arrays['coordinates'],
+                       dict(zip(names, arrays['exponents'].tolist())),
+                       dict(zip(names, arrays['masses'])),
+                       int(arrays['n_neighbours']), float(arrays['min_distance']))
+
+    def save(self, path):
+        names = list(self.exponents)
+        # np.savez appends the extension itself when it is missing, write through a file object to keep the path
+        with open(path, 'wb') as model_file:
+            np.savez(model_file, coordinates=self.coordinates, names=np.asarray(names, dtype=str),
+                     exponents=np.asarray([self.exponents[name] for name in names]),
+                     masses=np.asarray([self.masses[name] for name in names]),
+                     n_neighbours=self.n_neighbours, min_distance=self.min_distance)
+
+    def age_band(self, ages):
+        """Age band of each age, using the bounds of the bands of the fitted matrices."""
+        return age_band(self.exponents, ages)
+
+    @property
+    def nbytes(self):
+        """Memory of the model (centroids, masses and KD-tree)."""
+        return (self.coordinates.nbytes + sum(masses.nbytes for masses in self.masses.values()) +
+                self.tree.indices.nbytes + self.tree.data.nbytes)
+
+    def neighbours(self, origins):
+        """The n_neighbours nearest MSOAs of each origin (the origin excluded) and their distances, shape (origins, k)."""
+        origins = np.atleast_1d(np.asarray(origins, dtype=np.int64))
+        distances, neighbours = self.tree.query(self.coordinates[origins], self.n_neighbours + 1)
+        # the origin is its own nearest MSOA, unless other centroids share its coordinates
+        not_origin = neighbours != origins[:, None]
+        keep = np.argsort(~not_origin, axis=1, kind='stable')[:, :self.n_neighbours]
+        return np.take_along_axis(neighbours, keep, axis=1), np.take_along_axis(distances, keep, axis=1)
+
+    def row(self, origin, sex, age_band):
+        """Destinations and probabilities of one origin."""
+        name = self._name(sex, age_band)
+        neighbours, distances = self.neighbours([origin])
+        weights = self._weights(self.masses[name][neighbours], distances, self.exponents[name], self.min_distance)
+        return neighbours[0], weights[0]
+
+    def sample_destinations(self, origins, sex, age_band, rng=None, uniforms=None):
+        """Draw the destination of a batch of movers, see ODMatrixBundle.sample_destinations (a single uniform draw
+        per mover is used)."""
+        origins = np.atleast_1d(np.asarray(origins, dtype=np.int64))
+        sex = np.broadcast_to(np.asarray(sex), origins.shape)
+        age_band = np.broadcast_to(np.asarray(age_band), origins.shape)
+        uniforms = rng.random(len(origins)) if uniforms is None else np.asarray(uniforms).reshape(-1, len(origins))[0]
+
+        destinations = np.full(len(origins), -1, dtype=np.int64)
+        names = np.char.add(np.char.add(sex.astype(str), '_'), age_band.astype(str))
+        for name in np.unique(names):
+            movers = np.flatnonzero(names == name)
+            # neighbours are searched once per origin, not per mover
+            unique_origins, mover_origins = np.unique(origins[movers], return_inverse=True)
+            neighbours, distances = self.neighbours(unique_origins)
+            cumulative = np.cumsum(self._weights(self.masses[name][neighbours], distances, self.exponents[name],
+                                                 self.min_distance), axis=1)
+            # rows of cumulative probabilities shifted by their row number, searched at once for all the movers
+            cumulative = np.minimum(cumulative / cumulative[:, -1:], 1) + np.arange(len(unique_origins))[:, None]
+            positions = np.searchsorted(cumulative.ravel(), mover_origins + uniforms[movers], side='right')
+            picked = np.minimum(positions - mover_origins * self.n_neighbours, self.n_neighbours - 1)
+            destinations[movers] = neighbours[mover_origins, picked]
+        return destinations
+
+    @staticmethod
+    def _weights(masses, distances, exponent, min_distance):
+        weights = masses * np.maximum(distances, min_distance) ** -exponent
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(weights / weights.sum(axis=1, keepdims=True))
+
+    @staticmethod
+    def _name(sex, age_band):
+        return '{}_{}'.format(sex, age_band)
@@ -1,6 +1,11 @@
-import pandas as pd
+import numpy as np
+from os.path import join
 
 from daedalus.RateTables.BaseHandler import BaseHandler
+from daedalus.RateTables.GravityODModel import GravityODModel
+from daedalus.RateTables.LADIndexedSource import MERGED_LADS, get_rates_location
+from daedalus.RateTables.ODLocationIndex import ODLocationIndex
+from daedalus.RateTables.ODMatrixBundle import ODMatrixBundle
 
 
 
@@ -10,20 +15,115 @@ class InternalMigrationMatrix(BaseHandler):
         self.path_msoa_to_lad = self.configuration.path_msoa_to_lad
         self.path_to_OD_matrix_index_file = self.configuration.path_to_OD_matrix_index_file
         self.df_OD_matrix_with_LAD = None
+        self.path_to_OD_matrices = self.configuration.path_to_OD_matrices
+        self.path_to_OD_matrix_bundle = self._config_option('path_to_OD_matrix_bundle',
+                                                            default=join(self.path_to_OD_matrices,
+                                                                         'od_matrices.bundle'))
         self.MSOA_location_index = {}
         self.df_OD_matrix_with_LAD = {}
+        self.OD_matrix_bundle = None
+        # bundle of the OD rows of the MSOAs of the LAD, and their OD indices
+        self.origin_bundle = None
+        self.origins = None
+        self.OD_location_index = None
+        self.location = self._config_option('location')
+        self.origin_subset = self._config_option('internal_migration', 'od_origin_subset', default=False)
+        self.path_to_gravity_model = self._config_option('internal_migration', 'gravity_model')
+        self.gravity_destinations = self._config_option('internal_migration', 'gravity_destinations',
+                                                        default='missing')
+        if self.gravity_destinations not in ['missing', 'all']:
+            raise ValueError("Unknown gravity_destinations {}, choose 'missing' or 'all'".format(
+                self.gravity_destinations))
+        if self.gravity_destinations == 'all' and self.path_to_gravity_model is None:
+            raise ValueError("gravity_destinations 'all' needs a gravity_model")
+        self.gravity_model = None
 
     def _build(self):
-        df_msoa_lad = pd.read_csv(self.path_msoa_to_lad)
-        df_OD_matrix_dest = pd.read_csv(self.path_to_OD_matrix_index_file, index_col=0)
-        print('Computing immigration OD matrices...')
-        self.df_OD_matrix_with_LAD = df_OD_matrix_dest.merge(df_msoa_lad[["MSOA11CD", "LAD16CD"]],left_index=True,
-                                                  right_on="MSOA11CD")
-        self.df_OD_matrix_with_LAD.index = self.df_OD_matrix_with_LAD["indices"]
-        # Create indices for MSOA and LAD
-        self.MSOA_location_index = self.df_OD_matrix_with_LAD["MSOA11CD"].to_dict()
-        self.LAD_location_index = self.df_OD_matrix_with_LAD["LAD16CD"].to_dict()
+        # OD index -> MSOA/LAD arrays, cached in binary form next to the rate tables
+        self.OD_location_index = ODLocationIndex.load_or_build(self.path_msoa_to_lad, self.path_to_OD_matrix_index_file,
+                                                               self.rate_table_dir)
+        self.df_OD_matrix_with_LAD = self.OD_location_index.to_frame()
+        # Create indices for MSOA and LAD (kept as dicts for the vivarium components using them)
+        self.MSOA_location_index = dict(zip(self.df_OD_matrix_with_LAD["indices"],
+                                            self.df_OD_matrix_with_LAD["MSOA11CD"]))
+        self.LAD_location_index = dict(zip(self.df_OD_matrix_with_LAD["indices"],
+                                           self.df_OD_matrix_with_LAD["LAD16CD"]))
 
+        if self.origin_subset and self.location is not None:
+            self.set_origin_subset()
 
+    def set_origin_subset(self):
+        """Extract the OD rows of the MSOAs of the LAD, that the movers of a single LAD run mostly leave from, to a
+        small bundle cached in a directory of the national OD matrix directory.
 
+        Simulants who moved out of the LAD stay in the simulation and can move again, their destinations are drawn
+        from the national bundle.
+        """
+        lads = MERGED_LADS.get(get_rates_location(self.location), [self.location])
+        origins = self.OD_location_index.od_indices_in(lads)
+        national = self.open_bundle()
+        if len(origins) == 0 or len(origins) >= national.n_origins():
+            print('No origin subset of the OD matrices for {}, using the national OD matrices'.format(self.location))
+            return
 
+        subset_dir = join(self.path_to_OD_matrices, 'origin_subsets', self.location)
+        self.origin_bundle = national.origin_subset(origins, subset_dir)
+        self.origins = origins
+
+    def open_bundle(self):
+        """Memory-mapped bundle of the national OD matrices of path_to_OD_matrices, opened on first use and
+        (re)built from the npz files when they are newer than it.
+
+        The InternalMigration component of daedalus draws the destinations of its movers from it, through
+        sample_destinations (the one of vivarium_population_spenser reads the npz files of path_to_OD_matrices).
+        """
+        if self.OD_matrix_bundle is None:
+            self.OD_matrix_bundle = ODMatrixBundle.open(self.path_to_OD_matrix_bundle, self.path_to_OD_matrices)
+        return self.OD_matrix_bundle
+
+    def load_gravity_model(self):
+        """Gravity model of internal_migration.gravity_model (None if there is none), loaded on first use."""
+        if self.gravity_model is None and self.path_to_gravity_model is not None:
+            self.gravity_model = GravityODModel.load(self.path_to_gravity_model)
+        return self.gravity_model
+
+    def open_destination_models(self):
+        """Open the OD matrix bundle (building it if needed) and load the gravity model that sample_destinations
+        uses, eg before the simulation starts."""
+        if self.gravity_destinations != 'all':
+            self.open_bundle()
+        self.load_gravity_model()
+
+    def age_band(self, ages):
+        """Age band of the matrices destinations are drawn from for each age."""
+        if self.gravity_destinations == 'all':
+            return self.load_gravity_model().age_band(ages)
+        return self.open_bundle().age_band(ages)
+
+    def sample_destinations(self, origins, sex, age_band, rng=None, uniforms=None):
+        """Draw destinations from the OD matrices, with the gravity model of internal_migration.gravity_model (if
+        any) for the origins without OD row, or for all of them with internal_migration.gravity_destinations 'all'.
+
+        The InternalMigration component of daedalus draws the destinations of its movers with it, see
+        ODMatrixBundle.sample_destinations for the parameters.
+        """
+        origins = np.atleast_1d(np.asarray(origins, dtype=np.int64))
+        sex = np.broadcast_to(np.asarray(sex), origins.shape)
+        age_band = np.broadcast_to(np.asarray(age_band), origins.shape)
+        uniforms = rng.random((2, len(origins))) if uniforms is None else np.asarray(uniforms)
+        if self.gravity_destinations == 'all':
+            return self.load_gravity_model().sample_destinations(origins, sex, age_band, uniforms=uniforms[0])
+        if self.origin_bundle is None:
+            destinations = self.open_bundle().sample_destinations(origins, sex, age_band, uniforms=uniforms)
+        else:
+            # the movers who left the LAD draw from the national matrices
+            destinations = self.origin_bundle.sample_destinations(origins, sex, age_band, uniforms=uniforms)
+            outside = ~np.isin(origins, self.origins)
+            if outside.any():
+                destinations[outside] = self.open_bundle().sample_destinations(
+                    origins[outside], sex[outside], age_band[outside], uniforms=uniforms[:, outside])
+        missing = destinations < 0
+        if self.load_gravity_model() is not None and missing.any():
+            destinations[missing] = self.gravity_model.sample_destinations(
+                origins[missing], sex[missing], age_band[missing], uniforms=uniforms[0, missing])
+        return destinations
@@ -0,0 +1,79 @@
+import os
+from collections import OrderedDict
+
+import pandas as pd
+
+# LADs whose rates are only available joined together.
+MERGED_LADS = {'E09000001+E09000033': ['E09000001', 'E09000033'],
+               'E06000052+E06000053': ['E06000052', 'E06000053']}
+
+
+def get_rates_location(location):
+    """LAD code under which the rates of a location are found, the merged code for the LADs joined together."""
+    for merged_code, lads in MERGED_LADS.items():
+        if location in lads:
+            return merged_code
+    return location
+
+
+class LADIndexedSource:
+    """National source file parsed once and kept in memory indexed by LAD code.
+
+    Loaders are shared within a process through `load`, so that building the tables of many LADs in a row (as
+    `scripts/parallel_run.py` does in each worker) parses each national file only once. Only the max_loaded most
+    recently used files are kept (a rate table is built from two of them at most), and `clear` frees them once the
+    tables are built.
+    """
+    _loaded = OrderedDict()
+    max_loaded = 2
+
+    def __init__(self, path, lad_column, group_column):
+        self.path = path
+        self.lad_column = lad_column
+        self.group_column = group_column
+
+        df = pd.read_csv(path)
+        self.columns = df.columns
+        self._by_lad = {lad: df_lad for lad, df_lad in df.groupby(lad_column, sort=False)}
+
+        # build the merged LADs from their parts when the file does not provide them
+        for merged_code, lads in MERGED_LADS.items():
+            if merged_code not in self._by_lad and any(lad in self._by_lad for lad in lads):
+                self._by_lad[merged_code] = self._merge([self._by_lad[lad] for lad in lads if lad in self._by_lad],
+                                                        merged_code)
+
+    @classmethod
+    def load(cls, path, lad_column, group_column):
+        """Get the loader of a file, parsing it only if it was not loaded before or has changed since."""
+        key = (os.path.abspath(path), os.path.getmtime(path), lad_column, group_column)
+        if key in cls._loaded:
+            cls._loaded.move_to_end(key)
+        else:
+            print('Indexing {} by {}...'.format(path, lad_column))
+            cls._loaded[key] = cls(path, lad_column, group_column)
+            while len(cls._loaded) > cls.max_loaded:
+                cls._loaded.popitem(last=False)
+        return cls._loaded[key]
+
+    @classmethod
+    def clear(cls):
+        """Forget the loaded files, to free their memory once the tables built from them are cached."""
+        cls._loaded.clear()
+
+    def get(self, lad):
+        """Rows of a LAD (an empty dataframe if the LAD is not found)."""
+        if lad in self._by_lad:
+            return self._by_lad[lad]
+        return pd.DataFrame(columns=self.columns)
+
+    def lads(self):
+        return list(self._by_lad)
+
+    def _merge(self, dfs, merged_code):
+        df = pd.concat(dfs)
+        numeric_columns = [column for column in df.select_dtypes('number').columns if column != self.group_column]
+        other_columns = [column for column in df.columns if column not in numeric_columns + [self.group_column]]
+        grouped = df.groupby(self.group_column, sort=False)
+        df = pd.concat([grouped[other_columns].first(), grouped[numeric_columns].sum()], axis=1).reset_index()
+        df[self.lad_column] = merged_code
+        return df[self.columns]
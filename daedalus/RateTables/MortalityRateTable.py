@@ -1,6 +1,6 @@
 import pandas as pd
 
-from daedalus.RateTables.BaseHandler import BaseHandler
+from daedalus.RateTables.BaseHandler import AGE_RANGE_KEYS, BaseHandler
 from os.path import exists
 from os import remove
 
@@ -8,10 +8,9 @@ from os import remove
 class MortalityRateTable(BaseHandler):
     def __init__(self, configuration):
         super().__init__(configuration=configuration)
-        self.scaling_method = self.configuration["scale_rates"]["method"]
-        self.filename = f'mortality_rate_table_{self.configuration["scale_rates"][self.scaling_method]["mortality"]}.csv'
-        self.rate_table_path = self.rate_table_dir + self.filename
+        self.scale_component = 'mortality'
         self.source_file = self.configuration.path_to_mortality_file
+        self.set_cache_key('mortality_rate_table', [self.source_file], AGE_RANGE_KEYS)
 
     def _build(self):
         df = pd.read_csv(self.source_file)
@@ -21,7 +20,3 @@ class MortalityRateTable(BaseHandler):
                                                     2012,
                                                     self.configuration.population.age_start,
                                                     self.configuration.population.age_end)
-
-        if self.configuration["scale_rates"][self.scaling_method]["mortality"] != 1:
-            print(f'Scaling the mortality migration rates by a factor of {self.configuration["scale_rates"][self.scaling_method]["mortality"]}')
-            self.rate_table["mean_value"] *= float(self.configuration["scale_rates"][self.scaling_method]["mortality"])
\ No newline at end of file
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from daedalus.RateTables.CacheManifest import CacheManifest
+from daedalus.RateTables.FileLock import FileLock
+
+
+class ODLocationIndex:
+    """MSOA and LAD of every OD matrix index, as integer arrays.
+
+    msoa_ids[od_index] and lad_ids[od_index] are positions in the msoa_codes and lad_codes tables (-1 when the OD index
+    has no MSOA in the lookup), so that OD indices of a whole population are translated to codes by array indexing.
+    The index is cached in binary form, named after a hash of the lookup and OD index files.
+    """
+    cache_prefix = 'OD_location_index'
+
+    def __init__(self, msoa_ids, lad_ids, msoa_codes, lad_codes):
+        self.msoa_ids = msoa_ids
+        self.lad_ids = lad_ids
+        self.msoa_codes = np.asarray(msoa_codes)
+        self.lad_codes = np.asarray(lad_codes)
+        # OD index of each MSOA of the code table
+        known = np.flatnonzero(self.msoa_ids >= 0)
+        self._msoa_od_indices = np.full(len(self.msoa_codes), -1, dtype=np.int64)
+        self._msoa_od_indices[self.msoa_ids[known]] = known
+
+    @classmethod
+    def build(cls, path_msoa_to_lad, path_to_OD_matrix_index_file):
+        """Index of the OD matrices from the MSOA to LAD lookup and the MSOA to OD index files."""
+        df_msoa_lad = pd.read_csv(path_msoa_to_lad, usecols=["MSOA11CD", "LAD16CD"]).drop_duplicates("MSOA11CD")
+        df_OD_matrix_dest = pd.read_csv(path_to_OD_matrix_index_file, index_col=0)
+        df_OD_matrix_dest = df_OD_matrix_dest.join(df_msoa_lad.set_index("MSOA11CD")["LAD16CD"])
+
+        n_indices = int(df_OD_matrix_dest["indices"].max()) + 1
+        msoa_codes = np.sort(df_OD_matrix_dest.index.unique().values.astype(str))
+        lad_codes = np.sort(df_OD_matrix_dest["LAD16CD"].dropna().unique().astype(str))
+        index_dtype = np.int16 if max(len(msoa_codes), len(lad_codes)) <= np.iinfo(np.int16).max else np.int32
+
+        msoa_ids = np.full(n_indices, -1, dtype=index_dtype)
+        msoa_ids[df_OD_matrix_dest["indices"].values] = np.searchsorted(msoa_codes,
+                                                                        df_OD_matrix_dest.index.values.astype(str))
+        lad_ids = np.full(n_indices, -1, dtype=index_dtype)
+        known_lad = df_OD_matrix_dest["LAD16CD"].notna().values
+        lad_ids[df_OD_matrix_dest["indices"].values[known_lad]] = np.searchsorted(
+            lad_codes, df_OD_matrix_dest["LAD16CD"].values[known_lad].astype(str))
+        return cls(msoa_ids, lad_ids, msoa_codes, lad_codes)
+
+    @classmethod
+    def load_or_build(cls, path_msoa_to_lad, path_to_OD_matrix_index_file, cache_dir):
+        """Load the cached index of these files, building and caching it first if needed."""
+        key = ''.join(CacheManifest(cache_dir).file_hashes([path_msoa_to_lad, path_to_OD_matrix_index_file]))
+        path = os.path.join(cache_dir, '{}_{}.npz'.format(cls.cache_prefix, key[:16]))
+        if not os.path.exists(path):
+            with FileLock(path + '.lock'):
+                if not os.path.exists(path):
+                    print('Building the OD location index...')
+                    cls.build(path_msoa_to_lad, path_to_OD_matrix_index_file).save(path)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(arrays['msoa_ids'], arrays['lad_ids'], arrays['msoa_codes'], arrays['lad_codes'])
+
+    def save(self, path):
+        # write to a temporary file and rename, so that other processes never read a half-written index
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as index_file:
+            np.savez(index_file, msoa_ids=self.msoa_ids, lad_ids=self.lad_ids, msoa_codes=self.msoa_codes,
+                     lad_codes=self.lad_codes)
+        os.replace(tmp_path, path)
+
+    def msoa(self, od_indices):
+        """MSOA code of each OD index."""
+        return self._codes(self.msoa_codes, self.msoa_ids[np.asarray(od_indices)])
+
+    def lad(self, od_indices):
+        """LAD code of each OD index."""
+        return self._codes(self.lad_codes, self.lad_ids[np.asarray(od_indices)])
+
+    def od_index(self, msoas):
+        """OD index of each MSOA code, -1 for unknown MSOAs."""
+        msoa_ids = pd.Index(self.msoa_codes).get_indexer(np.asarray(msoas))
+        return np.where(msoa_ids >= 0, self._msoa_od_indices[msoa_ids], -1)
+
+    def od_indices_in(self, lads):
+        """OD indices of all the MSOAs of some LADs."""
+        lad_ids = np.flatnonzero(np.isin(self.lad_codes, list(lads)))
+        return np.flatnonzero(np.isin(self.lad_ids, lad_ids))
+
+    def to_frame(self):
+        """OD indices with their MSOA and LAD codes, indexed by OD index (OD indices without MSOA are left out)."""
+        indices = np.flatnonzero(self.msoa_ids >= 0)
+        return pd.DataFrame({'indices': indices, 'MSOA11CD': self.msoa(indices), 'LAD16CD': self.lad(indices)},
+                            index=pd.Index(indices, name='indices'))
+
+    @staticmethod
+    def _codes(codes, ids):
+        return np.where(ids >= 0, codes[ids], None)
@@ -0,0 +1,339 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+
+from daedalus.RateTables.FileLock import FileLock
+
+
+class ODMatrixBundle:
+    """All the sex/age band OD probability matrices in one memory-mapped file.
+
+    The `*_prob_matrix_EW.npz` files are stored as CSR arrays (indptr, indices and data) in a single file made of a
+    small JSON header followed by the raw arrays. Opening the bundle maps the file read-only: nothing is read until a
+    row is accessed, only the pages of the rows used are loaded and every process of a node shares them through the
+    page cache.
+
+    Matrices are named after their source file, eg 'M_16to19' for 'M_16to19_prob_matrix_EW.npz'. To draw
+    destinations in constant time, the Walker alias table of every row (alias_prob and alias arrays, aligned with
+    data) is computed when the bundle is built and stored next to the CSR arrays.
+    """
+    magic = b'DAEDODB1'
+    version = 4
+    alignment = 64
+    file_suffix = '_prob_matrix_EW.npz'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as bundle_file:
+            if bundle_file.read(len(self.magic)) != self.magic:
+                raise ValueError('{} is not an OD matrix bundle'.format(path))
+            header_length = int(np.frombuffer(bundle_file.read(8), dtype='<u8')[0])
+            self.header = json.loads(bundle_file.read(header_length).decode())
+        self._data_start = len(self.magic) + 8 + header_length
+
+        self._memmap = np.memmap(path, dtype=np.uint8, mode='r')
+        self._arrays = {}
+        for name, matrix in self.header['matrices'].items():
+            self._arrays[name] = {array_name: self._view(**array) for array_name, array in matrix['arrays'].items()}
+
+    @classmethod
+    def open(cls, path, od_matrix_dir=None):
+        """Open a bundle, building it from the npz files of od_matrix_dir first if it is missing or out of date."""
+        if od_matrix_dir is not None and not cls.is_up_to_date(path, od_matrix_dir):
+            # only one process builds the bundle, the others wait for it
+            with FileLock(path + '.lock'):
+                if not cls.is_up_to_date(path, od_matrix_dir):
+                    cls.build(od_matrix_dir, path)
+        return cls(path)
+
+    @classmethod
+    def build(cls, od_matrix_dir, path):
+        """Write the bundle of all the OD matrices found in a directory.
+
+        Parameters
+        ----------
+        od_matrix_dir : str
+            Directory with the `*_prob_matrix_EW.npz` files
+        path : str
+            Path of the bundle
+        """
+        matrices = {}
+        for source in cls.source_files(od_matrix_dir):
+            print('Adding {} to the OD matrix bundle...'.format(source))
+            matrix = scipy.sparse.load_npz(source).tocsr()
+            matrix.sort_indices()
+            matrices[cls.matrix_name(source)] = {'shape': matrix.shape, 'arrays': cls.csr_arrays(matrix)}
+        cls.write(path, matrices, cls.source_stats(od_matrix_dir))
+        print('OD matrix bundle written to {}'.format(path))
+
+    @classmethod
+    def csr_arrays(cls, matrix):
+        """CSR arrays of a matrix with the alias tables of its rows."""
+        arrays = {'indptr': matrix.indptr.astype(np.int64),
+                  'indices': matrix.indices.astype(np.int32),
+                  'data': matrix.data.astype(np.float64)}
+        arrays['alias_prob'], arrays['alias'] = cls.alias_tables(arrays['indptr'], arrays['data'])
+        return arrays
+
+    @staticmethod
+    def alias_tables(indptr, data):
+        """Walker alias table of the rows of a CSR matrix, built with Vose's method.
+
+        For a draw in a row with n entries, the entry k is picked uniformly and kept with probability alias_prob[k],
+        else replaced by the entry alias[k] (both indices being relative to the start of the row).
+
+        Returns:
+        -------
+        The alias_prob and alias arrays, with one value per stored entry.
+        """
+        alias_prob = np.ones(len(data))
+        alias = np.zeros(len(data), dtype=np.int32)
+        for start, end in zip(indptr[:-1], indptr[1:]):
+            n = end - start
+            total = data[start:end].sum()
+            if n == 0 or total <= 0:
+                continue
+            scaled = list(data[start:end] * n / total)
+            alias[start:end] = np.arange(n)
+            small = [k for k in range(n) if scaled[k] < 1]
+            large = [k for k in range(n) if scaled[k] >= 1]
+            while small and large:
+                k, j = small.pop(), large.pop()
+                alias_prob[start + k] = scaled[k]
+                alias[start + k] = j
+                scaled[j] -= 1 - scaled[k]
+                (small if scaled[j] < 1 else large).append(j)
+            # left over entries (rounding errors) are kept with probability one
+        return alias_prob, alias
+
+    @classmethod
+    def write(cls, path, matrices, sources, origin_subset=None):
+        """Write a bundle from {name: {'shape': shape, 'arrays': {array name: ndarray}}}, arrays aligned in the file."""
+        header = {'version': cls.version, 'sources': sources, 'origin_subset': origin_subset, 'matrices': {}}
+        offset = 0
+        for name, matrix in matrices.items():
+            arrays = {}
+            for array_name, array in matrix['arrays'].items():
+                offset = cls._aligned(offset)
+                arrays[array_name] = {'offset': offset, 'dtype': array.dtype.str, 'length': len(array)}
+                offset += array.nbytes
+            header['matrices'][name] = {'shape': list(matrix['shape']), 'arrays': arrays}
+
+        # array offsets are relative to the end of the (padded) header
+        header_bytes = json.dumps(header, sort_keys=True).encode()
+        data_start = cls._aligned(len(cls.magic) + 8 + len(header_bytes))
+        header_bytes += b' ' * (data_start - len(cls.magic) - 8 - len(header_bytes))
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as bundle_file:
+            bundle_file.write(cls.magic)
+            bundle_file.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+            bundle_file.write(header_bytes)
+            for name, matrix in matrices.items():
+                for array_name, array in matrix['arrays'].items():
+                    bundle_file.seek(data_start + header['matrices'][name]['arrays'][array_name]['offset'])
+                    bundle_file.write(np.ascontiguousarray(array).tobytes())
+        # rename once complete, so that other processes never map a half-written bundle
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def source_files(cls, od_matrix_dir):
+        return sorted(glob.glob(os.path.join(od_matrix_dir, '*' + cls.file_suffix)))
+
+    @classmethod
+    def source_stats(cls, od_matrix_dir):
+        return {os.path.basename(source): [os.path.getsize(source), os.path.getmtime(source)]
+                for source in cls.source_files(od_matrix_dir)}
+
+    @classmethod
+    def matrix_name(cls, source):
+        return os.path.basename(source)[:-len(cls.file_suffix)]
+
+    @classmethod
+    def is_up_to_date(cls, path, od_matrix_dir):
+        """Whether the bundle exists and was built from the current npz files of od_matrix_dir."""
+        if not os.path.exists(path):
+            return False
+        try:
+            header = cls(path).header
+        except ValueError:
+            return False
+        return header['version'] == cls.version and header['sources'] == cls.source_stats(od_matrix_dir)
+
+    def names(self):
+        return list(self.header['matrices'])
+
+    def shape(self, name):
+        return tuple(self.header['matrices'][name]['shape'])
+
+    def matrix(self, sex, age_band):
+        """Whole matrix of a sex and age band as a scipy CSR matrix backed by the memory map."""
+        return self._matrix(self._name(sex, age_band))
+
+    def _matrix(self, name):
+        arrays = self._arrays[name]
+        return scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=self.shape(name),
+                                       copy=False)
+
+    def row(self, sex, age_band, origin):
+        """Destinations and probabilities of one origin row, only this row is read from the file.
+
+        Parameters
+        ----------
+        sex : str
+            'M' or 'F'
+        age_band : str
+            Age band of the matrix, eg '16to19'
+        origin : int
+            Row (OD index of the origin MSOA)
+
+        Returns:
+        -------
+        The array of destination OD indices and the array of their probabilities.
+        """
+        arrays = self._arrays[self._name(sex, age_band)]
+        start, end = arrays['indptr'][origin], arrays['indptr'][origin + 1]
+        return arrays['indices'][start:end], arrays['data'][start:end]
+
+    def sample_destinations(self, origins, sex, age_band, rng=None, uniforms=None):
+        """Draw the destination of a batch of movers, with the probabilities of the OD rows of their origin.
+
+        Parameters
+        ----------
+        origins : array-like of int
+            OD index of the origin MSOA of each mover
+        sex : str or array-like of str
+            'M' or 'F', for all or each of the movers
+        age_band : str or array-like of str
+            Age band of the matrix (eg '16to19'), for all or each of the movers, see `age_band`
+        rng : numpy Generator or RandomState
+            Source of the uniform draws
+        uniforms : ndarray
+            Uniform draws of shape (2, number of movers) used instead of drawing them from rng, eg the draws of a
+            vivarium randomness stream
+
+        Returns:
+        -------
+        An array with the OD index of the destination of each mover, -1 for movers whose origin row is empty.
+        """
+        origins = np.atleast_1d(np.asarray(origins, dtype=np.int64))
+        sex = np.broadcast_to(np.asarray(sex), origins.shape)
+        age_band = np.broadcast_to(np.asarray(age_band), origins.shape)
+        uniforms = rng.random((2, len(origins))) if uniforms is None else np.asarray(uniforms)
+
+        destinations = np.full(len(origins), -1, dtype=np.int64)
+        names = np.char.add(np.char.add(sex.astype(str), '_'), age_band.astype(str))
+        for name in np.unique(names):
+            movers = np.flatnonzero(names == name)
+            arrays = self._arrays[name]
+            start = arrays['indptr'][origins[movers]]
+            n = arrays['indptr'][origins[movers] + 1] - start
+            movers, start, n = movers[n > 0], start[n > 0], n[n > 0]
+
+            # uniform entry of the row, kept or replaced by its alias
+            k = np.minimum((uniforms[0, movers] * n).astype(np.int64), n - 1)
+            keep = uniforms[1, movers] < arrays['alias_prob'][start + k]
+            k = np.where(keep, k, arrays['alias'][start + k])
+            destinations[movers] = arrays['indices'][start + k]
+        return destinations
+
+    def origin_subset(self, origins, directory):
+        """Bundle with only some origin rows (eg the MSOAs of a LAD), written in a directory.
+
+        The matrices keep their national shape and indexing, other origin rows being empty. The subset is only
+        extracted again when the origins or the national matrices change.
+
+        Parameters
+        ----------
+        origins : array-like of int
+            OD indices of the origin MSOAs kept
+        directory : str
+            Directory of the subset
+
+        Returns:
+        -------
+        The ODMatrixBundle of the subset.
+        """
+        origins = np.unique(np.asarray(origins, dtype=np.int64))
+        path = os.path.join(directory, os.path.basename(self.path))
+        subset = {'origins': hashlib.sha1(origins.tobytes()).hexdigest()}
+        if not self._is_subset_up_to_date(path, subset):
+            os.makedirs(directory, exist_ok=True)
+            with FileLock(path + '.lock'):
+                if not self._is_subset_up_to_date(path, subset):
+                    print('Extracting the OD matrix rows of {} origins to {}...'.format(len(origins), directory))
+                    matrices = {name: {'shape': self.shape(name), 'arrays': self._origin_rows(self._arrays[name],
+                                                                                              origins)}
+                                for name in self.names()}
+                    self.write(path, matrices, self.header['sources'], origin_subset=subset)
+        return ODMatrixBundle(path)
+
+    def _is_subset_up_to_date(self, path, subset):
+        """Whether the subset bundle exists and was extracted for the same origins from the current national one."""
+        if not os.path.exists(path):
+            return False
+        try:
+            header = ODMatrixBundle(path).header
+        except ValueError:
+            return False
+        return header['version'] == self.version and header['sources'] == self.header['sources'] and \
+            header.get('origin_subset') == subset
+
+    def n_origins(self):
+        """Number of origin rows of the matrices."""
+        return max(self.shape(name)[0] for name in self.names())
+
+    @staticmethod
+    def _origin_rows(arrays, origins):
+        """Arrays of a matrix keeping only the entries of some rows."""
+        starts, ends = arrays['indptr'][origins], arrays['indptr'][origins + 1]
+        entries = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] +
+                                 [np.zeros(0, dtype=np.int64)])
+        row_lengths = np.zeros(len(arrays['indptr']) - 1, dtype=np.int64)
+        row_lengths[origins] = ends - starts
+        subset = {'indptr': np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64)}
+        for array_name, array in arrays.items():
+            if array_name != 'indptr':
+                subset[array_name] = np.asarray(array[entries])
+        return subset
+
+    def arrays(self, sex, age_band):
+        """All the arrays (indptr, indices, data...) of a matrix, as read-only memory maps."""
+        return self._arrays[self._name(sex, age_band)]
+
+    def age_bands(self):
+        """Age bands of the bundle, sorted by their lower bound (eg ['0to4', '5to15', ..., '75plus'])."""
+        return age_bands(self.names())
+
+    def age_band(self, ages):
+        """Age band of each age, using the bounds of the bands of the bundle."""
+        return age_band(self.names(), ages)
+
+    @staticmethod
+    def _name(sex, age_band):
+        return '{}_{}'.format(sex, age_band)
+
+    def _view(self, offset, dtype, length):
+        start = self._data_start + offset
+        return self._memmap[start:start + length * np.dtype(dtype).itemsize].view(dtype)
+
+    @classmethod
+    def _aligned(cls, offset):
+        return -(-offset // cls.alignment) * cls.alignment
+
+
+def age_bands(names):
+    """Age bands of sex/age band matrix names (eg 'M_16to19'), sorted by their lower bound."""
+    bands = {name.split('_', 1)[1] for name in names}
+    return sorted(bands, key=lambda band: int(band.replace('plus', 'to').split('to')[0]))
+
+
+def age_band(names, ages):
+    """Age band of each age, using the bounds of the bands of sex/age band matrix names."""
+    bands = age_bands(names)
+    starts = [int(band.replace('plus', 'to').split('to')[0]) for band in bands]
+    return np.asarray(bands)[np.searchsorted(starts, np.floor(np.asarray(ages)), side='right') - 1]
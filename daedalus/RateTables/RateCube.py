@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+
+class RateCube:
+    """Dense array of the rates of a rate table, indexed [location, ethnicity, sex, age, year].
+
+    Locations, ethnicities and sexes are mapped to integer codes through their sorted unique values, ages and years
+    through the [start, end) intervals of the rate table. Rates of whole populations are then looked up with array
+    indexing instead of filtering the long rate table.
+    """
+    value_column = 'mean_value'
+
+    def __init__(self, values, locations, ethnicities, sexes, age_bins, year_bins):
+        """
+        Parameters
+        ----------
+        values : ndarray
+            Rates with shape (locations, ethnicities, sexes, age bins, year bins)
+        locations, ethnicities, sexes : array-like
+            Sorted values of each categorical dimension
+        age_bins, year_bins : ndarray
+            Sorted (start, end) pairs with shape (n, 2) of each interval dimension
+        """
+        self.values = values
+        self.locations = pd.Index(locations)
+        self.ethnicities = pd.Index(ethnicities)
+        self.sexes = pd.Index(sexes)
+        self.age_bins = np.asarray(age_bins)
+        self.year_bins = np.asarray(year_bins)
+
+    @classmethod
+    def from_rate_table(cls, rate_table, fill_value=0.0, dtype=np.float64):
+        """Build the cube of a rate table in the long format used by vivarium (eg a BaseHandler rate table).
+
+        Parameters
+        ----------
+        rate_table : Dataframe
+            Rates with the location, ethnicity, sex, age_start, age_end, year_start, year_end and mean_value columns
+        fill_value : float
+            Rate of the cells missing in the rate table
+        dtype : numpy dtype
+            Type of the rates in the cube
+
+        Returns:
+        -------
+        A RateCube.
+        """
+        locations = np.sort(rate_table['location'].unique())
+        ethnicities = np.sort(rate_table['ethnicity'].unique())
+        sexes = np.sort(rate_table['sex'].unique())
+        age_bins = rate_table[['age_start', 'age_end']].drop_duplicates().sort_values('age_start').values
+        year_bins = rate_table[['year_start', 'year_end']].drop_duplicates().sort_values('year_start').values
+
+        cube = cls(np.full((len(locations), len(ethnicities), len(sexes), len(age_bins), len(year_bins)),
+                           fill_value, dtype=dtype),
+                   locations, ethnicities, sexes, age_bins, year_bins)
+        cube.values[cube.location_codes(rate_table['location']),
+                    cube.ethnicity_codes(rate_table['ethnicity']),
+                    cube.sex_codes(rate_table['sex']),
+                    cls._bin_codes(age_bins, rate_table['age_start']),
+                    cls._bin_codes(year_bins, rate_table['year_start'])] = rate_table[cls.value_column].values
+        return cube
+
+    def location_codes(self, locations):
+        return self.locations.get_indexer(np.asarray(locations))
+
+    def ethnicity_codes(self, ethnicities):
+        return self.ethnicities.get_indexer(np.asarray(ethnicities))
+
+    def sex_codes(self, sexes):
+        return self.sexes.get_indexer(np.asarray(sexes))
+
+    def age_codes(self, ages):
+        return self._bin_codes(self.age_bins, ages)
+
+    def year_codes(self, years):
+        return self._bin_codes(self.year_bins, years)
+
+    def lookup(self, location, ethnicity, sex, age, year=None):
+        """Rates of a population given as arrays (or scalars) of locations, ethnicities, sexes, ages and years.
+
+        The year can be omitted when the cube only has one year bin. Values outside of the cube get a nan rate.
+
+        Returns:
+        -------
+        An array with the rate of each simulant.
+        """
+        if year is None:
+            if len(self.year_bins) != 1:
+                raise ValueError('The rate cube has {} year bins, a year is needed'.format(len(self.year_bins)))
+            year = self.year_bins[0, 0]
+
+        codes = np.broadcast_arrays(self.location_codes(np.atleast_1d(location)),
+                                    self.ethnicity_codes(np.atleast_1d(ethnicity)),
+                                    self.sex_codes(np.atleast_1d(sex)),
+                                    self.age_codes(np.atleast_1d(age)),
+                                    self.year_codes(np.atleast_1d(year)))
+        found = np.all([code >= 0 for code in codes], axis=0)
+
+        rates = np.full(found.shape, np.nan)
+        rates[found] = self.values[tuple(code[found] for code in codes)]
+        return rates
+
+    def to_rate_table(self):
+        """Back to the long format, in location/ethnicity/sex/age/year order."""
+        location, ethnicity, sex, age, year = np.indices(self.values.shape).reshape(5, -1)
+        return pd.DataFrame({'location': self.locations.values[location],
+                             'ethnicity': self.ethnicities.values[ethnicity],
+                             'age_start': self.age_bins[age, 0],
+                             'age_end': self.age_bins[age, 1],
+                             'sex': self.sexes.values[sex],
+                             'year_start': self.year_bins[year, 0],
+                             'year_end': self.year_bins[year, 1],
+                             self.value_column: self.values.ravel()},
+                            columns=['location', 'ethnicity', 'age_start', 'age_end', 'sex', 'year_start',
+                                     'year_end', self.value_column])
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    @staticmethod
+    def _bin_codes(bins, values):
+        """Index of the [start, end) interval of each value, -1 if it falls in none of them."""
+        values = np.asarray(values)
+        codes = np.searchsorted(bins[:, 0], values, side='right') - 1
+        inside = (codes >= 0) & (values < bins[np.maximum(codes, 0), 1])
+        return np.where(inside, codes, -1)
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+
+class CSVCacheBackend:
+    """Plain text cache, kept to export rate tables in the format used by the original pipeline."""
+    extension = '.csv'
+
+    def write(self, rate_table, path):
+        rate_table.to_csv(path)
+
+    def read(self, path, compact=False):
+        rate_table = pd.read_csv(path, index_col=[0])
+        return to_storage_dtypes(rate_table) if compact else rate_table
+
+
+class NpzCacheBackend:
+    """Typed columnar cache stored as one numpy array per column (categories are stored as codes)."""
+    extension = '.npz'
+
+    def write(self, rate_table, path):
+        rate_table = to_storage_dtypes(rate_table)
+        arrays = {'__columns__': np.asarray(rate_table.columns, dtype=str)}
+        for i, column in enumerate(rate_table.columns):
+            if rate_table[column].dtype.name == 'category':
+                arrays['codes_{}'.format(i)] = rate_table[column].cat.codes.values
+                arrays['categories_{}'.format(i)] = np.asarray(rate_table[column].cat.categories, dtype=str)
+            else:
+                arrays['values_{}'.format(i)] = rate_table[column].values
+        # np.savez appends the extension itself when it is missing, write through a file object to keep the path
+        with open(path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+
+    def read(self, path, compact=False):
+        columns = {}
+        with np.load(path, allow_pickle=False) as arrays:
+            for i, column in enumerate(arrays['__columns__']):
+                if 'codes_{}'.format(i) in arrays:
+                    columns[column] = pd.Categorical.from_codes(arrays['codes_{}'.format(i)],
+                                                                arrays['categories_{}'.format(i)])
+                else:
+                    columns[column] = arrays['values_{}'.format(i)]
+            column_order = list(arrays['__columns__'])
+        return read_dtypes(pd.DataFrame(columns, columns=column_order), compact)
+
+
+class ParquetCacheBackend:
+    """Typed columnar cache stored in Parquet, needs pyarrow or fastparquet."""
+    extension = '.parquet'
+
+    def write(self, rate_table, path):
+        to_storage_dtypes(rate_table).to_parquet(path, index=False)
+
+    def read(self, path, compact=False):
+        return read_dtypes(pd.read_parquet(path), compact)
+
+
+class FeatherCacheBackend:
+    """Typed columnar cache stored in Feather, needs pyarrow."""
+    extension = '.feather'
+
+    def write(self, rate_table, path):
+        to_storage_dtypes(rate_table).reset_index(drop=True).to_feather(path)
+
+    def read(self, path, compact=False):
+        return read_dtypes(pd.read_feather(path), compact)
+
+
+CACHE_BACKENDS = {'csv': CSVCacheBackend,
+                  'npz': NpzCacheBackend,
+                  'parquet': ParquetCacheBackend,
+                  'feather': FeatherCacheBackend}
+
+
+def get_cache_backend(cache_format):
+    """Get the rate table cache backend for a given format.
+
+    Parameters
+    ----------
+    cache_format : str
+        One of 'npz', 'parquet', 'feather' or 'csv'.
+
+    Returns:
+    -------
+    An instance of the cache backend.
+    """
+    try:
+        return CACHE_BACKENDS[cache_format]()
+    except KeyError:
+        raise ValueError('Unknown rate table cache format {}, choose one of {}'.format(cache_format,
+                                                                                      list(CACHE_BACKENDS)))
+
+
+def to_storage_dtypes(rate_table):
+    """Categorical string columns and the smallest integer type for integer columns."""
+    rate_table = rate_table.copy()
+    for column in rate_table.columns:
+        if pd.api.types.is_string_dtype(rate_table[column]):
+            rate_table[column] = rate_table[column].astype('category')
+        elif pd.api.types.is_integer_dtype(rate_table[column]):
+            rate_table[column] = pd.to_numeric(rate_table[column], downcast='integer')
+    return rate_table
+
+
+def from_storage_dtypes(rate_table):
+    """Back to the plain object/int64 columns used in the rate tables handed to vivarium."""
+    for column in rate_table.columns:
+        if rate_table[column].dtype.name == 'category':
+            rate_table[column] = rate_table[column].astype(object)
+        elif pd.api.types.is_integer_dtype(rate_table[column]):
+            rate_table[column] = rate_table[column].astype(np.int64)
+    return rate_table
+
+
+def to_compact_dtypes(rate_table, float32=False):
+    """Storage dtypes kept in memory, with float32 rates if asked for."""
+    rate_table = to_storage_dtypes(rate_table)
+    if float32:
+        for column in rate_table.select_dtypes('float64').columns:
+            rate_table[column] = rate_table[column].astype(np.float32)
+    return rate_table
+
+
+def to_lookup_dtypes(rate_table):
+    """Rate table kept with compact dtypes in the columns handed to vivarium: its lookup tables do not support
+    categorical columns, which are converted back to strings, but keep the small integers and float32 rates."""
+    categories = rate_table.select_dtypes('category').columns
+    if len(categories) == 0:
+        return rate_table
+    return rate_table.astype({column: object for column in categories})
+
+
+def read_dtypes(rate_table, compact):
+    """Dtypes of a rate table read from the cache: the storage ones when compact, the plain ones otherwise."""
+    return rate_table if compact else from_storage_dtypes(rate_table)
@@ -0,0 +1,152 @@
+import numpy as np
+import scipy.sparse
+
+
+class TopKODMatrix:
+    """Compact OD matrix keeping the k most likely destinations of every origin row.
+
+    The kept probabilities are renormalised to sum to one and quantised, as uint16 (in units of 1/65535, each row
+    summing exactly to 65535) or float16. Destinations are stored as int16 when there are less than 32768 MSOAs. Rows
+    are padded to k entries with a zero probability and a -1 destination, so that the arrays are dense (origins, k)
+    blocks and all the destinations of an origin are contiguous in memory.
+    """
+    quantization = 65535
+
+    def __init__(self, destinations, probabilities, discarded_mass, n_destinations):
+        """
+        Parameters
+        ----------
+        destinations : ndarray
+            Destination indices with shape (origins, k), -1 for padding
+        probabilities : ndarray
+            Quantised (uint16) or float16 probabilities with shape (origins, k)
+        discarded_mass : ndarray
+            Share of the probability mass of each origin row that is not kept
+        n_destinations : int
+            Number of columns of the original matrix
+        """
+        self.destinations = destinations
+        self.probabilities = probabilities
+        self.discarded_mass = discarded_mass
+        self.n_destinations = n_destinations
+
+    @classmethod
+    def from_sparse(cls, matrix, k, probability_dtype=np.uint16):
+        """Keep the top k destinations of every row of a sparse OD matrix.
+
+        Parameters
+        ----------
+        matrix : scipy sparse matrix
+            OD probabilities, rows are origins
+        k : int
+            Number of destinations kept per origin
+        probability_dtype : numpy dtype
+            np.uint16 or np.float16
+
+        Returns:
+        -------
+        A TopKODMatrix. Its discarded_mass is the share of the probability mass of each row that falls outside of the
+        top k.
+        """
+        matrix = scipy.sparse.csr_matrix(matrix)
+        matrix.eliminate_zeros()
+        n_origins, n_destinations = matrix.shape
+        rows = np.repeat(np.arange(n_origins), np.diff(matrix.indptr))
+
+        # entries sorted by decreasing probability within each row, then ranked within their row
+        order = np.lexsort((-matrix.data, rows))
+        rank = np.arange(matrix.nnz) - matrix.indptr[rows]
+        kept = order[rank < k]
+        kept_rows, kept_rank = rows[kept], rank[rank < k]
+
+        index_dtype = np.int16 if n_destinations <= np.iinfo(np.int16).max else np.int32
+        destinations = np.full((n_origins, k), -1, dtype=index_dtype)
+        destinations[kept_rows, kept_rank] = matrix.indices[kept]
+        kept_probabilities = np.zeros((n_origins, k))
+        kept_probabilities[kept_rows, kept_rank] = matrix.data[kept]
+
+        kept_mass = kept_probabilities.sum(axis=1)
+        row_mass = np.asarray(matrix.sum(axis=1)).ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            discarded_mass = np.nan_to_num(1 - kept_mass / row_mass).clip(0, 1).astype(np.float32)
+            kept_probabilities = np.nan_to_num(kept_probabilities / kept_mass[:, None])
+        return cls(destinations, cls._quantize(kept_probabilities, probability_dtype), discarded_mass,
+                   n_destinations)
+
+    @classmethod
+    def from_npz(cls, path, k, probability_dtype=np.uint16):
+        """Top k matrix of a `*_prob_matrix_EW.npz` file."""
+        return cls.from_sparse(scipy.sparse.load_npz(path), k, probability_dtype)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['destinations'], arrays['probabilities'], arrays['discarded_mass'],
+                       int(arrays['n_destinations']))
+
+    def save(self, path):
+        # np.savez appends the extension itself when it is missing, write through a file object to keep the path
+        with open(path, 'wb') as matrix_file:
+            np.savez(matrix_file, destinations=self.destinations, probabilities=self.probabilities,
+                     discarded_mass=self.discarded_mass, n_destinations=self.n_destinations)
+
+    @property
+    def k(self):
+        return self.destinations.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.destinations.nbytes + self.probabilities.nbytes + self.discarded_mass.nbytes
+
+    def row_probabilities(self, origins=None):
+        """Decoded probabilities (origins, k) of some (by default all) origin rows, each summing to one."""
+        probabilities = self.probabilities if origins is None else self.probabilities[origins]
+        probabilities = probabilities.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(probabilities / probabilities.sum(axis=-1, keepdims=True))
+
+    def row(self, origin):
+        """Destinations and probabilities of one origin row."""
+        valid = self.destinations[origin] >= 0
+        return self.destinations[origin][valid].astype(np.int64), self.row_probabilities(origin)[valid]
+
+    def sample_destinations(self, origins, rng):
+        """Draw the destination of a batch of movers from the top k destinations of their origin.
+
+        Returns:
+        -------
+        An array with the destination index of each mover, -1 for movers whose origin row is empty.
+        """
+        origins = np.atleast_1d(np.asarray(origins, dtype=np.int64))
+        cumulative = np.cumsum(self.probabilities[origins].astype(np.float64), axis=1)
+        uniforms = rng.random(len(origins)) * cumulative[:, -1]
+        picked = np.minimum((cumulative <= uniforms[:, None]).sum(axis=1), self.k - 1)
+        destinations = self.destinations[origins, picked].astype(np.int64)
+        destinations[cumulative[:, -1] == 0] = -1
+        return destinations
+
+    def to_sparse(self):
+        """Back to a CSR matrix with the renormalised probabilities."""
+        rows, ranks = np.nonzero(self.destinations >= 0)
+        return scipy.sparse.csr_matrix((self.row_probabilities()[rows, ranks], (rows, self.destinations[rows, ranks])),
+                                       shape=(len(self.destinations), self.n_destinations))
+
+    def report(self):
+        """Summary of the footprint and of the probability mass lost by keeping only k destinations."""
+        return {'k': self.k,
+                'origins': len(self.destinations),
+                'nbytes': self.nbytes,
+                'mean_discarded_mass': float(self.discarded_mass.mean()),
+                'max_discarded_mass': float(self.discarded_mass.max())}
+
+    @classmethod
+    def _quantize(cls, probabilities, probability_dtype):
+        if np.dtype(probability_dtype) == np.float16:
+            return probabilities.astype(np.float16)
+        if np.dtype(probability_dtype) != np.uint16:
+            raise ValueError('Unsupported OD probability type {}, use uint16 or float16'.format(probability_dtype))
+        quantized = np.rint(probabilities * cls.quantization).astype(np.int64)
+        # rounding errors go to the most likely destination, so that each non empty row sums exactly to 65535
+        non_empty = quantized.sum(axis=1) > 0
+        quantized[non_empty, 0] += cls.quantization - quantized[non_empty].sum(axis=1)
+        return quantized.astype(np.uint16)
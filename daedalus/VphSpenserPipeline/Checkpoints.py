@@ -0,0 +1,136 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import random
+import re
+
+import numpy as np
+import pandas as pd
+
+
+class Checkpoints:
+    """Checkpoints of a simulation written at the end of each simulated year, to resume an interrupted run.
+
+    A checkpoint holds the state table of the population (untracked simulants included), the time of the clock, the
+    key mapping of the randomness system (simulants' random draws depend on it, the seed and the clock only) and the
+    global numpy and python random states, with the state of other parts of the pipeline if any (eg the
+    PopulationArchiver). Each is a pickle written next to a small JSON file with its hash and compression, written
+    last, so that a checkpoint interrupted half-way is never taken as valid.
+    """
+    pattern = 'checkpoint_year_{}.pkl'
+
+    def __init__(self, directory, keep=1, compression=None):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory of the checkpoints of a run
+        keep : int
+            Number of checkpoints kept, older ones are removed (None to keep all)
+        compression : str
+            Compression of the pickles, None (the fastest to write) or one of the compressions of pandas.to_pickle
+            (eg 'gzip', several times smaller and slower)
+        """
+        self.directory = directory
+        self.keep = keep
+        self.compression = compression
+
+    def save(self, simulation, year, extra=None):
+        """Write the checkpoint of a simulation at the end of a simulated year, with extra state to restore with it
+        (picklable)."""
+        os.makedirs(self.directory, exist_ok=True)
+        state = {'year': year,
+                 'population': simulation._population._population,
+                 'clock_time': simulation._clock._time,
+                 'randomness_key_mapping': simulation._randomness._key_mapping.__dict__,
+                 'numpy_random_state': np.random.get_state(),
+                 'python_random_state': random.getstate(),
+                 'extra': extra}
+
+        path = os.path.join(self.directory, self.pattern.format(year))
+        # write to a temporary file and rename, then mark the checkpoint as valid
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        pd.to_pickle(state, tmp_path, compression=self.compression, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with open(self._marker(path), 'w') as marker_file:
+            json.dump({'year': year, 'sha1': self._hash(path), 'compression': self.compression}, marker_file)
+        print('Checkpoint of year {} written to {}'.format(year, path))
+
+        # checkpoints of later years were left by another run, and would be taken as the latest one
+        years = self.years()
+        for old_year in [other_year for other_year in years if other_year > year]:
+            self.remove(old_year)
+        if self.keep is not None:
+            # the checkpoint just written is always kept
+            years = [other_year for other_year in years if other_year <= year]
+            for old_year in years[:-max(self.keep, 1)]:
+                self.remove(old_year)
+
+    def latest(self):
+        """Year of the latest valid checkpoint, None if there is none."""
+        for year in reversed(self.years()):
+            if self.is_valid(year):
+                return year
+            print('Ignoring invalid checkpoint of year {}'.format(year))
+        return None
+
+    def restore(self, simulation, year):
+        """Put a simulation that has been set up back in the state of a checkpoint.
+
+        The state is updated in place, as the components of the simulation hold references to the randomness key
+        mapping.
+
+        Returns:
+        -------
+        The extra state saved with the checkpoint (None if there was none)
+        """
+        path = os.path.join(self.directory, self.pattern.format(year))
+        with open(self._marker(path)) as marker_file:
+            compression = json.load(marker_file).get('compression')
+        state = pd.read_pickle(path, compression=compression)
+        simulation._population._population = state['population']
+        simulation._clock._time = state['clock_time']
+        simulation._randomness._key_mapping.__dict__.update(state['randomness_key_mapping'])
+        np.random.set_state(state['numpy_random_state'])
+        random.setstate(state['python_random_state'])
+        print('Simulation restored from the checkpoint of year {} ({} simulants, clock at {})'.format(
+            year, len(state['population']), state['clock_time']))
+        return state.get('extra')
+
+    def years(self):
+        """Years of the checkpoints found in the directory, valid or not, sorted."""
+        paths = glob.glob(os.path.join(self.directory, self.pattern.format('*')))
+        return sorted(int(re.search(r'checkpoint_year_(\d+)', os.path.basename(path)).group(1)) for path in paths)
+
+    def is_valid(self, year):
+        path = os.path.join(self.directory, self.pattern.format(year))
+        try:
+            with open(self._marker(path)) as marker_file:
+                return json.load(marker_file)['sha1'] == self._hash(path)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def clear(self):
+        """Remove all the checkpoints of the directory, eg those of a previous run when a new run starts."""
+        for year in self.years():
+            self.remove(year)
+
+    def remove(self, year):
+        path = os.path.join(self.directory, self.pattern.format(year))
+        for one_file in [self._marker(path), path]:
+            if os.path.exists(one_file):
+                os.remove(one_file)
+
+    @staticmethod
+    def _marker(path):
+        return path + '.json'
+
+    @staticmethod
+    def _hash(path):
+        sha = hashlib.sha1()
+        with open(path, 'rb') as checkpoint_file:
+            for block in iter(lambda: checkpoint_file.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
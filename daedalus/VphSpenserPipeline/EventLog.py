@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class EventLog:
+    """Append-only log of the events of a simulation, written instead of yearly snapshots of the whole population.
+
+    The tracked columns of the state table are compared with their previous values after every time step:
+    simulants that entered the simulation (births and immigrations) and simulants whose tracked state changed
+    (deaths, emigrations, internal moves and other updates, eg the last birth time of mothers) are logged with the
+    time of the step, the event, their previous MSOA and LAD and their whole new state. The other columns change
+    together with the tracked ones (eg the previous locations of the movers), or, like ages, for everyone. Together
+    with the population at the start (the base), this is enough to rebuild the population at any date, see
+    OutputStore.population_at. The events of each year are written at the end of the year, so that disk use and
+    write time scale with the number of events.
+    """
+    # columns of the log before the state of the simulants
+    event_columns = ['time', 'event', 'old_MSOA', 'old_LAD']
+    # columns compared after every time step, only these are copied from the state table
+    tracked_columns = ['alive', 'location', 'MSOA', 'entrance_time', 'exit_time', 'last_birth_time']
+
+    def __init__(self, output_store, location, translate=None):
+        """
+        Parameters
+        ----------
+        output_store : OutputStore
+            Where and in which format the log is written
+        location : str
+            Simulated LAD
+        translate : callable
+            Applied to the logged simulants, eg PopulationArchiver.with_simulant_ids to log them by simulant id when
+            the state table is compacted
+        """
+        self.output_store = output_store
+        self.location = location
+        self.translate = translate
+        self._previous = None
+        self._columns = None
+        self._events = []
+
+    def start(self, population, time):
+        """Write the base population and start a new log, at the start of the simulation."""
+        self.output_store.write_file(population, self.output_store.events_path(self.location))
+        write_manifest(self.output_store.event_log_manifest_path(self.location),
+                       {'start_time': str(time), 'year_end_times': {}})
+        self.resume(population)
+
+    def resume(self, population):
+        """Continue the log of a simulation restored from a checkpoint, from its current population."""
+        self._keep_state(population)
+        self._events = []
+
+    def run_for(self, simulation, duration):
+        """Run a simulation for a duration, step by step, recording the events of each step (the same steps as
+        InteractiveContext.run_for)."""
+        for _ in range(int(np.ceil(duration / simulation._clock.step_size))):
+            simulation.step()
+            self.record(simulation._population._population, simulation._clock._time)
+
+    def record(self, population, time):
+        """Record the events between the previous state of the population and its state at a time."""
+        previous = self._previous
+        # simulants are appended to the state table, compare the rows in place unless they were reordered
+        in_place = population.index[:len(previous)].equals(previous.index)
+        positions = np.arange(len(previous)) if in_place else population.index.get_indexer(previous.index)
+
+        changed = np.zeros(len(previous), dtype=bool)
+        for column in previous.columns:
+            new_values = population[column].values
+            new_values = new_values[:len(previous)] if in_place else new_values[positions]
+            old_values = previous[column].values
+            changed |= (new_values != old_values) & ~(pd.isna(new_values) & pd.isna(old_values))
+
+        entered = np.ones(len(population), dtype=bool)
+        entered[positions] = False
+        new_simulants = population[entered]
+        if len(new_simulants):
+            birth = new_simulants['parent_id'].values != -1 if 'parent_id' in new_simulants else False
+            self._log(new_simulants, time, np.where(birth, 'birth', 'immigration'), None, None)
+
+        updated = population.iloc[positions[changed]]
+        old = previous[changed]
+        if len(updated):
+            event = np.select([updated['alive'].values == 'dead', updated['alive'].values == 'emigrated',
+                               updated['MSOA'].values != old['MSOA'].values],
+                              ['death', 'emigration', 'internal_migration'], 'update')
+            # deaths and emigrations are logged once, later updates of exited simulants are not moves
+            exited_before = old['alive'].values != 'alive'
+            event = np.where(exited_before & (event != 'internal_migration'), 'update', event)
+            self._log(updated, time, event, old['MSOA'].values, old['location'].values)
+
+        self._keep_state(population)
+
+    def end_year(self):
+        """Events recorded since the end of the previous year, to be written with write_events, the log being
+        emptied for the next year."""
+        if self._events:
+            events = pd.concat(self._events)
+        else:
+            events = pd.DataFrame(columns=self.event_columns + self._columns)
+        events.index.name = 'simulant_id'
+        self._events = []
+        return events
+
+    def _keep_state(self, population):
+        """Copy of the tracked columns of the state table, to compare it with its state after the next step."""
+        self._previous = population[[column for column in self.tracked_columns if column in population]].copy()
+        self._columns = [column for column in population.columns if column != 'age'] + ['age']
+
+    def _log(self, simulants, time, event, old_MSOA, old_LAD):
+        if self.translate is not None:
+            simulants = self.translate(simulants)
+        log = pd.DataFrame({'time': pd.Timestamp(time), 'event': event, 'old_MSOA': old_MSOA, 'old_LAD': old_LAD},
+                           index=simulants.index)
+        self._events.append(pd.concat([log, simulants], axis=1))
+
+
+def write_events(output_store, location, events, year, end_time):
+    """Write the events of a year of the log of a LAD and add the year to the log (run by the output writer, the
+    year is only added once its events are on disk)."""
+    path = output_store.write_file(events, output_store.events_path(location, year))
+    manifest_path = output_store.event_log_manifest_path(location)
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest['year_end_times'][str(year)] = str(end_time)
+    write_manifest(manifest_path, manifest)
+    return path
+
+
+def write_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, path)
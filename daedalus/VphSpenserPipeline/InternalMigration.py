@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+
+class InternalMigration:
+    """Internal migration of the simulants between MSOAs, drawn from the memory-mapped OD matrix bundle.
+
+    The simulants move with the rates of cause.age_specific_internal_outmigration_rate and write the same columns as
+    the InternalMigration component of vivarium_population_spenser, but their destinations are drawn by the
+    InternalMigrationMatrix written to the simulation data as internal_migration.OD_matrices (from the OD matrix
+    bundle and/or the gravity model of its configuration), instead of from OD matrices loaded from the npz files by
+    every worker. The bundle is mapped read-only: the processes of a node share its pages through the page cache, and
+    only the origin rows of the movers are read.
+    """
+    columns_created = ['internal_outmigration', 'last_outmigration_time', 'previous_MSOA_locations',
+                       'previous_LAD_locations']
+
+    @property
+    def name(self):
+        return 'internal_migration'
+
+    def setup(self, builder):
+        rate_table = builder.data.load('cause.age_specific_internal_outmigration_rate')
+        self.outmigration_rate_table = builder.lookup.build_table(rate_table,
+                                                                  key_columns=['sex', 'location', 'ethnicity'],
+                                                                  parameter_columns=['age', 'year'],
+                                                                  value_columns=['mean_value'])
+        self.outmigration_rate = builder.value.register_rate_producer('int_outmigration_rate',
+                                                                      source=self.calculate_outmigration_rate,
+                                                                      requires_columns=['sex', 'location',
+                                                                                        'ethnicity'])
+        self.OD_matrices = builder.data.load('internal_migration.OD_matrices')
+        self.random = builder.randomness.get_stream('internal_outmigration')
+
+        builder.population.initializes_simulants(self.on_initialize_simulants, creates_columns=self.columns_created)
+        self.population_view = builder.population.get_view(self.columns_created +
+                                                           ['alive', 'age', 'sex', 'MSOA', 'location'])
+        builder.event.register_listener('time_step', self.on_time_step)
+
+    def on_initialize_simulants(self, pop_data):
+        self.population_view.update(pd.DataFrame({'internal_outmigration': '',
+                                                  'last_outmigration_time': pd.Series(pd.NaT, index=pop_data.index,
+                                                                                      dtype='datetime64[ns]'),
+                                                  'previous_MSOA_locations': '',
+                                                  'previous_LAD_locations': ''}, index=pop_data.index))
+
+    def calculate_outmigration_rate(self, index):
+        return self.outmigration_rate_table(index)
+
+    def on_time_step(self, event):
+        population = self.population_view.get(event.index, query="alive == 'alive'")
+        movers = self.random.filter_for_rate(population.index, self.outmigration_rate(population.index))
+        if len(movers) == 0:
+            return
+        # uniform draws of the destinations, keyed by simulant like the other random draws of vivarium
+        uniforms = np.vstack([self.random.get_draw(movers, additional_key='destination'),
+                              self.random.get_draw(movers, additional_key='destination_alias')])
+        update = self.moves(population.loc[movers], event.time, uniforms)
+        if not update.empty:
+            self.population_view.update(update)
+
+    def moves(self, movers, time, uniforms):
+        """New MSOA and LAD of the movers and their previous locations.
+
+        Parameters
+        ----------
+        movers : pandas.DataFrame
+            Simulants moving out of their MSOA, with their MSOA, location (LAD), sex (1 or 2) and age
+        time : pandas.Timestamp
+            Time of the moves
+        uniforms : ndarray
+            Two uniform draws for each mover
+
+        Returns:
+        -------
+        The update of the population view, movers whose MSOA has no OD index or no destination are left out.
+        """
+        location_index = self.OD_matrices.OD_location_index
+        origins = location_index.od_index(movers['MSOA'].values)
+        known = origins >= 0
+        movers, origins, uniforms = movers[known], origins[known], uniforms[:, known]
+
+        sex = np.where(movers['sex'].values == 1, 'M', 'F')
+        age_band = self.OD_matrices.age_band(movers['age'].values)
+        destinations = self.OD_matrices.sample_destinations(origins, sex, age_band, uniforms=uniforms)
+        moved = destinations >= 0
+        movers, destinations = movers[moved], destinations[moved]
+
+        return pd.DataFrame({'internal_outmigration': 'Yes',
+                             'last_outmigration_time': pd.Series(time, index=movers.index, dtype='datetime64[ns]'),
+                             'previous_MSOA_locations': movers['MSOA'].values,
+                             'previous_LAD_locations': movers['location'].values,
+                             'MSOA': location_index.msoa(destinations),
+                             'location': location_index.lad(destinations)}, index=movers.index)
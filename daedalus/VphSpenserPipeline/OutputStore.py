@@ -0,0 +1,303 @@
+import json
+import os
+import re
+
+import pandas as pd
+
+# dtypes of the population columns when read back from CSV (times are kept as strings)
+columns_dtypes = {'tracked': 'bool', 'immigrated': 'str', 'emigrated': 'str', 'cause_of_death': 'str',
+          'years_of_life_lost': 'float64', 'previous_MSOA_locations': 'str', 'internal_outmigration': 'str',
+          'last_outmigration_time': 'str', 'previous_LAD_locations': 'str', 'ethnicity': 'str', 'age': 'float64',
+          'MSOA': 'str', 'alive': 'str', 'sex': 'float64', 'location': 'str', 'exit_time': 'str',
+          'entrance_time': 'str', 'parent_id': 'int64', 'last_birth_time': 'str', 'age_bucket': 'str'}
+
+# typed schema of the columnar formats: categorical strings and datetime times
+output_schema = {column: 'datetime64[ns]' if column.endswith('_time') else 'category' if dtype == 'str' else dtype
+                 for column, dtype in columns_dtypes.items()}
+
+# file extension and compressions of each output format (None: uncompressed)
+OUTPUT_FORMATS = {'csv': ('.csv', [None, 'gzip', 'bz2', 'xz', 'zip']),
+                  'parquet': ('.parquet', [None, 'snappy', 'gzip', 'brotli', 'zstd', 'lz4']),
+                  'feather': ('.feather', [None, 'lz4', 'zstd'])}
+CSV_COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zip': '.zip'}
+
+
+class OutputStore:
+    """Population snapshots of the simulations, stored as CSV or as typed columnar files (Parquet or Feather, they
+    need pyarrow), partitioned by simulated LAD and year:
+
+    <output_dir>/<LAD>/year_<n>/ssm_<LAD>_MSOA11_ppp_2011_simulation_year_<n>[_reassigned].<format>
+    <output_dir>/<LAD>/ssm_<LAD>_MSOA11_ppp_2011_simulation[_reassigned].<format>  (final population)
+
+    Instead of yearly snapshots, a simulation can write an event log (see EventLog): the population at the start
+    and the events of each year, from which the population at any date is rebuilt.
+
+    <output_dir>/<LAD>/events/ssm_<LAD>_MSOA11_ppp_2011_events_base.<format>  (population at the start)
+    <output_dir>/<LAD>/events/ssm_<LAD>_MSOA11_ppp_2011_events_year_<n>.<format>
+    <output_dir>/<LAD>/events/event_log.json  (start time and end time of each logged year)
+
+    Simulants that left the simulation can be moved out of it to an archive, at the end of each year (see
+    PopulationArchiver):
+
+    <output_dir>/<LAD>/archive/ssm_<LAD>_MSOA11_ppp_2011_archive_year_<n>.<format>  (simulants archived in year n)
+
+    Snapshots are read in whatever format they were written, so that readers work on outputs of any format, and are
+    rebuilt from the event log when there is no snapshot of a year.
+    """
+
+    def __init__(self, output_dir, output_format='csv', compression=None):
+        """
+        Parameters
+        ----------
+        output_dir : str
+            Directory of the outputs of all the simulated LADs
+        output_format : str
+            Format of the written snapshots: 'csv', 'parquet' or 'feather'
+        compression : str
+            Compression of the written snapshots (None: uncompressed), see OUTPUT_FORMATS
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format {}, use one of {}'.format(output_format, list(OUTPUT_FORMATS)))
+        if compression not in OUTPUT_FORMATS[output_format][1]:
+            raise ValueError('Unknown {} compression {}, use one of {}'.format(output_format, compression,
+                                                                               OUTPUT_FORMATS[output_format][1]))
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.compression = compression
+
+    @classmethod
+    def from_config(cls, config):
+        """Store of the `output` section of the config (uncompressed CSV by default)."""
+        if 'output' not in config:
+            return cls(config.output_dir)
+        return cls(config.output_dir, config.output.format, config.output.compression)
+
+    def path(self, location, year=None, reassigned=False, output_format=None, compression=None):
+        """Path of a snapshot in a format (the format of the store by default).
+
+        Parameters
+        ----------
+        location : str
+            Simulated LAD
+        year : int
+            Simulated year, None for the final population
+        reassigned : bool
+            Population with the internal migrants reassigned to their LAD
+        """
+        name = 'ssm_' + location + '_MSOA11_ppp_2011_simulation'
+        directory = os.path.join(self.output_dir, location)
+        if year is not None:
+            name += '_year_' + str(year)
+            directory = os.path.join(directory, 'year_' + str(year))
+        name += '_reassigned' if reassigned else ''
+        return self._path(directory, name, output_format, compression)
+
+    def events_path(self, location, year=None, output_format=None, compression=None):
+        """Path of the events of a year of the event log, or of its base population (year None)."""
+        name = 'ssm_' + location + '_MSOA11_ppp_2011_events_' + ('base' if year is None else 'year_' + str(year))
+        return self._path(os.path.join(self.output_dir, location, 'events'), name, output_format, compression)
+
+    def archive_path(self, location, year, output_format=None, compression=None):
+        """Path of the simulants archived at the end of a year."""
+        name = 'ssm_' + location + '_MSOA11_ppp_2011_archive_year_' + str(year)
+        return self._path(os.path.join(self.output_dir, location, 'archive'), name, output_format, compression)
+
+    def event_log_manifest_path(self, location):
+        return os.path.join(self.output_dir, location, 'events', 'event_log.json')
+
+    def find(self, location, year=None, reassigned=False):
+        """Path of a written snapshot, whatever its format (the format of the store first), None if there is none."""
+        return self._find(lambda *output_format: self.path(location, year, reassigned, *output_format))
+
+    def find_events(self, location, year=None):
+        """Path of the written events of a year (or base population), whatever their format, None if there are none."""
+        return self._find(lambda *output_format: self.events_path(location, year, *output_format))
+
+    def find_archive(self, location, year):
+        """Path of the simulants archived in a year, whatever their format, None if there are none."""
+        return self._find(lambda *output_format: self.archive_path(location, year, *output_format))
+
+    def exists(self, location, year=None, reassigned=False):
+        """Whether there is a snapshot, written or that can be rebuilt from the event log."""
+        return self.find(location, year, reassigned) is not None or (
+            not reassigned and self._event_log_end_time(location, year) is not None)
+
+    def write(self, pop, location, year=None, reassigned=False):
+        """Write a snapshot.
+
+        Returns:
+        -------
+        The path of the written file.
+        """
+        return self.write_file(pop, self.path(location, year, reassigned))
+
+    def write_file(self, frame, path):
+        """Write a frame in the format of the store, through a temporary file so that a half-written file is never
+        left."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if self.output_format == 'csv':
+            frame.to_csv(tmp_path, compression=self.compression)
+        else:
+            self._write_columnar(to_output_dtypes(frame), tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, location, year=None, reassigned=False):
+        """Read a snapshot in whatever format it was written, or rebuild it from the event log."""
+        path = self.find(location, year, reassigned)
+        if path is not None:
+            return read_output(path)
+        end_time = None if reassigned else self._event_log_end_time(location, year)
+        if end_time is None:
+            raise FileNotFoundError('No output for {} (year {}) in {}'.format(location, year, self.output_dir))
+        return self.population_at(location, end_time)
+
+    def read_event_log_manifest(self, location):
+        """Start time and end time of each year of the event log of a LAD, None if it has no event log."""
+        path = self.event_log_manifest_path(location)
+        if not os.path.exists(path):
+            return None
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+        return {'start_time': pd.Timestamp(manifest['start_time']),
+                'year_end_times': {int(year): pd.Timestamp(end_time)
+                                   for year, end_time in manifest['year_end_times'].items()}}
+
+    def read_events(self, location, until=None):
+        """Events of the event log of a LAD, in the order they happened, up to a date (all of them by default)."""
+        manifest = self.read_event_log_manifest(location)
+        if manifest is None:
+            raise FileNotFoundError('No event log for {} in {}'.format(location, self.output_dir))
+        parts = []
+        year_start_time = manifest['start_time']
+        for year, end_time in sorted(manifest['year_end_times'].items()):
+            if until is not None and year_start_time > pd.Timestamp(until):
+                break
+            parts.append(read_output(self.find_events(location, year)))
+            year_start_time = end_time
+        if not parts:
+            return pd.DataFrame(columns=['time', 'event'])
+        events = pd.concat(parts)
+        events['time'] = pd.to_datetime(events['time'])
+        return events if until is None else events[events['time'] <= pd.Timestamp(until)]
+
+    def population_at(self, location, date):
+        """Rebuild the population of a LAD at a date from its event log.
+
+        The population at the start is updated with the latest state of every simulant that had an event (or
+        entered the simulation) up to the date. The ages of the living simulants are then brought forward to the
+        date, by 365.25 days a year as in the simulation, so that the population matches the snapshot of the
+        simulation at the end of any of its time steps.
+        """
+        manifest = self.read_event_log_manifest(location)
+        date = pd.Timestamp(date)
+        if manifest is None or date < manifest['start_time']:
+            raise ValueError('No event log of {} covering {} in {}'.format(location, date, self.output_dir))
+        population = read_output(self.find_events(location))
+        latest = self.read_events(location, until=date)
+        latest = latest[~latest.index.duplicated(keep='last')]
+
+        state_time = pd.Series(manifest['start_time'], index=population.index)
+        population = pd.concat([population.drop(latest.index, errors='ignore'), latest[population.columns]])
+        state_time = pd.concat([state_time.drop(latest.index, errors='ignore'), latest['time']])
+        population, state_time = population.sort_index(), state_time.sort_index()
+
+        alive = (population['alive'] == 'alive').values
+        population.loc[alive, 'age'] += (date - state_time[alive]) / pd.Timedelta(days=365.25)
+        return population
+
+    def locations(self):
+        """Simulated LADs found in the output directory."""
+        return sorted(location for location in os.listdir(self.output_dir)
+                      if os.path.isdir(os.path.join(self.output_dir, location)) and location.startswith('E'))
+
+    def years(self, location):
+        """Simulated years of a LAD found in the output directory (snapshots or event log), sorted."""
+        years = {int(match.group(1)) for match in
+                 (re.fullmatch(r'year_(\d+)', name) for name in os.listdir(os.path.join(self.output_dir, location)))
+                 if match}
+        manifest = self.read_event_log_manifest(location)
+        return sorted(years | set(manifest['year_end_times']) if manifest is not None else years)
+
+    def _path(self, directory, name, output_format=None, compression=None):
+        if output_format is None:
+            output_format, compression = self.output_format, self.compression
+        name += OUTPUT_FORMATS[output_format][0]
+        if output_format == 'csv':
+            name += CSV_COMPRESSION_EXTENSIONS[compression]
+        return os.path.join(directory, name)
+
+    def _find(self, path):
+        # path(output_format, compression) of a file, the format of the store first
+        candidates = [path()]
+        for output_format in OUTPUT_FORMATS:
+            if output_format == 'csv':
+                candidates += [path('csv', compression) for compression in CSV_COMPRESSION_EXTENSIONS]
+            else:
+                candidates.append(path(output_format, None))
+        return next((candidate for candidate in candidates if os.path.exists(candidate)), None)
+
+    def _event_log_end_time(self, location, year):
+        # end of a year of the event log (of its last year for the final population), None if it was not logged
+        manifest = self.read_event_log_manifest(location)
+        if manifest is None or not manifest['year_end_times']:
+            return None
+        return manifest['year_end_times'].get(max(manifest['year_end_times']) if year is None else year)
+
+    def _write_columnar(self, pop, path):
+        import pyarrow as pa
+        table = pa.Table.from_pandas(pop, preserve_index=True)
+        if self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path, compression=self.compression or 'none')
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, path, compression=self.compression or 'uncompressed')
+
+
+def read_output(path):
+    """Read a snapshot file, its format given by its extension."""
+    if path.endswith(OUTPUT_FORMATS['parquet'][0]):
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pandas()
+    if path.endswith(OUTPUT_FORMATS['feather'][0]):
+        import pyarrow.feather as feather
+        return feather.read_table(path).to_pandas()
+    return pd.read_csv(path, index_col=0, dtype=columns_dtypes)
+
+
+def output_format_of(path):
+    """Format and compression of a snapshot file, to write other snapshots like it (the compression of Feather
+    files is not recorded, they are taken as uncompressed)."""
+    if path.endswith(OUTPUT_FORMATS['parquet'][0]):
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(path).metadata
+        compression = metadata.row_group(0).column(0).compression.lower() if metadata.num_row_groups else None
+        return 'parquet', compression if compression in OUTPUT_FORMATS['parquet'][1] else None
+    if path.endswith(OUTPUT_FORMATS['feather'][0]):
+        return 'feather', None
+    for compression, extension in CSV_COMPRESSION_EXTENSIONS.items():
+        if compression is not None and path.endswith(OUTPUT_FORMATS['csv'][0] + extension):
+            return 'csv', compression
+    return 'csv', None
+
+
+def to_output_dtypes(pop):
+    """Cast the population columns to the typed schema of the columnar formats (other string columns are stored as
+    categories)."""
+    pop = pop.copy()
+    for column in pop.columns:
+        dtype = output_schema.get(column)
+        if dtype is None and (pd.api.types.is_object_dtype(pop[column]) or
+                              pd.api.types.is_string_dtype(pop[column])):
+            dtype = 'category'
+        if dtype is None or pop[column].dtype.name == dtype:
+            continue
+        if dtype.startswith('datetime64'):
+            pop[column] = pd.to_datetime(pop[column])
+        elif dtype == 'category':
+            pop[column] = pop[column].astype('category')
+        else:
+            pop[column] = pop[column].astype(dtype)
+    return pop
@@ -0,0 +1,108 @@
+import concurrent.futures
+import threading
+import time
+
+from daedalus.VphSpenserPipeline.PhaseTimer import peak_rss_mb
+
+
+class OutputWriter:
+    """Write the population snapshots of the simulation in the background.
+
+    Snapshots are written to an OutputStore by a worker thread or process while the next year is simulated. At most
+    max_pending snapshots wait to be written, each one holding a copy of the population: `write` blocks until one
+    of them is done when there are more. `close` waits for all of them and raises the first error of the worker.
+    The time the worker spends on each write is recorded as an 'output' phase of the timer, if any.
+    """
+
+    def __init__(self, output_store, mode='thread', max_pending=1, timer=None):
+        """
+        Parameters
+        ----------
+        output_store : OutputStore
+            Where and in which format the snapshots are written
+        mode : str
+            'thread' (no copy of the snapshot, but formatting competes with the simulation for the GIL), 'process'
+            (formatting runs alongside the simulation, but each snapshot is pickled to the worker process, a full
+            serialized copy of the population) or 'sync' (written before returning)
+        max_pending : int
+            Maximum number of snapshots waiting to be written
+        timer : PhaseTimer
+            Timer of the run the writes are reported to
+        """
+        if mode == 'process':
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        elif mode == 'thread':
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        elif mode == 'sync':
+            self._executor = None
+        else:
+            raise ValueError("Unknown output writer {}, use 'process', 'thread' or 'sync'".format(mode))
+        self.output_store = output_store
+        self.mode = mode
+        self.timer = timer
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, pop, location, year=None):
+        """Queue the snapshot of a simulated LAD and year to be written, see OutputStore.write."""
+        self.submit(self.output_store.write, pop, location, year)
+
+    def submit(self, function, *args):
+        """Queue any writing function, eg of the events of an EventLog (it must be picklable for a 'process'
+        writer)."""
+        self._raise_errors()
+        if self._executor is None:
+            self._report(*timed_call(function, *args))
+            return
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(timed_call, function, *args)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+
+    def flush(self):
+        """Wait until all the queued snapshots are written."""
+        concurrent.futures.wait(self._futures)
+        self._raise_errors()
+
+    def close(self):
+        """Wait until all the snapshots are written."""
+        if self._executor is not None:
+            concurrent.futures.wait(self._futures)
+            self._executor.shutdown()
+            self._executor = None
+        self._raise_errors()
+
+    def _raise_errors(self):
+        # forget the snapshots that are written, raise the error of a failed one
+        done = [future for future in self._futures if future.done()]
+        self._futures = [future for future in self._futures if not future.done()]
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+            self._report(*future.result())
+
+    def _report(self, path, wall_seconds, cpu_seconds, worker_peak_rss_mb):
+        print('Written', path)
+        if self.timer is not None:
+            details = {'path': path, 'writer': self.mode}
+            if self.mode == 'process':
+                details['worker_peak_rss_mb'] = worker_peak_rss_mb
+            self.timer.add('output', wall_seconds, cpu_seconds, **details)
+
+
+def timed_call(function, *args):
+    """Call a writing function, returning its result with the wall and CPU time it took and the peak RSS of the
+    process running it (a module function, to be sent to a worker process)."""
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    return result, time.perf_counter() - start_wall, time.process_time() - start_cpu, peak_rss_mb()
@@ -0,0 +1,112 @@
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class PhaseTimer:
+    """Wall time, CPU time and peak memory of each phase of a run, written as a JSON report next to its outputs.
+
+    Every phase is recorded under a phase type (eg 'rate_table' or 'simulate_year') with optional details (the
+    table, the year, whether a rate table was read from the cache...), so that the reports of several LADs can be
+    merged by phase type with merge_reports. The peak RSS is the high-water mark of the process at the end of the
+    phase: a phase raising it is the one that needed the memory.
+    """
+
+    def __init__(self, location=None):
+        """
+        Parameters
+        ----------
+        location : str
+            Simulated LAD, recorded in the report
+        """
+        self.location = location
+        self.phases = []
+        self._started = datetime.datetime.now()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, phase, **details):
+        """Time the block of a with statement as a phase. The details recorded with it can be completed inside the
+        block through the dictionary it yields."""
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        details = dict(details)
+        try:
+            yield details
+        finally:
+            self.add(phase, time.perf_counter() - start_wall, time.process_time() - start_cpu, **details)
+
+    def add(self, phase, wall_seconds, cpu_seconds, **details):
+        """Record a phase timed elsewhere, eg an output written by a background worker."""
+        record = {'phase': phase}
+        record.update(details)
+        record.update({'wall_seconds': round(wall_seconds, 3), 'cpu_seconds': round(cpu_seconds, 3),
+                       'peak_rss_mb': peak_rss_mb()})
+        self.phases.append(record)
+        return record
+
+    def report(self):
+        """The report of the run so far, as a JSON serializable dictionary."""
+        return {'location': self.location,
+                'started': self._started.strftime("%Y-%m-%d %H:%M:%S"),
+                'wall_seconds': round(time.perf_counter() - self._start_wall, 3),
+                'cpu_seconds': round(time.process_time() - self._start_cpu, 3),
+                'peak_rss_mb': peak_rss_mb(),
+                'phases': self.phases}
+
+    def write(self, path):
+        """Write the report as JSON (atomically, it can be rewritten while a run goes on)."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2, default=str)
+        os.replace(tmp_path, path)
+        print('Timing report written to {}'.format(path))
+        return path
+
+
+def timing_report_path(output_dir, location):
+    """Path of the timing report of a LAD, next to its outputs."""
+    return os.path.join(output_dir, location, 'timing_report_{}.json'.format(location))
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process in MB (None where the resource module is not available)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+
+def merge_reports(paths):
+    """Merge the timing reports of several runs (eg one per LAD of a parallel run).
+
+    Returns:
+    -------
+    A dataframe with one row per phase of every report (with its location) and a dataframe with the total wall and
+    CPU time, the number of phases and the largest peak RSS of each phase type over all the reports.
+    """
+    phases = []
+    for path in paths:
+        with open(path) as report_file:
+            report = json.load(report_file)
+        for record in report['phases']:
+            phases.append(dict(record, location=report['location']))
+    phases = pd.DataFrame(phases, columns=None if phases else ['location', 'phase', 'wall_seconds',
+                                                               'cpu_seconds', 'peak_rss_mb'])
+    summary = phases.groupby('phase', sort=False).agg(count=('wall_seconds', 'size'),
+                                                      wall_seconds=('wall_seconds', 'sum'),
+                                                      cpu_seconds=('cpu_seconds', 'sum'),
+                                                      peak_rss_mb=('peak_rss_mb', 'max'))
+    return phases, summary.sort_values('wall_seconds', ascending=False)
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+from daedalus.VphSpenserPipeline.OutputStore import read_output
+
+
+class PopulationArchiver:
+    """Move the simulants that left the simulation (dead or emigrated) out of its state table.
+
+    Exited simulants otherwise stay in the state table for the whole run, and every time step works on all of them.
+    At each compaction they are written to the archive of the LAD in the output store, and the state table keeps
+    the living ones only. Vivarium uses the index of the state table as positions (population view updates,
+    simulant creation, random draws), so it is renumbered from 0, and the archiver keeps the simulant id of each
+    row: the index the simulant would have without compaction. The randomness key mapping is compacted in the
+    same way, so that the remaining simulants keep their random draws, and the ids of the columns referring to
+    other simulants (parent_id) are translated when their rows are compacted.
+
+    get_population returns the population as it would be without compaction: the living simulants with their ids,
+    and the archived ones read back.
+    """
+
+    def __init__(self, output_store, location, id_columns=('parent_id',)):
+        """
+        Parameters
+        ----------
+        output_store : OutputStore
+            Where and in which format the archive is written
+        location : str
+            Simulated LAD
+        id_columns : tuple
+            Columns holding the index of another simulant (-1 for none)
+        """
+        self.output_store = output_store
+        self.location = location
+        self.id_columns = id_columns
+        # simulant id of each row of the state table up to the last compaction, later rows are numbered from next_id
+        self.ids = None
+        self.next_id = 0
+        # years whose compaction archived simulants
+        self.years = []
+        self._archive = None
+
+    def simulant_ids(self, index):
+        """Simulant ids of rows of the state table."""
+        positions = np.asarray(index)
+        if self.ids is None:
+            return positions
+        return np.where(positions < len(self.ids), self.ids[np.minimum(positions, len(self.ids) - 1)],
+                        self.next_id + positions - len(self.ids))
+
+    def with_simulant_ids(self, population):
+        """Rows of the state table indexed by their simulant ids, with the id columns translated."""
+        population = population.copy()
+        population.index = pd.Index(self.simulant_ids(population.index))
+        if self.ids is not None:
+            # rows created since the last compaction still refer to other simulants by their row
+            created = np.asarray(population.index) >= self.next_id
+            for column in self.id_columns:
+                if column in population and created.any():
+                    values = population[column].values
+                    refers = created & (values >= 0)
+                    values = values.copy()
+                    values[refers] = self.simulant_ids(values[refers])
+                    population[column] = values
+        return population
+
+    def compact(self, simulation, year):
+        """Archive the exited simulants at the end of a year and remove them from the state table.
+
+        Returns:
+        -------
+        The number of archived simulants
+        """
+        population = self.with_simulant_ids(simulation._population._population)
+        exited = (population['alive'] != 'alive').values
+        keep = np.flatnonzero(~exited)
+        if exited.any():
+            archive = population[exited]
+            self.output_store.write_file(archive, self.output_store.archive_path(self.location, year))
+            self.years.append(year)
+            if self._archive is not None:
+                self._archive = pd.concat([self._archive, archive])
+
+        key_mapping = simulation._randomness._key_mapping
+        if len(key_mapping._map) >= len(population):
+            # the random draws of a row are read at its position in the key mapping (without a key for every
+            # simulant, eg with the default randomness.key_columns, vivarium draws by row and there is none)
+            key_mapping._map = pd.concat([key_mapping._map.iloc[keep], key_mapping._map.iloc[len(population):]])
+
+        self.next_id = max(self.next_id, int(population.index.max()) + 1 if len(population) else 0)
+        self.ids = np.asarray(population.index)[keep]
+        active = population.iloc[keep]
+        active.index = pd.RangeIndex(len(active))
+        simulation._population._population = active
+        print('Archived {} exited simulants, {} simulants left in the simulation'.format(exited.sum(), len(active)))
+        return int(exited.sum())
+
+    def get_population(self, simulation, untracked=False, archived=True):
+        """Population of the simulation indexed by simulant id, like simulation.get_population, with the archived
+        simulants (read back from the archive once, then kept) by default."""
+        population = self.with_simulant_ids(simulation._population._population)
+        if archived and self.years:
+            if self._archive is None:
+                self._archive = pd.concat([read_output(self.output_store.find_archive(self.location, year))
+                                           for year in self.years])
+            population = pd.concat([like(self._archive, population), population]).sort_index()
+            population.index.name = None
+        if not untracked and 'tracked' in population:
+            population = population[population['tracked']]
+        return population
+
+    def state(self):
+        """State of the archiver, saved with the checkpoints of the simulation."""
+        return {'ids': self.ids, 'next_id': self.next_id, 'years': list(self.years)}
+
+    def restore(self, state):
+        self.ids = state['ids']
+        self.next_id = state['next_id']
+        self.years = list(state['years'])
+        self._archive = None
+
+
+def like(frame, population):
+    """Columns of a frame read back from the archive cast to the dtypes of the population (times are read from CSV
+    as strings)."""
+    frame = frame.copy()
+    for column, dtype in population.dtypes.items():
+        if column not in frame or frame[column].dtype == dtype:
+            continue
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            frame[column] = pd.to_datetime(frame[column])
+        else:
+            frame[column] = frame[column].astype(dtype)
+    return frame
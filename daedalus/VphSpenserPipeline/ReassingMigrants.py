@@ -3,14 +3,9 @@ import os
 import pandas as pd
 import argparse
 from glob import glob
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore, columns_dtypes, output_format_of
 pd.options.mode.chained_assignment = None
 
-columns_dtypes = {'tracked': 'bool', 'immigrated': 'str', 'emigrated': 'str', 'cause_of_death': 'str',
-          'years_of_life_lost': 'float64', 'previous_MSOA_locations': 'str', 'internal_outmigration': 'str',
-          'last_outmigration_time': 'str', 'previous_LAD_locations': 'str', 'ethnicity': 'str', 'age': 'float64',
-          'MSOA': 'str', 'alive': 'str', 'sex': 'float64', 'location': 'str', 'exit_time': 'str',
-          'entrance_time': 'str', 'parent_id': 'int64', 'last_birth_time': 'str', 'age_bucket': 'str'}
-
 
 def get_migrants(input_path, list_pop_locations_dir):
     """ Function that finds all the individuals that internally migrated into a given location
@@ -26,9 +21,9 @@ def get_migrants(input_path, list_pop_locations_dir):
 
     """
 
-    input_location_path = os.path.join(input_path, list_pop_locations_dir[0])
-    # path to the simulation files
-    list_pop_dir = [i for i in os.listdir(input_location_path) if i.startswith('year_')]
+    store = OutputStore(input_path)
+    # path to the simulation files (in any output format)
+    list_pop_dir = ['year_' + str(year) for year in store.years(list_pop_locations_dir[0])]
 
     dict_migrants = {}
     # for each year run the reassigment
@@ -43,8 +38,7 @@ def get_migrants(input_path, list_pop_locations_dir):
 
         for loc in list_pop_locations_dir:
 
-            data_location_simulation = pd.read_csv(os.path.join(input_path, loc, year_dir,
-                                                                'ssm_' + loc + '_MSOA11_ppp_2011_simulation_' + year_dir + '.csv'), dtype=columns_dtypes)
+            data_location_simulation = store.read(loc, year_number(year_dir))
 
             data_location_simulation_int_migrants = data_location_simulation[data_location_simulation['location'] != loc]
 
@@ -53,8 +47,7 @@ def get_migrants(input_path, list_pop_locations_dir):
                 migrant_data = pd.concat([migrant_data,data_location_simulation_int_migrants])
 
             if year_dir == list_pop_dir[-1]:
-                data_location_simulation_full = pd.read_csv(os.path.join(input_path, loc,
-                                                                         'ssm_' + loc + '_MSOA11_ppp_2011_simulation.csv'), dtype=columns_dtypes)
+                data_location_simulation_full = store.read(loc)
 
                 data_location_simulation_full_migrants = data_location_simulation_full[data_location_simulation_full['location'] != loc]
                 if data_location_simulation_full_migrants.shape[0] > 0:
@@ -70,7 +63,7 @@ def get_migrants(input_path, list_pop_locations_dir):
     return dict_migrants
 
 
-def reassign_internal_migration_to_LAD(location, input_path, pool_migrants):
+def reassign_internal_migration_to_LAD(location, input_path, pool_migrants, output_store=None):
     """ Function that finds all the individuals that internally migrated into a given location
 
     Parameters
@@ -81,19 +74,22 @@ def reassign_internal_migration_to_LAD(location, input_path, pool_migrants):
         Input data path where the outputs of all simulations are found
     pool_migrants: dict of Dataframe
         Dictionary with pool of migrants from each year
+    output_store: OutputStore
+        Store of the reassigned populations (by default, next to the simulated ones and in their format)
 
     """
 
-    input_location_path = os.path.join(input_path, location)
-    # path to the simulation files
-    list_pop_dir = [i for i in os.listdir(input_location_path) if i.startswith('year_')]
+    store = OutputStore(input_path)
+    if output_store is None:
+        output_store = OutputStore(input_path, *output_format_of(store.find(location)))
+    # path to the simulation files (in any output format)
+    list_pop_dir = ['year_' + str(year) for year in store.years(location)]
 
     # for each year run the reassignment
     for year_dir in list_pop_dir:
         print ('Reassign for ', year_dir)
 
-        simulation_data = pd.read_csv(os.path.join(input_location_path, year_dir,
-                                                   'ssm_' + location + '_MSOA11_ppp_2011_simulation_' + year_dir + '.csv'), dtype=columns_dtypes)
+        simulation_data = store.read(location, year_number(year_dir))
 
         simulation_data.loc[:,'duplicate'] = False
         simulation_data.loc[:,'internal_migration_in'] = 'No'
@@ -110,14 +106,10 @@ def reassign_internal_migration_to_LAD(location, input_path, pool_migrants):
 
             simulation_data = pd.concat([simulation_data,data_location_simulation])
 
-        simulation_data.to_csv(os.path.join(input_location_path, year_dir,
-                                            'ssm_' + location + '_MSOA11_ppp_2011_simulation_' + year_dir + '_reassigned.csv'))
+        output_store.write(simulation_data, location, year_number(year_dir), reassigned=True)
 
     # run comparison for the total simmulation
-    final_file = 'ssm_' + location + '_MSOA11_ppp_2011_simulation'
-
-    simulation_data_full = pd.read_csv(os.path.join(input_location_path,
-                                                   'ssm_' + location + '_MSOA11_ppp_2011_simulation.csv'), dtype=columns_dtypes)
+    simulation_data_full = store.read(location)
 
     simulation_data_full.loc[:,'duplicate'] = False
     simulation_data_full.loc[:,'internal_migration_in'] = 'No'
@@ -135,5 +127,9 @@ def reassign_internal_migration_to_LAD(location, input_path, pool_migrants):
 
         simulation_data_full = pd.concat([simulation_data_full, data_location_simulation_full])
 
-    simulation_data_full.to_csv(os.path.join(input_location_path,
-                                        final_file+'_reassigned.csv'))
+    output_store.write(simulation_data_full, location, reassigned=True)
+
+
+def year_number(year_dir):
+    """Simulated year of a year_<n> output directory."""
+    return int(year_dir[len('year_'):])
@@ -10,7 +10,7 @@ from vivarium_population_spenser.population import FertilityAgeSpecificRates
 from vivarium_population_spenser.population import Mortality
 from vivarium_population_spenser.population import Emigration
 from vivarium_population_spenser.population import ImmigrationDeterministic as Immigration
-from vivarium_population_spenser.population import InternalMigration
+from vivarium_population_spenser.population import InternalMigration as SpenserInternalMigration
 
 from daedalus.RateTables.EmigrationRateTable import EmigrationRateTable
 from daedalus.RateTables.MortalityRateTable import MortalityRateTable
@@ -18,9 +18,19 @@ from daedalus.RateTables.FertilityRateTable import FertilityRateTable
 from daedalus.RateTables.ImmigrationRateTable import ImmigrationRateTable
 from daedalus.RateTables.InternalMigrationMatrix import InternalMigrationMatrix
 from daedalus.RateTables.InternalMigrationRateTable import InternalMigrationRateTable
+from daedalus.RateTables.LADIndexedSource import LADIndexedSource
+from daedalus.VphSpenserPipeline.Checkpoints import Checkpoints
+from daedalus.VphSpenserPipeline.EventLog import EventLog, write_events
+from daedalus.VphSpenserPipeline.InternalMigration import InternalMigration
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore
+from daedalus.VphSpenserPipeline.OutputWriter import OutputWriter
+from daedalus.VphSpenserPipeline.PhaseTimer import PhaseTimer, timing_report_path
+from daedalus.VphSpenserPipeline.PopulationArchiver import PopulationArchiver
+from daedalus.VphSpenserPipeline.SetupCache import SetupCache
+from daedalus.VphSpenserPipeline.SimulationProfiler import SimulationProfiler
 
 
-def RunPipeline(config, start_population_size):
+def RunPipeline(config, start_population_size, resume=False, timer=None):
     """ Run the daedalus Microsimulation pipeline
 
    Parameters
@@ -29,12 +39,30 @@ def RunPipeline(config, start_population_size):
         Config file to run the pipeline
     start_population_size: int
         Size of the starting population
+    resume: bool
+        Continue from the latest valid checkpoint of the run, if any
+    timer: PhaseTimer
+        Timer the phases of the pipeline are recorded to. By default a new one, whose report is written to
+        timing_report_<LAD>.json in the output directory of the LAD when the pipeline returns or fails
     Returns:
     --------
      A dataframe with the resulting simulation
     """
 
 
+    # the report is written here unless the caller (eg scripts/run.py) times the whole run
+    report_path = None
+    if timer is None:
+        timer = PhaseTimer(config.location)
+        report_path = timing_report_path(config.output_dir, config.location)
+    try:
+        return _run_pipeline(config, start_population_size, resume, timer)
+    finally:
+        if report_path is not None:
+            timer.write(report_path)
+
+
+def _run_pipeline(config, start_population_size, resume, timer):
     # Set up the components using the config.
 
     config.update({
@@ -45,7 +73,11 @@ def RunPipeline(config, start_population_size):
     num_years = config.time.num_years
 
 
-    components = [eval(x) for x in config.components]
+    # InternalMigration() draws the destinations from the OD matrix bundle, unless the spenser component is asked for
+    namespace = dict(globals())
+    if not use_OD_matrix_bundle(config):
+        namespace['InternalMigration'] = SpenserInternalMigration
+    components = [eval(x, namespace) for x in config.components]
 
     simulation = InteractiveContext(components=components,
                                     configuration=config,
@@ -54,92 +86,227 @@ def RunPipeline(config, start_population_size):
 
     if 'InternalMigration()' in config.components:
         # setup internal migration matrices
-        OD_matrices = InternalMigrationMatrix(configuration=config)
-        OD_matrices.set_matrix_tables()
+        with timer.phase('OD_index'):
+            OD_matrices = InternalMigrationMatrix(configuration=config)
+            OD_matrices.set_matrix_tables()
+            if use_OD_matrix_bundle(config):
+                # the bundle is (re)built from the npz files if needed before the simulation starts
+                OD_matrices.open_destination_models()
+        simulation._data.write("internal_migration.OD_matrices", OD_matrices)
         simulation._data.write("internal_migration.MSOA_index", OD_matrices.MSOA_location_index)
         simulation._data.write("internal_migration.LAD_index", OD_matrices.LAD_location_index)
         simulation._data.write("internal_migration.MSOA_LAD_indices", OD_matrices.df_OD_matrix_with_LAD)
-        simulation._data.write("internal_migration.path_to_OD_matrices", config.path_to_OD_matrices)
+        simulation._data.write("internal_migration.OD_location_index", OD_matrices.OD_location_index)
+        simulation._data.write("internal_migration.path_to_OD_matrices", OD_matrices.path_to_OD_matrices)
 
         # setup internal migraionts rates
-        asfr_int_migration = InternalMigrationRateTable(configuration=config)
-        asfr_int_migration.set_rate_table()
-        simulation._data.write("cause.age_specific_internal_outmigration_rate", asfr_int_migration.rate_table)
+        asfr_int_migration = set_rate_table(InternalMigrationRateTable, config, timer, 'internal_migration')
+        simulation._data.write("cause.age_specific_internal_outmigration_rate", asfr_int_migration.hand_over_rate_table())
 
     if 'Mortality()' in config.components:
         # setup mortality rates
-        asfr_mortality = MortalityRateTable(configuration=config)
-        asfr_mortality.set_rate_table()
+        asfr_mortality = set_rate_table(MortalityRateTable, config, timer, 'mortality')
         simulation._data.write("cause.all_causes.cause_specific_mortality_rate",
-                           asfr_mortality.rate_table)
+                           asfr_mortality.hand_over_rate_table())
 
     if 'FertilityAgeSpecificRates()' in config.components:
         # setup fertility rates
-        asfr_fertility = FertilityRateTable(configuration=config)
-        asfr_fertility.set_rate_table()
+        asfr_fertility = set_rate_table(FertilityRateTable, config, timer, 'fertility')
         simulation._data.write("covariate.age_specific_fertility_rate.estimate",
-                           asfr_fertility.rate_table)
+                           asfr_fertility.hand_over_rate_table())
 
     if 'Emigration()' in config.components:
 
         # setup emigration rates
-        asfr_emigration = EmigrationRateTable(configuration=config)
-        asfr_emigration.set_rate_table()
+        asfr_emigration = set_rate_table(EmigrationRateTable, config, timer, 'emigration')
         simulation._data.write("covariate.age_specific_migration_rate.estimate",
-                           asfr_emigration.rate_table)
+                           asfr_emigration.hand_over_rate_table())
 
     if 'Immigration()' in config.components:
         # setup immigration rates
-        asfr_immigration = ImmigrationRateTable(configuration=config)
-        asfr_immigration.set_rate_table()
-        asfr_immigration.set_total_immigrants()
+        asfr_immigration = set_rate_table(ImmigrationRateTable, config, timer, 'immigration')
+        with timer.phase('total_immigrants'):
+            asfr_immigration.set_total_immigrants()
         simulation._data.write("cause.all_causes.immigration_to_MSOA", pd.read_csv(config.path_to_immigration_MSOA))
         simulation._data.write("cause.all_causes.cause_specific_immigration_rate",
-                           asfr_immigration.rate_table)
+                           asfr_immigration.hand_over_rate_table())
         simulation._data.write("cause.all_causes.cause_specific_total_immigrants_per_year",
                            asfr_immigration.total_immigrants)
 
+    # the national files the rate tables were built from are no longer needed once the tables are in the simulation
+    LADIndexedSource.clear()
+
     print('Start simulation setup')
     print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    simulation.setup()
+    # the lookup tables built from the rate tables are read from the setup cache of previous runs
+    setup_cache = SetupCache.from_config(config)
+    with timer.phase('simulation_setup') as details:
+        if setup_cache is None:
+            simulation.setup()
+        else:
+            with setup_cache.patch():
+                simulation.setup()
+            details.update(setup_cache.stats())
 
-    print('Start running simulation')
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    # time spent in each component at each time step, written to the profile directory of the LAD at the end
+    profiler = None
+    if 'profiling' in config and config.profiling.enabled:
+        profiler = SimulationProfiler(simulation, components).install()
+
+    # checkpoints of the simulation at the end of each year, to resume the run if it is interrupted
+    checkpoints = None
+    if 'checkpoints' in config and config.checkpoints.enabled:
+        checkpoints = Checkpoints(os.path.join(config.output_dir, config.location, 'checkpoints'),
+                                  keep=config.checkpoints.keep,
+                                  compression=config.checkpoints.compression
+                                  if 'compression' in config.checkpoints else None)
+        if not resume:
+            # a new run does not continue from the checkpoints of a previous one
+            checkpoints.clear()
+    elif resume:
+        print('Checkpoints are not enabled, starting the simulation from the beginning')
+
+    # the yearly snapshots are written in the background while the next year is simulated
+    output_store = OutputStore.from_config(config)
+    output_writer = OutputWriter(output_store, timer=timer, **output_writer_options(config))
+    # the simulants that left the simulation are moved out of it to the archive of the LAD
+    archiver = None
+    if 'archive' in config and config.archive.enabled:
+        archiver = PopulationArchiver(output_store, config.location)
+    # the events of each year can be written instead of the snapshots, with the population at the start
+    event_log = None
+    if 'output' in config and config.output.event_log:
+        event_log = EventLog(output_store, config.location,
+                             translate=archiver.with_simulant_ids if archiver is not None else None)
 
-    for year in range(1,num_years+1):
+    try:
+        start_year = 1
+        if resume and checkpoints is not None:
+            checkpoint_year = checkpoints.latest()
+            if checkpoint_year is not None:
+                with timer.phase('checkpoint_restore', year=checkpoint_year):
+                    archiver_state = checkpoints.restore(simulation, checkpoint_year)
+                if archiver is not None and archiver_state is not None:
+                    archiver.restore(archiver_state)
+                start_year = checkpoint_year + 1
+                # the snapshot of the checkpoint year may not have been written before the run was interrupted
+                if not output_store.exists(config.location, checkpoint_year):
+                    output_writer.write(utils.get_age_bucket(get_population(simulation, archiver)), config.location,
+                                        checkpoint_year)
+            else:
+                print('No checkpoint found, starting the simulation from the beginning')
 
-        simulation.run_for(duration=pd.Timedelta(days=365.25))
+        if event_log is not None:
+            if start_year > 1:
+                event_log.resume(simulation._population._population)
+            else:
+                event_log.start(simulation._population._population, simulation._clock._time)
 
-        print('Finished running simulation for year:', year)
+        print('Start running simulation')
         print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        pop = simulation.get_population()
 
-        # assign age brackets to the individuals
+        if start_year > num_years:
+            # the run had already finished
+            pop = utils.get_age_bucket(get_population(simulation, archiver))
 
-        pop = utils.get_age_bucket(pop)
+        for year in range(start_year, num_years+1):
 
-        # save the output file to csv
-        year_output_dir = os.path.join(os.path.join(config.output_dir,config.location,'year_'+str(year)))
-        os.makedirs(year_output_dir, exist_ok=True)
+            with timer.phase('simulate_year', year=year):
+                if event_log is None:
+                    simulation.run_for(duration=pd.Timedelta(days=365.25))
+                else:
+                    event_log.run_for(simulation, duration=pd.Timedelta(days=365.25))
 
-        output_data_filename = 'ssm_' + config.location + '_MSOA11_ppp_2011_simulation_year_'+str(year)+'.csv'
-        pop.to_csv(os.path.join(year_output_dir, output_data_filename))
+            print('Finished running simulation for year:', year)
+            print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            pop = get_population(simulation, archiver)
 
-        print ()
-        print ('In year: ',config.time.start.year + year)
-        # print some summary stats on the simulation
-        print('alive', len(pop[pop['alive'] == 'alive']))
+            # assign age brackets to the individuals
 
-        if 'Mortality()' in config.components:
-            print('dead', len(pop[pop['alive'] == 'dead']))
-        if 'Emigration()' in config.components:
-            print('emigrated', len(pop[pop['alive'] == 'emigrated']))
-        if 'InternalMigration()' in config.components:
-            print('internal migration', len(pop[pop['internal_outmigration'] != '']))
-        if 'FertilityAgeSpecificRates()' in config.components:
-            print('New children', len(pop[pop['parent_id'] != -1]))
-        if 'Immigration()' in config.components:
-            print('Immigrants', len(pop[pop['immigrated'].astype(str) == 'Yes']))
+            pop = utils.get_age_bucket(pop)
 
+            # save the output file (the time the writer takes is recorded as the 'output' phases, this is the time
+            # the simulation waits for it)
+            with timer.phase('output_submit', year=year):
+                if event_log is None:
+                    output_writer.write(pop, config.location, year)
+                else:
+                    output_writer.submit(write_events, output_store, config.location, event_log.end_year(), year,
+                                         simulation._clock._time)
+
+            if archiver is not None and year % config.archive.every_years == 0:
+                with timer.phase('archive', year=year) as details:
+                    details['archived'] = archiver.compact(simulation, year)
+                if event_log is not None:
+                    # the events of the year were taken, the log goes on from the compacted state table
+                    event_log.resume(simulation._population._population)
+
+            if checkpoints is not None:
+                with timer.phase('checkpoint', year=year):
+                    if event_log is not None:
+                        # the events of the year cannot be recovered from the checkpoint, they are written first
+                        output_writer.flush()
+                    checkpoints.save(simulation, year, extra=archiver.state() if archiver is not None else None)
+
+            print ()
+            print ('In year: ',config.time.start.year + year)
+            # print some summary stats on the simulation
+            with timer.phase('summary_statistics', year=year):
+                print('alive', len(pop[pop['alive'] == 'alive']))
+
+                if 'Mortality()' in config.components:
+                    print('dead', len(pop[pop['alive'] == 'dead']))
+                if 'Emigration()' in config.components:
+                    print('emigrated', len(pop[pop['alive'] == 'emigrated']))
+                if 'InternalMigration()' in config.components:
+                    print('internal migration', len(pop[pop['internal_outmigration'] != '']))
+                if 'FertilityAgeSpecificRates()' in config.components:
+                    print('New children', len(pop[pop['parent_id'] != -1]))
+                if 'Immigration()' in config.components:
+                    print('Immigrants', len(pop[pop['immigrated'].astype(str) == 'Yes']))
+    finally:
+        # all the snapshots are on disk when the pipeline returns, or fails
+        with timer.phase('output_close'):
+            output_writer.close()
+        if profiler is not None:
+            profiler.write(os.path.join(config.output_dir, config.location, 'profile'), config.location)
 
     return pop
+
+
+def get_population(simulation, archiver):
+    """Population of a simulation, with the simulants moved to the archive if it is compacted."""
+    if archiver is None:
+        return simulation.get_population()
+    return archiver.get_population(simulation)
+
+
+def set_rate_table(handler_class, config, timer, name):
+    """Build or fetch from the cache the rate table of a handler class, recording the time it takes (hashing the
+    source files for the cache key included) and whether it was cached.
+
+    Returns:
+    -------
+    The handler with its rate table set
+    """
+    with timer.phase('rate_table', table=name) as details:
+        handler = handler_class(configuration=config)
+        details['cached'] = os.path.exists(handler.rate_table_path)
+        handler.set_rate_table()
+    return handler
+
+
+def use_OD_matrix_bundle(config):
+    """Whether the InternalMigration component draws the destinations from the memory-mapped OD matrix bundle (the
+    default), instead of the vivarium_population_spenser component reading the npz files."""
+    if 'internal_migration' not in config or 'use_OD_matrix_bundle' not in config.internal_migration:
+        return True
+    return config.internal_migration.use_OD_matrix_bundle
+
+
+def output_writer_options(config):
+    """Options of the OutputWriter from the `output` section of the config (snapshots written in a background
+    thread by default)."""
+    if 'output' not in config:
+        return {'mode': 'thread', 'max_pending': 1}
+    return {'mode': config.output.writer, 'max_pending': config.output.max_pending}
@@ -0,0 +1,154 @@
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import pandas as pd
+
+from daedalus.RateTables.CacheManifest import CacheManifest
+from daedalus.RateTables.FileLock import FileLock
+
+
+class SetupCacheManifest(CacheManifest):
+    filename = 'setup_cache_manifest.json'
+
+
+class SetupCache:
+    """Interpolations of the lookup tables built during simulation.setup(), kept on disk for the next runs.
+
+    The components turn every rate table written to the simulation data into a lookup table, and vivarium builds
+    and validates one interpolation per location/ethnicity/sex group of the table, in python loops: most of the
+    setup time of a simulation. While `patch` is active, the interpolations are pickled to the cache directory,
+    named after a hash of the structure of their table (every column but the values, its index, the lookup
+    parameters and the vivarium and pandas versions), and read back the next time a table with the same structure
+    is looked up, by any LAD. Only the values are then refreshed, when they differ (eg another scale_rates
+    factor), which takes seconds instead of minutes.
+    """
+
+    def __init__(self, directory, max_entries=None):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory of the cached interpolations
+        max_entries : int
+            Least recently used interpolations are removed once there are more (None to keep all)
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Cache of the `setup_cache` section of the config, in <persistent_data_dir>/setup_cache by default, None
+        when disabled."""
+        if 'setup_cache' not in config or not config.setup_cache.enabled:
+            return None
+        directory = config.setup_cache.directory
+        if directory is None:
+            persistent_data_dir = config.persistent_data_dir if 'persistent_data_dir' in config else 'persistent_data'
+            directory = os.path.join(persistent_data_dir, 'setup_cache')
+        return cls(directory, config.setup_cache.max_entries)
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Build the interpolations of the lookup tables through the cache within a with statement, eg around
+        simulation.setup()."""
+        from vivarium.framework import lookup
+        interpolation = lookup.Interpolation
+        lookup.Interpolation = self.interpolation_factory(interpolation)
+        try:
+            yield self
+        finally:
+            lookup.Interpolation = interpolation
+
+    def interpolation_factory(self, interpolation_class):
+        def cached_interpolation(data, categorical_parameters, continuous_parameters, order, extrapolate):
+            return self.interpolation(interpolation_class, data, categorical_parameters, continuous_parameters,
+                                      order, extrapolate)
+        return cached_interpolation
+
+    def interpolation(self, interpolation_class, data, categorical_parameters, continuous_parameters, order,
+                      extrapolate):
+        """Interpolation of a table, read from the cache or built and cached."""
+        if not data.index.is_unique:
+            # the values of the cached sub-tables are refreshed by index
+            return interpolation_class(data, categorical_parameters, continuous_parameters, order=order,
+                                       extrapolate=extrapolate)
+        key, values_key = interpolation_keys(data, categorical_parameters, continuous_parameters, order, extrapolate)
+        filename = 'interpolation_{}.pkl'.format(key)
+        path = os.path.join(self.directory, filename)
+        os.makedirs(self.directory, exist_ok=True)
+        # only one process builds a missing interpolation, the others wait for it and then read it
+        with FileLock(path + '.lock'):
+            if os.path.exists(path):
+                with open(path, 'rb') as cache_file:
+                    cached = pickle.load(cache_file)
+                interpolation = cached['interpolation']
+                if cached['values_key'] != values_key:
+                    set_values(interpolation, data)
+                else:
+                    interpolation.data = data.copy()
+                self.hits += 1
+                print('Fetched interpolation of {} from the setup cache {}'.format(list(categorical_parameters), path))
+            else:
+                interpolation = interpolation_class(data, categorical_parameters, continuous_parameters, order=order,
+                                                    extrapolate=extrapolate)
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as cache_file:
+                    pickle.dump({'values_key': values_key, 'interpolation': interpolation}, cache_file,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+                self.misses += 1
+                print('Cached interpolation of {} to {}'.format(list(categorical_parameters), path))
+
+        manifest = SetupCacheManifest(self.directory)
+        manifest.record(filename, 'interpolation', key)
+        if self.max_entries is not None:
+            manifest.clean(self.max_entries)
+        return interpolation
+
+    def stats(self):
+        return {'setup_cache_hits': self.hits, 'setup_cache_misses': self.misses}
+
+
+def interpolation_keys(data, categorical_parameters, continuous_parameters, order, extrapolate):
+    """Hash of the structure of the table of an interpolation and hash of its values."""
+    value_columns = value_columns_of(data, categorical_parameters, continuous_parameters)
+    description = {'columns': [str(column) for column in data.columns],
+                   'dtypes': [str(dtype) for dtype in data.dtypes],
+                   'categorical_parameters': list(categorical_parameters),
+                   'continuous_parameters': [list(parameter) for parameter in continuous_parameters],
+                   'order': order, 'extrapolate': extrapolate, 'code': interpolation_code_version()}
+    structure = hashlib.sha1(json.dumps(description, sort_keys=True).encode())
+    structure.update(pd.util.hash_pandas_object(data.drop(columns=value_columns), index=True).values.tobytes())
+    values = hashlib.sha1(pd.util.hash_pandas_object(data[value_columns], index=False).values.tobytes())
+    return structure.hexdigest()[:16], values.hexdigest()
+
+
+def set_values(interpolation, data):
+    """Replace the values of a cached interpolation by the values of a table with the same structure."""
+    interpolation.data = data.copy()
+    value_columns = list(interpolation.value_columns)
+    for sub_interpolation in interpolation.interpolations.values():
+        sub_interpolation.data[value_columns] = data.loc[sub_interpolation.data.index, value_columns].values
+
+
+def value_columns_of(data, categorical_parameters, continuous_parameters):
+    """Columns interpolated by vivarium: neither categorical nor continuous parameters (nor bin edges)."""
+    parameter_columns = set(categorical_parameters) | {column for parameter in continuous_parameters
+                                                       for column in parameter}
+    return [column for column in data.columns if column not in parameter_columns]
+
+
+def interpolation_code_version():
+    """Versions of vivarium and pandas and hash of the source of the vivarium interpolation module, pickled
+    interpolations are only reused with the same ones."""
+    import vivarium
+    from vivarium import interpolation
+    with open(inspect.getsourcefile(interpolation), 'rb') as source_file:
+        source = hashlib.sha1(source_file.read()).hexdigest()
+    return '{} {} {}'.format(getattr(vivarium, '__version__', ''), pd.__version__, source)
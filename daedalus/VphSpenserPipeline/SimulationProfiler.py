@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+import pandas as pd
+
+
+class SimulationProfiler:
+    """Time spent in each component of a simulation at each time step.
+
+    The time step listeners (of every main loop event: time_step__prepare, time_step, time_step__cleanup and
+    collect_metrics) and the value pipeline sources and modifiers of the given components, and of their
+    sub-components, are wrapped once the simulation is set up. Each call records its wall time, the number of
+    simulants it is called for, the number of rows its component writes to the state table (population view
+    updates) and the number of simulants it adds. The calls are summed by time step, component and hook in
+    to_frame, and kept one by one for the Chrome trace timeline (chrome://tracing or https://ui.perfetto.dev) of
+    write. Times are inclusive: a pipeline evaluated by a listener counts in both.
+    """
+
+    def __init__(self, simulation, components):
+        """
+        Parameters
+        ----------
+        simulation : InteractiveContext
+            Simulation, set up
+        components : list
+            Components to profile, eg the ones built from config.components
+        """
+        self.simulation = simulation
+        self._owners = {}
+        self._components = []
+        for component in components:
+            self._add_owner(component, component_name(component))
+        # (time step, component, kind, hook) -> calls, seconds, simulants, updated, created
+        self._records = defaultdict(lambda: [0, 0., 0, 0, 0])
+        self._trace = []
+        self._updated = 0
+        self._restore = []
+        self._start = time.perf_counter()
+
+    def _add_owner(self, component, name):
+        self._owners[id(component)] = name
+        self._components.append(component)
+        for sub_component in getattr(component, 'sub_components', []):
+            self._add_owner(sub_component, name)
+
+    def _owner(self, function):
+        return self._owners.get(id(getattr(function, '__self__', None)))
+
+    def install(self):
+        """Wrap the listeners, pipelines and population views of the profiled components."""
+        for event in self.simulation.time_step_events:
+            for bucket in self.simulation._events.get_channel(event).listeners:
+                for i, listener in enumerate(bucket):
+                    owner = self._owner(listener)
+                    if owner is not None:
+                        bucket[i] = self._wrap(listener, owner, 'listener',
+                                               '{}.{}'.format(event, listener.__name__))
+                        self._restore.append((bucket.__setitem__, i, listener))
+
+        for name, pipeline in self.simulation._values.items():
+            owner = self._owner(pipeline.source)
+            if owner is not None:
+                self._restore.append((setattr, pipeline, 'source', pipeline.source))
+                pipeline.source = self._wrap(pipeline.source, owner, 'pipeline_source', name)
+            for i, mutator in enumerate(pipeline.mutators):
+                owner = self._owner(mutator)
+                if owner is not None:
+                    pipeline.mutators[i] = self._wrap(mutator, owner, 'pipeline_modifier', name)
+                    self._restore.append((pipeline.mutators.__setitem__, i, mutator))
+
+        views = {id(view): view for component in self._components for view in vars(component).values()
+                 if hasattr(view, 'update') and hasattr(view, 'subview')}
+        for view in views.values():
+            view.update = self._count_updates(view.update)
+            self._restore.append((delattr, view, 'update'))
+        return self
+
+    def uninstall(self):
+        """Restore the original listeners, pipelines and population views."""
+        for restore, *args in reversed(self._restore):
+            restore(*args)
+        self._restore = []
+
+    def _wrap(self, function, component, kind, hook):
+        def profiled(*args, **kwargs):
+            population = self.simulation._population._population
+            size = len(population) if population is not None else 0
+            updated = self._updated
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                population = self.simulation._population._population
+                self._record(component, kind, hook, start, end, simulants_of(args),
+                             self._updated - updated, (len(population) if population is not None else 0) - size)
+        return profiled
+
+    def _count_updates(self, update):
+        def profiled_update(population_update):
+            self._updated += len(population_update)
+            return update(population_update)
+        return profiled_update
+
+    def _record(self, component, kind, hook, start, end, simulants, updated, created):
+        step = self.simulation._clock._time
+        record = self._records[(step, component, kind, hook)]
+        record[0] += 1
+        record[1] += end - start
+        record[2] += simulants
+        record[3] += updated
+        record[4] += created
+        self._trace.append((component, kind, hook, start, end, step, simulants, updated, created))
+
+    def to_frame(self):
+        """Calls, time and simulants of each hook of each component at each time step (the time of the clock
+        when it starts)."""
+        rows = [(step, component, kind, hook, *record) for (step, component, kind, hook), record in
+                self._records.items()]
+        frame = pd.DataFrame(rows, columns=['time', 'component', 'kind', 'hook', 'calls', 'seconds', 'simulants',
+                                            'updated', 'created'])
+        frame.insert(0, 'step', frame['time'].rank(method='dense').astype(int) if len(frame) else 0)
+        return frame
+
+    def summary(self):
+        """Totals of to_frame over all the time steps, by component, sorted by time."""
+        frame = self.to_frame()
+        summary = frame.groupby('component').agg(calls=('calls', 'sum'), seconds=('seconds', 'sum'),
+                                                  simulants=('simulants', 'sum'), updated=('updated', 'sum'),
+                                                  created=('created', 'sum'), steps=('step', 'nunique'))
+        summary['seconds_per_step'] = summary['seconds'] / summary['steps']
+        return summary.sort_values('seconds', ascending=False)
+
+    def trace(self, process_name=None):
+        """Chrome trace timeline of all the calls."""
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                   'args': {'name': process_name or 'simulation'}}]
+        for component, kind, hook, start, end, step, simulants, updated, created in self._trace:
+            events.append({'name': '{} {}'.format(component, hook), 'cat': kind, 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': round((start - self._start) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+                           'args': {'component': component, 'time_step': str(step), 'simulants': simulants,
+                                    'updated': updated, 'created': created}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, directory, process_name=None):
+        """Write profile.csv (to_frame), profile.json (summary and time steps) and trace.json (Chrome trace) to a
+        directory.
+
+        Returns:
+        -------
+        The paths of the three files
+        """
+        os.makedirs(directory, exist_ok=True)
+        frame = self.to_frame()
+        paths = [os.path.join(directory, name) for name in ['profile.csv', 'profile.json', 'trace.json']]
+        frame.to_csv(paths[0], index=False)
+        profile = {'summary': self.summary().reset_index().to_dict(orient='records'),
+                   'steps': frame.assign(time=frame['time'].astype(str)).to_dict(orient='records')}
+        for path, content in zip(paths[1:], [profile, self.trace(process_name)]):
+            with open(path, 'w') as profile_file:
+                json.dump(content, profile_file, default=str)
+        print('Profile written to {}'.format(directory))
+        return paths
+
+
+def component_name(component):
+    return getattr(component, 'name', type(component).__name__)
+
+
+def simulants_of(args):
+    """Number of simulants a listener (called with an event) or a pipeline (called with an index) is called for."""
+    if not args:
+        return 0
+    index = getattr(args[0], 'index', args[0])
+    return len(index) if isinstance(index, pd.Index) else 0
@@ -4,10 +4,12 @@ utility functions
 
 import argparse
 import glob
+import multiprocessing
 import yaml
 import numpy as np
 import os
 import pandas as pd
+import time
 #import humanleague as hl
 from scipy.sparse import coo_matrix
 import scipy
@@ -279,33 +281,70 @@ def prepare_dataset(dataset_path="../daedalus/persistent_data/ssm_E08000032_MSOA
     print(f"\nWrite the dataset at: {output_path}")
 
 
-def make_od_matrices_sparse(path2csv, row_threshold=10):
+def make_od_matrices_sparse(path2csv, row_threshold=10, output_dir=".", process_np=1, chunksize=500):
     """Make OD matrices sparse
 
+    The dense CSV files are read by chunks of rows and processed in parallel, so that a national 7201x7201 matrix
+    never has to be held in memory as a whole.
+
     Args:
         path2csv: path to csv files, wildcards are accepted
         row_threshold (int, optional): all values less than row_max / row_threshold will be set to zero. Defaults to 10.
+        output_dir (str, optional): directory where the npz files are written. Defaults to the current directory.
+        process_np (int, optional): number of files processed in parallel. Defaults to 1.
+        chunksize (int, optional): number of rows read at once from each file. Defaults to 500.
+
+    Returns:
+        A list with the npz file written, its number of non zero values and the time it took in seconds, for each file.
     """
 
     list_of_files = glob.glob(path2csv)
+    os.makedirs(output_dir, exist_ok=True)
+
+    arguments = [(os.path.abspath(fi_rel), row_threshold, output_dir, chunksize) for fi_rel in list_of_files]
+    if process_np > 1 and len(arguments) > 1:
+        with multiprocessing.Pool(min(process_np, len(arguments))) as pool:
+            report = pool.starmap(make_od_matrix_sparse, arguments)
+    else:
+        report = [make_od_matrix_sparse(*one_file) for one_file in arguments]
+
+    for output_file, nnz, seconds in report:
+        print(f"{output_file}: {nnz} non zero values in {seconds:.2f}s")
+    return report
+
+
+def make_od_matrix_sparse(fi, row_threshold, output_dir, chunksize):
+    """Make one OD matrix sparse, see make_od_matrices_sparse
+
+    Returns:
+        The npz file written, its number of non zero values and the time it took in seconds.
+    """
+    print(f"Processing: {fi}")
+    start_time = time.time()
+
+    rows, cols, values = [], [], []
+    n_rows = n_cols = 0
+    for chunk in pd.read_csv(fi, chunksize=chunksize):
+        od_val_w = chunk.values[:, 1:].astype(float)
+        n_cols = od_val_w.shape[1]
 
-    for i, fi_rel in enumerate(list_of_files):
-        fi = os.path.abspath(fi_rel)
-        print(f"Processing: {fi}")
-        
-        od_weights = pd.read_csv(fi).values
-        od_val_w = od_weights[:, 1:]
-        od_val_w = od_val_w.astype(np.float)
-        
         # weights ---> probability distributions for each row
-        od_val_w = od_val_w/np.sum(od_val_w, axis=1)[:, None]
-    
-        for j in range(od_val_w.shape[0]):
-            row_threshold_adjust = np.max(od_val_w[j, :]) / row_threshold
-            od_val_w[j, od_val_w[j, :] < row_threshold_adjust] = 0
-        
-        od_val_sparse = coo_matrix(od_val_w)
-        scipy.sparse.save_npz(os.path.basename(fi).split(".csv")[0] + ".npz", od_val_sparse)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            od_val_w = od_val_w / np.sum(od_val_w, axis=1)[:, None]
+            # values below the threshold of their row are dropped (nan rows of empty weights are kept as they are)
+            keep = ~(od_val_w < np.max(od_val_w, axis=1)[:, None] / row_threshold) & (od_val_w != 0)
+
+        chunk_rows, chunk_cols = np.nonzero(keep)
+        rows.append(chunk_rows + n_rows)
+        cols.append(chunk_cols)
+        values.append(od_val_w[chunk_rows, chunk_cols])
+        n_rows += len(od_val_w)
+
+    od_val_sparse = coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(n_rows, n_cols))
+    output_file = os.path.join(output_dir, os.path.basename(fi).split(".csv")[0] + ".npz")
+    scipy.sparse.save_npz(output_file, od_val_sparse)
+    return output_file, od_val_sparse.nnz, time.time() - start_time
 
 
 def get_age_bucket(simulation_data):
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""calibrate_gravity_model: Fit the gravity model of internal migration destinations to the OD matrices
+
+A model is fitted for every number of neighbours given, and saved next to the OD matrices. The printed report
+compares their memory and their distance to the OD matrices, to choose one as `internal_migration.gravity_model`.
+
+# example:
+python scripts/calibrate_gravity_model.py -c config/default_config.yaml --persistent_data_dir persistent_data --n_neighbours 20 50 100 200
+"""
+
+import argparse
+import os
+import time
+
+import pandas as pd
+import scipy.sparse
+
+from daedalus.RateTables.GravityODModel import GravityODModel
+from daedalus.RateTables.ODLocationIndex import ODLocationIndex
+from daedalus.RateTables.ODMatrixBundle import ODMatrixBundle
+from prebuild_rate_tables import get_configuration
+
+
+def calibrate_gravity_model(configuration_file, persistent_data_dir, n_neighbours_list, min_distance=1000.0,
+                            sample_origins=1000, output_dir=None):
+    """Fit and save a gravity model for each number of neighbours
+
+    Args:
+        configuration_file: the model config file (YAML)
+        persistent_data_dir: directory where the persistent data is
+        n_neighbours_list (list): numbers of nearest MSOAs reachable from an origin to try
+        min_distance (float, optional): distances are floored to this value in metres. Defaults to 1000.
+        sample_origins (int, optional): number of origins used to fit the exponents. Defaults to 1000.
+        output_dir (str, optional): where to save the models. Defaults to the OD matrix directory.
+
+    Returns:
+        A dataframe with the fit of every matrix and number of neighbours, with the model file and memory.
+    """
+    config = get_configuration(configuration_file, persistent_data_dir)
+    output_dir = output_dir or config.path_to_OD_matrices
+
+    od_location_index = ODLocationIndex.load_or_build(config.path_msoa_to_lad, config.path_to_OD_matrix_index_file,
+                                                      persistent_data_dir)
+    coordinates = GravityODModel.read_centroids(config.path_to_MSOA_centroids, od_location_index)
+    od_matrices = {ODMatrixBundle.matrix_name(source): scipy.sparse.load_npz(source)
+                   for source in ODMatrixBundle.source_files(config.path_to_OD_matrices)}
+
+    reports = []
+    for n_neighbours in n_neighbours_list:
+        start_time = time.time()
+        model, report = GravityODModel.calibrate(od_matrices, coordinates, n_neighbours, min_distance, sample_origins)
+        model_file = os.path.join(output_dir, 'gravity_model_{}.npz'.format(n_neighbours))
+        model.save(model_file)
+        reports.append(report.assign(model_file=model_file, nbytes=model.nbytes,
+                                     seconds=time.time() - start_time))
+    return pd.concat(reports, ignore_index=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fit the gravity model of internal migration to the OD matrices")
+
+    parser.add_argument("-c", "--config", required=True, type=str, metavar="config-file",
+                        help="the model config file (YAML)")
+    parser.add_argument('--persistent_data_dir', help='directory where the persistent data is', required=True)
+    parser.add_argument('--n_neighbours', type=int, nargs='+', help='numbers of neighbours to try',
+                        default=[20, 50, 100, 200])
+    parser.add_argument('--min_distance', type=float, help='distances are floored to this value in metres',
+                        default=1000.0)
+    parser.add_argument('--sample_origins', type=int, help='number of origins used to fit the exponents',
+                        default=1000)
+    parser.add_argument('--output_dir', help='where to save the models (default: the OD matrix directory)',
+                        default=None)
+
+    args = parser.parse_args()
+
+    report = calibrate_gravity_model(args.config, args.persistent_data_dir, args.n_neighbours, args.min_distance,
+                                     args.sample_origins, args.output_dir)
+
+    print('\n\n================================')
+    summary = report.groupby(['model_file', 'n_neighbours'], sort=False).agg(
+        exponent=('exponent', 'mean'),
+        total_variation_distance=('total_variation_distance', 'mean'),
+        neighbour_mass_share=('neighbour_mass_share', 'mean'),
+        nbytes=('nbytes', 'first'))
+    print(summary.to_string())
+    print('================================')
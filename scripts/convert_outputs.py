@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""convert_outputs: Convert the population files of finished simulations to another output format
+
+Every yearly, final and reassigned population file found under the output directory is rewritten in the requested
+format (eg CSV outputs of previous runs to Parquet). Readers of the simulation outputs accept any of the formats.
+
+# example (all LADs of the output directory, to Parquet with zstd compression, removing the CSV files):
+python scripts/convert_outputs.py --output_dir output --format parquet --compression zstd --remove_source
+"""
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore, read_output
+
+
+def convert_outputs(output_dir, output_format, compression=None, locations=None, remove_source=False):
+    """Rewrite the population files of some LADs in an output format
+
+    Args:
+        output_dir: directory of the outputs of all the simulated LADs
+        output_format: 'csv', 'parquet' or 'feather'
+        compression (str, optional): compression of the converted files. Defaults to uncompressed.
+        locations (list, optional): LADs to convert. Defaults to all the LADs of the output directory.
+        remove_source (bool, optional): remove the original files once converted. Defaults to False.
+
+    Returns:
+        A dataframe with the size of each file before and after conversion and the time spent on it.
+    """
+    target = OutputStore(output_dir, output_format, compression)
+    report = []
+    for location in locations or target.locations():
+        for year in [None] + target.years(location):
+            for reassigned in [False, True]:
+                source_path = target.find(location, year, reassigned)
+                target_path = target.path(location, year, reassigned)
+                if source_path is None or source_path == target_path:
+                    continue
+                start_time = time.time()
+                target.write(read_output(source_path), location, year, reassigned)
+                report.append({'location': location, 'year': year, 'reassigned': reassigned,
+                               'source': source_path, 'source_bytes': os.path.getsize(source_path),
+                               'target': target_path, 'target_bytes': os.path.getsize(target_path),
+                               'seconds': time.time() - start_time})
+                print('Converted {} to {}'.format(source_path, target_path))
+                if remove_source:
+                    os.remove(source_path)
+    return pd.DataFrame(report)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert the population files of simulations to another format")
+
+    parser.add_argument('--output_dir', help='directory where the outputs of the simulations are', required=True)
+    parser.add_argument('--format', help="output format: 'csv', 'parquet' or 'feather'", default='parquet')
+    parser.add_argument('--compression', help='compression of the converted files (default: uncompressed)',
+                        default=None)
+    parser.add_argument('--location', nargs='+', help='LAD codes to convert (default: all)', default=None)
+    parser.add_argument('--remove_source', action='store_true', help='remove the original files once converted')
+
+    args = parser.parse_args()
+
+    report = convert_outputs(args.output_dir, args.format, args.compression, args.location, args.remove_source)
+
+    print('\n\n================================')
+    if len(report):
+        print(report[['target', 'source_bytes', 'target_bytes', 'seconds']].to_string(index=False))
+        print('Total: {:.1f} MB -> {:.1f} MB'.format(report['source_bytes'].sum() / 1e6,
+                                                     report['target_bytes'].sum() / 1e6))
+    else:
+        print('Nothing to convert')
+    print('================================')
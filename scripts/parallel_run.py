@@ -6,6 +6,9 @@ python scripts/parallel_run.py -c config/default_config.yaml --path_pop_files "d
 
 # example (run over all LADs):
 python scripts/parallel_run.py -c config/default_config.yaml --path_pop_files "data/ssm_*ppp*csv" --input_data_dir data --persistent_data_dir persistent_data --output_dir output --process_np 8
+
+# example (continue an interrupted run over all LADs from the checkpoints of each LAD):
+python scripts/parallel_run.py -c config/default_config.yaml --path_pop_files "data/ssm_*ppp*csv" --input_data_dir data --persistent_data_dir persistent_data --output_dir output --process_np 8 --resume
 """
 __author__ = "Kasra Hosseini (khosseini@turing.ac.uk)"
 
@@ -19,6 +22,7 @@ import multiprocessing
 import os
 import time
 
+from daedalus.VphSpenserPipeline.PhaseTimer import merge_reports, timing_report_path
 from run import run_pipeline
 
 # ----------------------
@@ -26,7 +30,8 @@ def run_pipeline_location_list(configuration_file,
                                location_list=None, 
                                input_data_dir=None, 
                                persistent_data_dir=None, 
-                               output_dir=None):
+                               output_dir=None,
+                               resume=False):
     """Run `run.py` for a list of locations."""
 
     for one_location in location_list:
@@ -36,7 +41,8 @@ def run_pipeline_location_list(configuration_file,
                         one_location, 
                         input_data_dir, 
                         persistent_data_dir, 
-                        output_dir)
+                        output_dir,
+                        resume)
         except Exception as err:
             fio = open(os.path.join(output_dir, "error_log.txt"), "a+")
             fio.writelines(err + "\n")
@@ -97,7 +103,8 @@ def run_parallel(target_func, location_list, start, end, process_np=8, **kwds):
                                           location_list_one_node, 
                                           kwds["input_data_dir"], 
                                           kwds["persistent_data_dir"], 
-                                          kwds["output_dir"]))
+                                          kwds["output_dir"],
+                                          kwds.get("resume", False)))
         #print(location_list_one_node)
         jobs.append(p)
     for i in range(len(jobs)):
@@ -106,6 +113,28 @@ def run_parallel(target_func, location_list, start, end, process_np=8, **kwds):
     check_par_jobs(jobs)
 
 
+# ----------------------
+def merge_timing_reports(output_dir, location_list):
+    """Merge the timing reports of the simulated locations into timing_report.csv (every phase of every location)
+    and timing_summary.csv (totals by phase type) in the output directory.
+
+    Returns:
+        The summary dataframe, None if no location has a report.
+    """
+    paths = [timing_report_path(output_dir, location) for location in location_list]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None
+    phases, summary = merge_reports(paths)
+    phases.to_csv(os.path.join(output_dir, "timing_report.csv"), index=False)
+    summary.to_csv(os.path.join(output_dir, "timing_summary.csv"))
+    print('\n\n================================')
+    print('Timing of {} locations:'.format(len(paths)))
+    print(summary.to_string())
+    print('================================')
+    return summary
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Run Dynamic Microsimulation in parallel")
@@ -119,6 +148,8 @@ if __name__ == "__main__":
     parser.add_argument('--persistent_data_dir', help='directory where the persistent data is', default=None)
     parser.add_argument('--output_dir', type=str, help='directory where the output data is saved', default=None)
     parser.add_argument('--process_np', type=int, help='number of processors to be used', default=8)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue each location from the latest checkpoint of a previous run')
 
     args = parser.parse_args()
 
@@ -137,4 +168,8 @@ if __name__ == "__main__":
                  configuration_file=args.config,
                  input_data_dir=args.input_data_dir,
                  persistent_data_dir=args.persistent_data_dir,
-                 output_dir=args.output_dir)
+                 output_dir=args.output_dir,
+                 resume=args.resume)
+
+    pop_end_index = args.pop_end_index if args.pop_end_index >= 0 else len(list_all_LADs)
+    merge_timing_reports(args.output_dir, list_all_LADs[args.pop_start_index:pop_end_index])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""prebuild_rate_tables: Build and cache all the rate tables before running any simulation
+
+Rate tables are otherwise built lazily by the first simulation needing them. This builds the shared mortality,
+fertility, emigration and internal migration tables and the immigration table of every LAD (or of the given LADs).
+
+# example (all LADs found in the immigration file, 8 processes for the immigration tables):
+python scripts/prebuild_rate_tables.py -c config/default_config.yaml --persistent_data_dir persistent_data --process_np 8
+
+# example (only the LADs of the population files):
+python scripts/prebuild_rate_tables.py -c config/default_config.yaml --persistent_data_dir persistent_data --path_pop_files "data/ssm_*ppp*csv"
+"""
+
+import argparse
+from glob import glob
+import multiprocessing
+import os
+from os.path import exists
+from pathlib import Path
+import time
+
+import daedalus.utils as utils
+from daedalus.RateTables.EmigrationRateTable import EmigrationRateTable
+from daedalus.RateTables.FertilityRateTable import FertilityRateTable
+from daedalus.RateTables.ImmigrationRateTable import ImmigrationRateTable
+from daedalus.RateTables.InternalMigrationRateTable import InternalMigrationRateTable
+from daedalus.RateTables.LADIndexedSource import LADIndexedSource, get_rates_location
+from daedalus.RateTables.MortalityRateTable import MortalityRateTable
+from run import set_persistent_data_paths
+
+
+def get_configuration(configuration_file, persistent_data_dir):
+    config = utils.get_config(configuration_file)
+    set_persistent_data_paths(config, persistent_data_dir)
+    return config
+
+
+def build_rate_table(handler):
+    """Build (or fetch from the cache) the rate table of a handler.
+
+    Returns:
+    -------
+    The name of the cached file, the time it took in seconds, whether it was already cached and its memory footprint
+    in bytes once loaded.
+    """
+    start_time = time.time()
+    cached = exists(handler.rate_table_path)
+    handler.set_rate_table()
+    return handler.filename, time.time() - start_time, cached, handler.memory_footprint()
+
+
+def build_immigration_rate_tables(configuration_file, persistent_data_dir, location_list):
+    """Build the immigration rate table of a list of LADs, the national files are parsed once for all of them."""
+    config = get_configuration(configuration_file, persistent_data_dir)
+    report = []
+    for location in location_list:
+        config.update({'location': location}, source=str(Path(__file__).resolve()))
+        report.append(build_rate_table(ImmigrationRateTable(configuration=config)))
+    LADIndexedSource.clear()
+    return report
+
+
+def prebuild_rate_tables(configuration_file, persistent_data_dir, location_list=None, process_np=1):
+    """Build and cache the shared rate tables and the immigration rate table of every LAD
+
+    Args:
+        configuration_file: the model config file (YAML)
+        persistent_data_dir: directory where the persistent data is
+        location_list (list, optional): LADs to build immigration tables for. Defaults to all LADs in the
+            immigration file.
+        process_np (int, optional): Number of processes used to build the immigration tables. Defaults to 1.
+
+    Returns:
+        A list with the cached file, build time in seconds, whether it was already cached and the memory footprint in
+        bytes, for each table.
+    """
+    config = get_configuration(configuration_file, persistent_data_dir)
+
+    report = []
+    for handler_class in [MortalityRateTable, FertilityRateTable, EmigrationRateTable, InternalMigrationRateTable]:
+        report.append(build_rate_table(handler_class(configuration=config)))
+
+    if location_list is None:
+        location_list = LADIndexedSource.load(config.path_to_immigration_file, 'LAD.code', 'ETH.group').lads()
+        LADIndexedSource.clear()
+    # LADs sharing the same (joined) rates are built once
+    location_list = sorted(set(get_rates_location(location) for location in location_list))
+
+    process_np = max(1, min(process_np, len(location_list)))
+    chunks = [location_list[i::process_np] for i in range(process_np)]
+    if process_np == 1:
+        reports = [build_immigration_rate_tables(configuration_file, persistent_data_dir, chunks[0])]
+    else:
+        with multiprocessing.Pool(process_np) as pool:
+            reports = pool.starmap(build_immigration_rate_tables,
+                                   [(configuration_file, persistent_data_dir, chunk) for chunk in chunks])
+    for chunk_report in reports:
+        report.extend(chunk_report)
+
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build and cache the rate tables before running simulations")
+
+    parser.add_argument("-c", "--config", required=True, type=str, metavar="config-file",
+                        help="the model config file (YAML)")
+    parser.add_argument('--persistent_data_dir', help='directory where the persistent data is', required=True)
+    parser.add_argument('--location', nargs='*', help='LAD codes to build immigration tables for', default=None)
+    parser.add_argument('--path_pop_files', help='build immigration tables for the LADs of these population files, '
+                                                 'wildcard accepted', default=None)
+    parser.add_argument('--process_np', type=int, help='number of processors to be used', default=1)
+
+    args = parser.parse_args()
+
+    location_list = args.location
+    if args.path_pop_files:
+        location_list = (location_list or []) + [os.path.basename(one_file).split("_")[1]
+                                                 for one_file in glob(args.path_pop_files)]
+
+    start_time = time.time()
+    report = prebuild_rate_tables(args.config, args.persistent_data_dir, location_list, args.process_np)
+
+    print('\n\n================================')
+    for filename, seconds, cached, nbytes in report:
+        print('{:<60} {:>8.2f}s {:<6} {:>8.1f} MB'.format(filename, seconds, 'cached' if cached else 'built',
+                                                         nbytes / 2 ** 20))
+    print('{} rate tables ready in {:.2f}s, {:.1f} MB in memory'.format(len(report), time.time() - start_time,
+                                                                       sum(row[3] for row in report) / 2 ** 20))
+    print('================================')
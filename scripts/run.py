@@ -7,10 +7,13 @@ import datetime
 import daedalus.utils as utils
 import argparse
 import yaml
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore
+from daedalus.VphSpenserPipeline.PhaseTimer import PhaseTimer, timing_report_path
 from daedalus.VphSpenserPipeline.RunPipeline import RunPipeline
 
 
-def run_pipeline(configuration_file, location=None, input_data_dir=None, persistent_data_dir=None, output_dir=None):
+def run_pipeline(configuration_file, location=None, input_data_dir=None, persistent_data_dir=None, output_dir=None,
+                 resume=False):
     """
     Given an basic input config file and data directory information configure the
      vivarium public health spenser pipeline and run it.
@@ -27,6 +30,8 @@ def run_pipeline(configuration_file, location=None, input_data_dir=None, persist
         Path to the directory where the rate/probability/demographic files that needed to run the simulation are found.
     output_dir: str
         Path to the directory where the output data should be saved
+    resume: bool
+        Continue the simulation from the latest valid checkpoint of a previous run of this location
     """
 
     config = utils.get_config(configuration_file)
@@ -103,6 +108,59 @@ def run_pipeline(configuration_file, location=None, input_data_dir=None, persist
 
         'path_to_raw_pop_file': "{}/{}".format(input_data_dir, input_data_raw_filename),
         'path_to_pop_file': "{}/{}".format(run_output_dir, input_data_processed_filename),
+
+    }, source=str(Path(__file__).resolve()))
+    set_persistent_data_paths(config, persistent_data_dir)
+
+    # wall time, CPU time and peak memory of each phase of the run, written next to the outputs
+    timer = PhaseTimer(location)
+    try:
+        # process the raw input data into a VPH format with the right variables
+        with timer.phase('dataset_preparation'):
+            utils.prepare_dataset(config.path_to_raw_pop_file, config.path_to_pop_file,
+                                  location_code=location,
+                                  lookup_ethnicity=config.path_to_ethnic_lookup,
+                                  loopup_location_code=config.path_msoa_to_lad)
+
+        # run the pipeline
+        pop = RunPipeline(config, start_population_size, resume=resume, timer=timer)
+
+        print('Finished running the full simulation')
+        # save the output file
+        with timer.phase('output', final=True) as details:
+            details['path'] = OutputStore.from_config(config).write(pop, location)
+
+        # print some summary stats on the simulation
+        with timer.phase('summary_statistics', final=True):
+            print('alive', len(pop[pop['alive'] == 'alive']))
+
+            if 'Mortality()' in config.components:
+                print('dead', len(pop[pop['alive'] == 'dead']))
+            if 'Emigration()' in config.components:
+                print('emigrated', len(pop[pop['alive'] == 'emigrated']))
+            if 'InternalMigration()' in config.components:
+                print('internal migration', len(pop[pop['internal_outmigration'] != '']))
+            if 'FertilityAgeSpecificRates()' in config.components:
+                print('New children', len(pop[pop['parent_id'] != -1]))
+            if 'Immigration()' in config.components:
+                print('Immigrants', len(pop[pop['immigrated'].astype(str) == 'Yes']))
+    finally:
+        timer.write(timing_report_path(output_dir, location))
+
+
+def set_persistent_data_paths(config, persistent_data_dir):
+    """
+    Add the paths to the rate, lookup and OD matrix files found in the persistent data directory to the config.
+
+    Parameters
+    ----------
+    config : ConfigTree
+        Config file to run the pipeline
+    persistent_data_dir: str
+        Path to the directory where the rate/probability/demographic files that needed to run the simulation are found.
+    """
+    config.update({
+
         'path_to_mortality_file': "{}/{}".format(persistent_data_dir, config.mortality_file),
         'path_to_fertility_file': "{}/{}".format(persistent_data_dir, config.fertility_file),
         'path_to_emigration_file': "{}/{}".format(persistent_data_dir, config.emigration_file),
@@ -112,40 +170,16 @@ def run_pipeline(configuration_file, location=None, input_data_dir=None, persist
         'path_to_OD_matrices': "{}/{}".format(persistent_data_dir, config.OD_matrix_dir),
         'path_to_OD_matrix_index_file': "{}/{}/{}".format(persistent_data_dir, config.OD_matrix_dir,
                                                           config.OD_matrix_index_file),
+        'path_to_OD_matrix_bundle': "{}/{}/{}".format(persistent_data_dir, config.OD_matrix_dir,
+                                                      config.OD_matrix_bundle),
         'path_to_internal_outmigration_file': "{}/{}".format(persistent_data_dir,
                                                              config.internal_outmigration_file),
         'path_to_immigration_MSOA': "{}/{}".format(persistent_data_dir, config.immigration_MSOA),
+        'path_to_ethnic_lookup': "{}/{}".format(persistent_data_dir, config.ethnic_lookup),
+        'path_to_MSOA_centroids': "{}/{}".format(persistent_data_dir, config.MSOA_centroids),
 
     }, source=str(Path(__file__).resolve()))
 
-    # process the raw input data into a VPH format with the right variables
-    utils.prepare_dataset(config.path_to_raw_pop_file, config.path_to_pop_file,
-                          location_code=location,
-                          lookup_ethnicity="{}/{}".format(persistent_data_dir, config.ethnic_lookup),
-                          loopup_location_code=config.path_msoa_to_lad)
-
-    # run the pipeline
-    pop = RunPipeline(config, start_population_size)
-
-    print('Finished running the full simulation')
-    # save the output file to csv
-    output_data_filename = 'ssm_' + location + '_MSOA11_ppp_2011_simulation.csv'
-    pop.to_csv(os.path.join(run_output_dir, output_data_filename))
-
- # print some summary stats on the simulation
-    print('alive', len(pop[pop['alive'] == 'alive']))
-
-    if 'Mortality()' in config.components:
-        print('dead', len(pop[pop['alive'] == 'dead']))
-    if 'Emigration()' in config.components:
-        print('emigrated', len(pop[pop['alive'] == 'emigrated']))
-    if 'InternalMigration()' in config.components:
-        print('internal migration', len(pop[pop['internal_outmigration'] != '']))
-    if 'FertilityAgeSpecificRates()' in config.components:
-        print('New children', len(pop[pop['parent_id'] != -1]))
-    if 'Immigration()' in config.components:
-        print('Immigrants', len(pop[pop['immigrated'].astype(str) == 'Yes']))
-
 
 if __name__ == "__main__":
 
@@ -157,8 +191,11 @@ if __name__ == "__main__":
     parser.add_argument('--input_data_dir', help='directory where the input data is', default=None)
     parser.add_argument('--persistent_data_dir', help='directory where the persistent data is', default=None)
     parser.add_argument('--output_dir', type=str, help='directory where the output data is saved', default=None)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of a previous run of this location')
 
     args = parser.parse_args()
     configuration_file = args.config
 
-    run_pipeline(configuration_file, args.location, args.input_data_dir, args.persistent_data_dir, args.output_dir)
+    run_pipeline(configuration_file, args.location, args.input_data_dir, args.persistent_data_dir, args.output_dir,
+                 args.resume)
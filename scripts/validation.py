@@ -3,6 +3,7 @@ import os
 import pandas as pd
 import argparse
 from daedalus.VphSpenserPipeline.ValidationEstimates import compare_estimates, compare_detailed_estimates
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore
 from daedalus.VphSpenserPipeline.ReassingMigrants import get_migrants, reassign_internal_migration_to_LAD
 
 def run_validation(location, input_location_path, persistent_data_dir):
@@ -25,15 +26,16 @@ def run_validation(location, input_location_path, persistent_data_dir):
     ONS_summary_data = pd.read_csv(ONS_summary_file)
     ONS_detailed_data = pd.read_csv(ONS_detailed_file)
 
-    # path to the simulation files
-    list_pop_dir = [i for i in os.listdir(input_location_path) if i.startswith('year_')]
+    # simulation files, in any output format
+    store = OutputStore(os.path.dirname(os.path.normpath(input_location_path)))
+    list_pop_dir = ['year_' + str(year) for year in store.years(location)]
 
 
     # for each year run the comparisons
     for year_dir in list_pop_dir:
 
-        year = int(list(year_dir)[-1])
-        simulation_data = pd.read_csv(os.path.join(input_location_path, year_dir,'ssm_'+location+'_MSOA11_ppp_2011_simulation_'+year_dir+'_reassigned.csv'))
+        year = int(year_dir[len('year_'):])
+        simulation_data = store.read(location, year, reassigned=True)
 
         summary_df_sum = compare_estimates(simulation_data, ONS_summary_data, location, year)
         summary_df_sum_detailed, summary_df_last_detailed = compare_detailed_estimates(simulation_data, ONS_detailed_data, location, year)
@@ -46,13 +48,11 @@ def run_validation(location, input_location_path, persistent_data_dir):
 
 
     # run comparison for the total simmulation
-    final_file = 'ssm_'+location+'_MSOA11_ppp_2011_simulation_reassigned.csv'
-
     # get the number of years that the simulatio ran for (should be the same at the highest values for the year subdirectories)
-    total_year = [int(list(y)[-1]) for y in list_pop_dir]
+    total_year = store.years(location)
     year = 2011 + max(total_year)
 
-    simulation_data = pd.read_csv(os.path.join(input_location_path,final_file))
+    simulation_data = store.read(location, reassigned=True)
 
     summary_df_sum = compare_estimates(simulation_data, ONS_summary_data, location, max(total_year))
     summary_df_sum_detailed, summary_df_last_detailed = compare_detailed_estimates(simulation_data, ONS_detailed_data,
@@ -1,17 +1,45 @@
+import json
 import pytest
 import yaml
 import pandas as pd
-from os.path import exists
-from os import remove
+import numpy as np
+import multiprocessing
+import time
+from os.path import basename, exists
+import os
+from os import makedirs
+import scipy.sparse
+import shutil
+import random
+from types import SimpleNamespace
 from vivarium import InteractiveContext
 
 from daedalus.RateTables import ImmigrationRateTable
-from daedalus.utils import get_config
+from daedalus.utils import get_config, make_od_matrices_sparse
 #from daedalus.PopulationSynthesis import static
 
 from daedalus.RateTables import FertilityRateTable
 from daedalus.RateTables import MortalityRateTable
 from daedalus.RateTables import EmigrationRateTable
+from daedalus.RateTables.InternalMigrationMatrix import InternalMigrationMatrix
+from daedalus.RateTables.BaseHandler import AGE_RANGE_KEYS, BaseHandler
+from daedalus.RateTables.RateTableCache import get_cache_backend, to_compact_dtypes
+from daedalus.RateTables.RateCube import RateCube
+from daedalus.RateTables.LADIndexedSource import LADIndexedSource, get_rates_location
+from daedalus.RateTables.GravityODModel import GravityODModel
+from daedalus.RateTables.ODLocationIndex import ODLocationIndex
+from daedalus.RateTables.ODMatrixBundle import ODMatrixBundle
+from daedalus.RateTables.TopKODMatrix import TopKODMatrix
+from daedalus.VphSpenserPipeline.Checkpoints import Checkpoints
+from daedalus.VphSpenserPipeline.EventLog import EventLog, write_events
+from daedalus.VphSpenserPipeline.InternalMigration import InternalMigration
+from daedalus.VphSpenserPipeline.OutputStore import OutputStore, to_output_dtypes
+from daedalus.VphSpenserPipeline.OutputWriter import OutputWriter
+from daedalus.VphSpenserPipeline.PhaseTimer import PhaseTimer, merge_reports, timing_report_path
+from daedalus.VphSpenserPipeline.PopulationArchiver import PopulationArchiver
+from daedalus.VphSpenserPipeline.ReassingMigrants import get_migrants, reassign_internal_migration_to_LAD
+from daedalus.VphSpenserPipeline.SetupCache import SetupCache
+from daedalus.VphSpenserPipeline.SimulationProfiler import SimulationProfiler
 
 from pathlib import Path
 
@@ -132,9 +160,1040 @@ def test_9_immigration_rate_table(configuration):
     assert isinstance(RateTable.rate_table, pd.DataFrame)
     RateTable.clear_cache()
 
+
+def leeds_rate_frame(locations=('E08000032', 'E08000033'), ethnicities=('BAN', 'WBI')):
+    # small wide-format table laid out like the LEEDS rate files
+    rows = []
+    for i, loc in enumerate(locations):
+        for j, eth in enumerate(ethnicities):
+            row = {'LAD.code': loc, 'ETH.group': eth}
+            for k, suffix in enumerate(['M', 'F']):
+                columns = [suffix + 'B.0'] + [suffix + str(age) + '.' + str(age + 1) for age in range(0, 100)] + \
+                          [suffix + '100.101p']
+                for age, column in enumerate(columns):
+                    row[column] = 1000 * i + 100 * j + 10 * k + age / 1000
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def test_10_transform_rate_table():
+    df = leeds_rate_frame()
+    rate_table = BaseHandler.transform_rate_table(df, 2011, 2012, -1, 101)
+
+    assert rate_table.shape == (2 * 2 * 2 * 102, 8)
+    assert list(rate_table.columns) == ['location', 'ethnicity', 'age_start', 'age_end', 'sex', 'year_start',
+                                        'year_end', 'mean_value']
+    for _, row in rate_table.sample(50, random_state=0).iterrows():
+        column = ('M' if row['sex'] == 1 else 'F') + \
+                 {-1: 'B.0', 100: '100.101p'}.get(row['age_start'],
+                                                  '{}.{}'.format(row['age_start'], row['age_start'] + 1))
+        source = df[(df['LAD.code'] == row['location']) & (df['ETH.group'] == row['ethnicity'])]
+        assert row['mean_value'] == source[column].values[0]
+
+    # categories that are duplicated or missing get a zero rate
+    df = pd.concat([df.iloc[[0]], df.drop(index=1)])
+    rate_table = BaseHandler.transform_rate_table(df, 2011, 2012, 10, 50, [2])
+    assert rate_table.shape == (2 * 2 * 40, 8)
+    assert (rate_table[rate_table['location'] == 'E08000032']['mean_value'] == 0).all()
+    assert (rate_table[rate_table['location'] == 'E08000033']['mean_value'] != 0).all()
+
+
+def test_11_compute_migration_rates():
+    df_migration = leeds_rate_frame()
+    rows = []
+    for loc in ['E08000032', 'E08000033']:
+        for eth in ['BAN_UK', 'BAN_NonUK', 'WBI_UK', 'WBI_NonUK', 'WBI_Other']:
+            row = {'LAD': loc, 'ETH': eth, 'B': 2}
+            for suffix in ['M', 'F']:
+                for age in range(0, 101):
+                    row[suffix + str(age)] = 0 if eth.startswith('BAN') and age == 30 else 2
+            rows.append(row)
+    df_total = pd.DataFrame(rows)
+
+    rate_table = BaseHandler.compute_migration_rates(df_migration, df_total, 2011, 2012, -1, 100)
+    counts = BaseHandler.compute_migration_rates(df_migration, df_total, 2011, 2012, -1, 100, normalize=False)
+    assert rate_table.shape == counts.shape == (2 * 2 * 2 * 101, 8)
+
+    # only the '_UK' and '_NonUK' totals are added up in the denominator
+    with_population = (rate_table['ethnicity'] == 'WBI') | (rate_table['age_start'] != 30)
+    assert np.allclose(rate_table[with_population]['mean_value'], counts[with_population]['mean_value'] / 4)
+    # a zero denominator gives a zero rate, normalised or not
+    assert (rate_table[~with_population]['mean_value'] == 0).all()
+    assert (counts[~with_population]['mean_value'] == 0).all()
+
+
+@pytest.mark.parametrize('cache_format', ['npz', 'csv', 'parquet', 'feather'])
+def test_12_rate_table_cache_backends(cache_format, tmp_path):
+    if cache_format in ['parquet', 'feather']:
+        pytest.importorskip('pyarrow')
+    rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+    backend = get_cache_backend(cache_format)
+    path = str(tmp_path / ('test_rate_table' + backend.extension))
+
+    backend.write(rate_table, path)
+    pd.testing.assert_frame_equal(backend.read(path), rate_table)
+
+
+class LeedsRateTable(BaseHandler):
+    """Rate table built from the LEEDS-like test frame."""
+
+    def _build(self):
+        self.rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+
+
+def test_13_rate_table_cache_rebuilds_legacy_csv(tmp_path):
+    RateTable = LeedsRateTable(configuration={})
+    RateTable.rate_table_path = str(tmp_path / ('test_rate_table' + RateTable.cache_backend.extension))
+    # a CSV cached by a previous version, from other sources
+    BaseHandler.transform_rate_table(leeds_rate_frame(locations=['E08000032']), 2011, 2012, 0, 100).to_csv(
+        RateTable.legacy_csv_path())
+
+    RateTable.set_rate_table()
+    assert exists(RateTable.rate_table_path) and not exists(RateTable.legacy_csv_path())
+    pd.testing.assert_frame_equal(RateTable.rate_table,
+                                  BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100))
+
+
+def test_14_rate_table_cache_key(tmp_path):
+    source_file = str(tmp_path / 'test_rate_source.csv')
+    leeds_rate_frame().to_csv(source_file, index=False)
+    RateTable = BaseHandler(configuration={'population': {'age_start': 0, 'age_end': 100}})
+    RateTable.rate_table_dir = str(tmp_path) + '/'
+
+    RateTable.set_cache_key('test_rate_table', [source_file], AGE_RANGE_KEYS)
+    first_path = RateTable.rate_table_path
+    RateTable.set_cache_key('test_rate_table', [source_file], AGE_RANGE_KEYS)
+    assert RateTable.rate_table_path == first_path
+    # the size of the population of each LAD, written to the config by RunPipeline, is not part of the key
+    for population_size in [1000, 2000]:
+        RateTable.configuration['population']['population_size'] = population_size
+        RateTable.set_cache_key('test_rate_table', [source_file], AGE_RANGE_KEYS)
+        assert RateTable.rate_table_path == first_path
+
+    # a new config or source file content gives a new cache entry
+    RateTable.configuration['population']['age_end'] = 90
+    RateTable.set_cache_key('test_rate_table', [source_file], AGE_RANGE_KEYS)
+    assert RateTable.rate_table_path != first_path
+    second_path = RateTable.rate_table_path
+    leeds_rate_frame(locations=['E08000032']).to_csv(source_file, index=False)
+    RateTable.set_cache_key('test_rate_table', [source_file], AGE_RANGE_KEYS)
+    assert RateTable.rate_table_path not in [first_path, second_path]
+
+    # only the most recently used entries are kept
+    RateTable.rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+    for path in [first_path, second_path]:
+        RateTable.rate_table_path = path
+        RateTable.cache()
+    assert RateTable.clean_cache(1) == [basename(first_path)]
+    assert not exists(first_path) and exists(second_path)
+
+
+def test_15_scaled_rate_table():
+    RateTable = BaseHandler(configuration={'scale_rates': {'method': 'constant', 'constant': {'mortality': 1}}})
+    RateTable.scale_component = 'mortality'
+    RateTable.rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+    assert RateTable.scaled_rate_table() is RateTable.rate_table
+
+    RateTable.configuration['scale_rates']['constant']['mortality'] = 2.5
+    scaled = RateTable.scaled_rate_table()
+    assert np.allclose(scaled['mean_value'], 2.5 * RateTable.rate_table['mean_value'])
+    # the cached table itself is left unscaled
+    assert not np.allclose(scaled['mean_value'], RateTable.rate_table['mean_value'])
+
+
+def test_16_lad_indexed_source(tmp_path):
+    source_file = str(tmp_path / 'test_immigration_source.csv')
+    df = leeds_rate_frame(locations=['E08000032', 'E09000001', 'E09000033'])
+    df.insert(0, 'LAD.name', 'name')
+    df.to_csv(source_file, index=False)
+
+    source = LADIndexedSource.load(source_file, 'LAD.code', 'ETH.group')
+    assert LADIndexedSource.load(source_file, 'LAD.code', 'ETH.group') is source
+    pd.testing.assert_frame_equal(source.get('E08000032'), df[df['LAD.code'] == 'E08000032'])
+    assert source.get('E06000001').empty
+
+    # LADs with joined rates are built from their parts
+    merged = source.get(get_rates_location('E09000033'))
+    assert list(merged.columns) == list(df.columns)
+    assert (merged['LAD.code'] == 'E09000001+E09000033').all()
+    parts = df[df['LAD.code'].isin(['E09000001', 'E09000033'])]
+    assert np.isclose(merged['M50.51'].sum(), parts['M50.51'].sum())
+
+    # only the most recently used files stay loaded, until they are cleared
+    other_files = [str(tmp_path / 'test_immigration_source_{}.csv'.format(i)) for i in range(2)]
+    for other_file in other_files:
+        df.to_csv(other_file, index=False)
+        LADIndexedSource.load(other_file, 'LAD.code', 'ETH.group')
+    assert len(LADIndexedSource._loaded) == LADIndexedSource.max_loaded
+    assert LADIndexedSource.load(source_file, 'LAD.code', 'ETH.group') is not source
+    assert LADIndexedSource.load(other_files[1], 'LAD.code', 'ETH.group') is \
+        LADIndexedSource.load(other_files[1], 'LAD.code', 'ETH.group')
+    LADIndexedSource.clear()
+    assert not LADIndexedSource._loaded
+
+
+def test_17_rate_cube():
+    rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, -1, 101)
+    cube = RateCube.from_rate_table(rate_table)
+    assert cube.values.shape == (2, 2, 2, 102, 1)
+    pd.testing.assert_frame_equal(cube.to_rate_table(), rate_table)
+
+    population = rate_table.sample(200, random_state=0)
+    rates = cube.lookup(population['location'], population['ethnicity'], population['sex'],
+                        population['age_start'] + 0.5, 2011)
+    assert np.array_equal(rates, population['mean_value'].values)
+
+    # simulants outside of the rate table get a nan rate
+    rates = cube.lookup(['E08000032', 'E06000001', 'E08000032'], 'WBI', 1, [30, 30, 101.5])
+    assert rates[0] == rate_table[(rate_table['location'] == 'E08000032') & (rate_table['ethnicity'] == 'WBI') &
+                                  (rate_table['sex'] == 1) & (rate_table['age_start'] == 30)]['mean_value'].values[0]
+    assert np.isnan(rates[1:]).all()
+
+
+class SlowRateTable(BaseHandler):
+    """Rate table whose build takes a while and is counted, to check that parallel workers build it only once."""
+
+    def __init__(self, directory):
+        super().__init__(configuration={})
+        self.builds_file = os.path.join(directory, 'test_slow_rate_table_builds.txt')
+        self.rate_table_path = os.path.join(directory, 'test_slow_rate_table' + self.cache_backend.extension)
+
+    def _build(self):
+        with open(self.builds_file, 'a') as builds_file:
+            builds_file.write('build\n')
+        time.sleep(0.5)
+        self.rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+
+
+def load_slow_rate_table(directory):
+    RateTable = SlowRateTable(directory)
+    RateTable.set_rate_table()
+    return len(RateTable.rate_table)
+
+
+def test_18_rate_table_cache_parallel_workers(tmp_path):
+    with multiprocessing.Pool(4) as pool:
+        lengths = pool.map(load_slow_rate_table, [str(tmp_path)] * 4)
+
+    assert len(set(lengths)) == 1
+    RateTable = SlowRateTable(str(tmp_path))
+    with open(RateTable.builds_file) as builds_file:
+        assert len(builds_file.readlines()) == 1
+    assert not exists(RateTable.rate_table_path + '.lock')
+
+
+@pytest.mark.parametrize('float32_rates', [False, True])
+def test_19_compact_rate_table(float32_rates, tmp_path):
+    RateTable = BaseHandler(configuration={'rate_tables': {'compact_dtypes': True, 'float32_rates': float32_rates}})
+    RateTable.rate_table_path = str(tmp_path / ('test_rate_table' + RateTable.cache_backend.extension))
+    rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+    RateTable.rate_table = rate_table
+    RateTable.cache()
+
+    RateTable.set_rate_table()
+    compact = RateTable.rate_table
+    assert compact['location'].dtype.name == 'category' and compact['ethnicity'].dtype.name == 'category'
+    assert all(compact[column].dtype.itemsize <= 2 for column in ['age_start', 'age_end', 'sex', 'year_start'])
+    assert compact['mean_value'].dtype == (np.float32 if float32_rates else np.float64)
+    # the footprint of the table handed to the simulation, whose locations and ethnicities are strings again
+    assert RateTable.memory_footprint() < rate_table.memory_usage(deep=True).sum()
+
+    # same rates as the plain rate table, through the frame or a rate cube
+    plain = compact.astype({'location': object, 'ethnicity': object, 'age_start': np.int64, 'age_end': np.int64,
+                            'sex': np.int64, 'year_start': np.int64, 'year_end': np.int64, 'mean_value': np.float64})
+    pd.testing.assert_frame_equal(plain, rate_table, check_exact=not float32_rates, rtol=1e-6)
+    assert np.allclose(RateTable.rate_cube(scaled=False).to_rate_table()['mean_value'],
+                       RateCube.from_rate_table(rate_table).to_rate_table()['mean_value'])
+
+
+def test_20_od_matrix_bundle(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    makedirs(od_matrix_dir, exist_ok=True)
+    matrices = {}
+    for sex, age_band in [('M', '0to4'), ('F', '0to4'), ('M', '75plus')]:
+        matrix = scipy.sparse.random(50, 50, density=0.2, format='coo', random_state=len(matrices))
+        scipy.sparse.save_npz('{}/{}_{}_prob_matrix_EW.npz'.format(od_matrix_dir, sex, age_band), matrix)
+        matrices[(sex, age_band)] = matrix.tocsr()
+
+    bundle = ODMatrixBundle.open(od_matrix_dir + '/od_matrices.bundle', od_matrix_dir)
+    assert sorted(bundle.names()) == ['F_0to4', 'M_0to4', 'M_75plus']
+    assert bundle.age_bands() == ['0to4', '75plus']
+    assert list(bundle.age_band([0, 4.5, 75, 100])) == ['0to4', '0to4', '75plus', '75plus']
+    for (sex, age_band), matrix in matrices.items():
+        assert (bundle.matrix(sex, age_band) != matrix).nnz == 0
+        destinations, probabilities = bundle.row(sex, age_band, 7)
+        assert np.array_equal(probabilities, matrix.toarray()[7, destinations])
+        assert np.array_equal(destinations, np.flatnonzero(matrix.toarray()[7]))
+
+    # the bundle is rebuilt when a source matrix changes
+    assert ODMatrixBundle.is_up_to_date(bundle.path, od_matrix_dir)
+    scipy.sparse.save_npz(od_matrix_dir + '/M_0to4_prob_matrix_EW.npz', scipy.sparse.coo_matrix(np.eye(50)))
+    assert not ODMatrixBundle.is_up_to_date(bundle.path, od_matrix_dir)
+    bundle = ODMatrixBundle.open(bundle.path, od_matrix_dir)
+    assert bundle.row('M', '0to4', 7)[0].tolist() == [7]
+
+
+def test_21_od_matrix_alias_sampling(tmp_path):
+    matrix = scipy.sparse.random(30, 30, density=0.3, format='csr', random_state=1)
+    matrix.sort_indices()
+    alias_prob, alias = ODMatrixBundle.alias_tables(matrix.indptr, matrix.data)
+
+    # the alias tables give back the (normalised) probabilities of every row
+    for row in range(30):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        n = end - start
+        if n == 0:
+            continue
+        probabilities = alias_prob[start:end].copy()
+        np.add.at(probabilities, alias[start:end], 1 - alias_prob[start:end])
+        assert np.allclose(probabilities / n, matrix.data[start:end] / matrix.data[start:end].sum())
+
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    makedirs(od_matrix_dir, exist_ok=True)
+    scipy.sparse.save_npz(od_matrix_dir + '/M_16to19_prob_matrix_EW.npz', matrix.tocoo())
+    scipy.sparse.save_npz(od_matrix_dir + '/F_16to19_prob_matrix_EW.npz', scipy.sparse.coo_matrix(np.eye(30)))
+    bundle = ODMatrixBundle.open(od_matrix_dir + '/od_matrices.bundle', od_matrix_dir)
+
+    origin = int(np.argmax(np.diff(matrix.indptr)))
+    destinations = bundle.sample_destinations(np.full(100000, origin), 'M', '16to19', np.random.default_rng(0))
+    row = matrix.toarray()[origin]
+    frequencies = np.bincount(destinations, minlength=30) / len(destinations)
+    assert np.abs(frequencies - row / row.sum()).max() < 0.01
+    # the alias tables are read from the bundle, like the CSR arrays
+    arrays = bundle.arrays('M', '16to19')
+    assert isinstance(arrays['alias_prob'], np.memmap) and isinstance(arrays['alias'], np.memmap)
+    assert np.array_equal(arrays['alias_prob'], alias_prob) and np.array_equal(arrays['alias'], alias)
+
+    # movers of different sexes are drawn from their own matrix
+    destinations = bundle.sample_destinations([3, 4, origin], ['F', 'F', 'M'], '16to19', np.random.default_rng(0))
+    assert destinations[:2].tolist() == [3, 4] and row[destinations[2]] > 0
+
+
+def test_22_make_od_matrices_sparse(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_csv')
+    makedirs(od_matrix_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    weights = {}
+    for name in ['M_0to4_prob_matrix_EW', 'F_0to4_prob_matrix_EW']:
+        weights[name] = rng.exponential(size=(40, 40)) * (rng.random((40, 40)) < 0.5)
+        pd.DataFrame(weights[name], index=['MSOA{}'.format(i) for i in range(40)]).to_csv(
+            '{}/{}.csv'.format(od_matrix_dir, name))
+
+    report = make_od_matrices_sparse(od_matrix_dir + '/*.csv', row_threshold=10, output_dir=od_matrix_dir + '/npz',
+                                      process_np=2, chunksize=7)
+    assert sorted(basename(output_file) for output_file, _, _ in report) == ['F_0to4_prob_matrix_EW.npz',
+                                                                             'M_0to4_prob_matrix_EW.npz']
+    for output_file, nnz, _ in report:
+        # rows normalised, then values under a tenth of the row maximum dropped
+        expected = weights[basename(output_file)[:-4]]
+        expected = expected / expected.sum(axis=1)[:, None]
+        expected[expected < expected.max(axis=1)[:, None] / 10] = 0
+        matrix = scipy.sparse.load_npz(output_file)
+        assert matrix.nnz == nnz == np.count_nonzero(expected)
+        assert np.allclose(matrix.toarray(), expected, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('probability_dtype', [np.uint16, np.float16])
+def test_23_top_k_od_matrix(probability_dtype, tmp_path):
+    matrix = scipy.sparse.random(40, 40, density=0.3, format='csr', random_state=2)
+    top_k = TopKODMatrix.from_sparse(matrix, 5, probability_dtype)
+    assert top_k.destinations.dtype == np.int16 and top_k.probabilities.dtype == probability_dtype
+    if probability_dtype == np.uint16:
+        assert (top_k.probabilities.sum(axis=1)[np.diff(matrix.indptr) > 0] == TopKODMatrix.quantization).all()
+
+    dense = matrix.toarray()
+    for origin in range(40):
+        destinations, probabilities = top_k.row(origin)
+        expected = np.argsort(-dense[origin], kind='stable')[:min(5, np.count_nonzero(dense[origin]))]
+        assert sorted(destinations) == sorted(expected)
+        assert np.allclose(probabilities, dense[origin, destinations] / dense[origin, destinations].sum(), atol=1e-3)
+        if len(destinations):
+            assert np.isclose(top_k.discarded_mass[origin], 1 - dense[origin, destinations].sum() / dense[origin].sum(),
+                              atol=1e-6)
+
+    origin = int(np.argmax(np.diff(matrix.indptr)))
+    draws = top_k.sample_destinations(np.full(50000, origin), np.random.default_rng(0))
+    destinations, probabilities = top_k.row(origin)
+    assert set(draws) <= set(destinations)
+    frequencies = np.array([np.mean(draws == destination) for destination in destinations])
+    assert np.abs(frequencies - probabilities).max() < 0.01
+
+    top_k.save(str(tmp_path / 'test_top_k.npz'))
+    loaded = TopKODMatrix.load(str(tmp_path / 'test_top_k.npz'))
+    assert (loaded.to_sparse() != top_k.to_sparse()).nnz == 0
+
+
+def od_matrix_test_data(directory, n_msoas=6):
+    """MSOA lookup (two wards per MSOA, MSOAs split between two LADs), OD index and random OD matrices."""
+    makedirs(directory, exist_ok=True)
+    msoas = ['E0200000{}'.format(i) for i in range(n_msoas)]
+    lads = ['E08000032' if i < n_msoas // 2 else 'E08000033' for i in range(n_msoas)]
+    pd.DataFrame({'MSOA11CD': msoas * 2, 'LAD16CD': lads * 2, 'WD16CD': ['W{}'.format(i) for i in range(2 * n_msoas)]}
+                 ).to_csv(directory + '/msoa_to_lad.csv', index=False)
+    pd.DataFrame({'indices': range(n_msoas)}, index=msoas).to_csv(directory + '/MSOA_to_OD_index.csv')
+    for sex in ['M', 'F']:
+        matrix = scipy.sparse.random(n_msoas, n_msoas, density=0.6, format='coo', random_state=len(sex))
+        scipy.sparse.save_npz('{}/{}_16to19_prob_matrix_EW.npz'.format(directory, sex), matrix)
+    return ConfigTree({'path_msoa_to_lad': directory + '/msoa_to_lad.csv',
+                       'path_to_OD_matrix_index_file': directory + '/MSOA_to_OD_index.csv',
+                       'path_to_OD_matrices': directory,
+                       'location': 'E08000032'})
+
+
+def test_24_od_matrix_origin_subset(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    config = od_matrix_test_data(od_matrix_dir)
+    # movers of E08000032 (MSOAs 0 to 2) can go to MSOA 3 of E08000033, and from there to MSOA 4 (men) or back
+    national = {'M': [[0, .5, 0, .5, 0, 0], [1, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0],
+                      [0, 0, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0]],
+                'F': [[0, 1, 0, 0, 0, 0], [0, 0, .5, .5, 0, 0], [1, 0, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0],
+                      [0, 0, 1, 0, 0, 0], [0, 0, 0, 0, 1, 0]]}
+    for sex, matrix in national.items():
+        national[sex] = np.array(matrix)
+        scipy.sparse.save_npz('{}/{}_16to19_prob_matrix_EW.npz'.format(od_matrix_dir, sex),
+                              scipy.sparse.coo_matrix(national[sex]))
+
+    subset_config = ConfigTree(config.to_dict())
+    subset_config.update({'internal_migration': {'od_origin_subset': True}})
+    OD_matrices = InternalMigrationMatrix(configuration=subset_config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+    # the simulation components keep reading the national matrices
+    assert OD_matrices.path_to_OD_matrices == od_matrix_dir
+    assert os.listdir(od_matrix_dir + '/origin_subsets/E08000032') == [os.path.basename(
+        OD_matrices.path_to_OD_matrix_bundle)]
+    for sex in ['M', 'F']:
+        # only the rows of the LAD are extracted, with their national index
+        subset = OD_matrices.origin_bundle.matrix(sex, '16to19').toarray()
+        assert np.array_equal(subset[:3], national[sex][:3]) and not subset[3:].any()
+
+    # a man who moved out of the LAD to MSOA 3 moves again, to MSOA 4, with the national matrices
+    destinations = OD_matrices.sample_destinations([3, 3], ['M', 'F'], '16to19', np.random.default_rng(0))
+    assert destinations.tolist() == [4, 0]
+    destinations = OD_matrices.sample_destinations([0, 1, 2] * 100, 'M', '16to19', np.random.default_rng(0))
+    assert all(national_row[destination] > 0 for national_row, destination in
+               zip(national['M'][[0, 1, 2] * 100], destinations))
+
+    # the national matrices are not copied when the LAD has all the origins
+    pd.DataFrame({'MSOA11CD': ['E0200000{}'.format(i) for i in range(6)], 'LAD16CD': 'E08000032'}).to_csv(
+        config.path_msoa_to_lad, index=False)
+    OD_matrices = InternalMigrationMatrix(configuration=subset_config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+    assert OD_matrices.origin_bundle is None
+
+    # nor opened for runs without origin subsets
+    OD_matrices = InternalMigrationMatrix(configuration=config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+    assert OD_matrices.OD_matrix_bundle is None and OD_matrices.origin_bundle is None
+    assert OD_matrices.open_bundle().matrix('M', '16to19').nnz == scipy.sparse.load_npz(
+        od_matrix_dir + '/M_16to19_prob_matrix_EW.npz').nnz
+
+
+def test_25_od_location_index(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    config = od_matrix_test_data(od_matrix_dir)
+    index = ODLocationIndex.load_or_build(config.path_msoa_to_lad, config.path_to_OD_matrix_index_file, od_matrix_dir)
+    assert len([f for f in os.listdir(od_matrix_dir) if f.startswith(ODLocationIndex.cache_prefix)]) == 1
+
+    assert index.msoa([0, 5, 2]).tolist() == ['E02000000', 'E02000005', 'E02000002']
+    assert index.lad([0, 5]).tolist() == ['E08000032', 'E08000033']
+    assert index.od_index(['E02000004', 'E02000009']).tolist() == [4, -1]
+    assert index.od_indices_in(['E08000033']).tolist() == [3, 4, 5]
+
+    # same translation as the merge of the lookup files done before
+    df_msoa_lad = pd.read_csv(config.path_msoa_to_lad)
+    df_OD_matrix_dest = pd.read_csv(config.path_to_OD_matrix_index_file, index_col=0)
+    expected = df_OD_matrix_dest.merge(df_msoa_lad[["MSOA11CD", "LAD16CD"]], left_index=True, right_on="MSOA11CD")
+    expected.index = expected["indices"]
+    loaded = ODLocationIndex.load_or_build(config.path_msoa_to_lad, config.path_to_OD_matrix_index_file, od_matrix_dir)
+    assert dict(zip(loaded.to_frame()["indices"], loaded.to_frame()["MSOA11CD"])) == expected["MSOA11CD"].to_dict()
+    assert dict(zip(loaded.to_frame()["indices"], loaded.to_frame()["LAD16CD"])) == expected["LAD16CD"].to_dict()
+
+
+def test_26_gravity_od_model(tmp_path):
+    # OD matrix drawn from a gravity model with an exponent of 2 on a grid of MSOAs 1km apart
+    coordinates = np.array([[x, y] for x in range(12) for y in range(12)], dtype=float) * 1000
+    masses = np.random.default_rng(0).uniform(0.5, 1.5, len(coordinates))
+    distances = np.hypot(*(coordinates[:, None, :] - coordinates[None, :, :]).transpose(2, 0, 1))
+    np.fill_diagonal(distances, np.inf)
+    weights = masses * np.maximum(distances, 1000) ** -2.0
+    matrix = scipy.sparse.csr_matrix(weights / weights.sum(axis=1, keepdims=True))
+
+    model, report = GravityODModel.calibrate({'M_16to19': matrix}, coordinates, n_neighbours=143, sample_origins=None)
+    assert abs(model.exponents['M_16to19'] - 2.0) < 0.05
+    # masses are fitted as the shares of arrivals, not the masses of the generating model
+    assert report['total_variation_distance'][0] < 0.1 and report['neighbour_mass_share'][0] == pytest.approx(1)
+
+    destinations, probabilities = model.row(20, 'M', '16to19')
+    assert 20 not in destinations
+    assert np.abs(probabilities - matrix.toarray()[20, destinations]).max() < 0.02
+    draws = model.sample_destinations(np.full(50000, 20), 'M', '16to19', np.random.default_rng(0))
+    frequencies = np.array([np.mean(draws == destination) for destination in destinations])
+    assert np.abs(frequencies - probabilities).max() < 0.01
+
+    model.save(str(tmp_path / 'test_gravity_model.npz'))
+    loaded = GravityODModel.load(str(tmp_path / 'test_gravity_model.npz'))
+    assert loaded.exponents == model.exponents and loaded.n_neighbours == 143
+
+
+def test_27_gravity_od_model_backs_up_od_matrices(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    config = od_matrix_test_data(od_matrix_dir)
+    # movers of the LAD (MSOAs 0 to 2) stay in it, origins 3 to 5 have no OD row
+    matrix = np.zeros((6, 6))
+    matrix[:3, :3] = 1 / 3
+    scipy.sparse.save_npz(od_matrix_dir + '/M_16to19_prob_matrix_EW.npz', scipy.sparse.coo_matrix(matrix))
+    coordinates = np.arange(12, dtype=float).reshape(6, 2) * 1000
+    GravityODModel(coordinates, {'M_16to19': 1.0}, {'M_16to19': np.ones(6) / 6}, n_neighbours=2).save(
+        od_matrix_dir + '/gravity_model.npz')
+    config.update({'internal_migration': {'gravity_model': od_matrix_dir + '/gravity_model.npz'}})
+
+    OD_matrices = InternalMigrationMatrix(configuration=config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+    # the gravity model is used for the origins without OD row
+    destinations = OD_matrices.sample_destinations([0, 1, 5, 5, 4], 'M', '16to19', np.random.default_rng(0))
+    assert (destinations >= 0).all()
+    assert set(destinations[2:4]) <= {3, 4} and destinations[4] in [3, 5]
+
+    # or for all the movers of the internal migration component, without opening the OD matrices
+    gravity_config = ConfigTree(config.to_dict())
+    gravity_config.update({'internal_migration': {'gravity_destinations': 'all'}})
+    OD_matrices = InternalMigrationMatrix(configuration=gravity_config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+    component = InternalMigration()
+    component.OD_matrices = OD_matrices
+    movers = pd.DataFrame({'MSOA': ['E02000000', 'E02000005'], 'location': ['E08000032', 'E08000033'],
+                           'sex': 1.0, 'age': 17.5})
+    update = component.moves(movers, pd.Timestamp('2011-02-01'), np.random.default_rng(0).random((2, 2)))
+    # the two nearest MSOAs of each origin
+    assert update['MSOA'][0] in ['E02000001', 'E02000002'] and update['MSOA'][1] in ['E02000003', 'E02000004']
+    assert OD_matrices.OD_matrix_bundle is None
+    with pytest.raises(ValueError):
+        InternalMigrationMatrix(configuration=ConfigTree({**config.to_dict(),
+                                                          'internal_migration': {'gravity_destinations': 'all'}}))
+
+
+def test_28_checkpoints(tmp_path):
+    checkpoint_dir = str(tmp_path / 'test_checkpoints')
+    key_mapping = SimpleNamespace(_map=pd.Series([0.1, 0.2]), _size=2)
+    simulation = SimpleNamespace(_population=SimpleNamespace(_population=pd.DataFrame({'age': [1.0, 2.0]})),
+                                 _clock=SimpleNamespace(_time=pd.Timestamp('2012-01-01')),
+                                 _randomness=SimpleNamespace(_key_mapping=key_mapping))
+    checkpoints = Checkpoints(checkpoint_dir, keep=2)
+    assert checkpoints.latest() is None
+
+    np.random.seed(0)
+    random.seed(0)
+    for year in [1, 2, 3]:
+        simulation._population._population['age'] += 1
+        simulation._clock._time += pd.Timedelta(days=365.25)
+        checkpoints.save(simulation, year)
+    expected_draws = (np.random.random(3), random.random())
+    # only the last two checkpoints are kept
+    assert checkpoints.years() == [2, 3] and checkpoints.latest() == 3
+
+    simulation._population._population = pd.DataFrame({'age': [0.0]})
+    simulation._clock._time = pd.Timestamp('2011-01-01')
+    key_mapping._size = 0
+    checkpoints.restore(simulation, checkpoints.latest())
+    pd.testing.assert_frame_equal(simulation._population._population, pd.DataFrame({'age': [4.0, 5.0]}))
+    assert simulation._clock._time == pd.Timestamp('2012-01-01') + 3 * pd.Timedelta(days=365.25)
+    # the key mapping is updated in place, and the random states are restored
+    assert simulation._randomness._key_mapping is key_mapping and key_mapping._size == 2
+    assert np.array_equal(np.random.random(3), expected_draws[0]) and random.random() == expected_draws[1]
+
+    # a checkpoint written half-way is ignored
+    with open(os.path.join(checkpoint_dir, Checkpoints.pattern.format(3)), 'ab') as checkpoint_file:
+        checkpoint_file.write(b'truncated')
+    assert not checkpoints.is_valid(3) and checkpoints.latest() == 2
+
+    # a new run over the checkpoints of years 2 and 3 of a previous one keeps the checkpoint it writes, and would not
+    # resume from the previous run, the compression of each checkpoint is read from its marker
+    checkpoints = Checkpoints(checkpoint_dir, keep=1, compression='gzip')
+    checkpoints.save(simulation, 1)
+    assert checkpoints.years() == [1] and checkpoints.latest() == 1
+    Checkpoints(checkpoint_dir).restore(simulation, 1)
+    pd.testing.assert_frame_equal(simulation._population._population, pd.DataFrame({'age': [4.0, 5.0]}))
+    checkpoints.save(simulation, 2)
+    checkpoints.clear()
+    assert checkpoints.years() == [] and checkpoints.latest() is None
+
+
+def test_29_output_writer(tmp_path):
+    pop = pd.DataFrame({'age': np.arange(1000) / 10, 'alive': 'alive', 'MSOA': 'E02002183'})
+    for mode in ['sync', 'thread', 'process']:
+        for compression in [None, 'gzip']:
+            output_store = OutputStore(str(tmp_path / '{}_{}'.format(mode, compression)), 'csv', compression)
+            with OutputWriter(output_store, mode, max_pending=1) as output_writer:
+                for year in [1, 2, 3]:
+                    output_writer.write(pop.assign(year=year), 'E08000032', year)
+            # all the snapshots are written when the writer is closed
+            for year in [1, 2, 3]:
+                written = output_store.read('E08000032', year)
+                pd.testing.assert_frame_equal(written[pop.columns], pop, check_dtype=False)
+                assert (written['year'] == year).all()
+            assert output_store.find('E08000032', 1).endswith('.csv.gz' if compression else '.csv')
+
+    # errors of the background writer are raised in the simulation
+    output_dir = str(tmp_path / 'test_output_writer')
+    with open(output_dir, 'w'):
+        pass
+    output_writer = OutputWriter(OutputStore(output_dir), 'thread')
+    output_writer.write(pop, 'E08000032', 1)
+    with pytest.raises(OSError):
+        output_writer.close()
+
+
+def test_30_output_store(tmp_path):
+    output_dir = str(tmp_path / 'test_output_store')
+    pop = pd.DataFrame({'tracked': True, 'alive': ['alive', 'dead', 'emigrated'], 'MSOA': 'E02002183',
+                        'location': ['E08000032', 'E08000032', 'E08000033'], 'age': [1.5, 30.0, 80.25],
+                        'sex': [1.0, 2.0, 1.0], 'parent_id': [-1, 0, -1],
+                        'entrance_time': pd.to_datetime(['2011-01-01 00:00:00', '2011-06-01 12:00:00', '2011-01-01 00:00:00']),
+                        'exit_time': pd.to_datetime([None, '2012-02-01', None])}, index=[4, 5, 9])
+    csv_store = OutputStore(output_dir)
+    for year in [None, 1, 2]:
+        csv_store.write(pop, 'E08000032', year)
+    assert csv_store.locations() == ['E08000032'] and csv_store.years('E08000032') == [1, 2]
+
+    for output_format, compression in [('parquet', 'zstd'), ('feather', 'lz4')]:
+        store = OutputStore(output_dir, output_format, compression)
+        store.write(pop, 'E08000032', 3)
+        # the typed schema is kept, with categorical strings
+        written = store.read('E08000032', 3)
+        assert written['alive'].dtype.name == 'category' and written['parent_id'].dtype == np.int64
+        assert pd.api.types.is_datetime64_any_dtype(written['exit_time'])
+        pd.testing.assert_frame_equal(written, to_output_dtypes(pop), check_dtype=False, check_categorical=False)
+        # outputs of any format are read
+        assert store.read('E08000032', 1)['entrance_time'].iloc[1] == '2011-06-01 12:00:00'
+        shutil.rmtree(os.path.dirname(store.path('E08000032', 3)))
+
+    # reassigned outputs are written in the format of the simulation outputs
+    parquet_store = OutputStore(output_dir, 'parquet', 'snappy')
+    for year in [None, 1, 2]:
+        parquet_store.write(pop.iloc[2:], 'E08000033', year)
+    pool_migrants = get_migrants(output_dir, ['E08000032', 'E08000033'])
+    reassign_internal_migration_to_LAD('E08000033', output_dir, pool_migrants)
+    assert parquet_store.find('E08000033', 1, reassigned=True) == parquet_store.path('E08000033', 1, reassigned=True)
+    reassigned = parquet_store.read('E08000033', 1, reassigned=True)
+    # the simulant of E08000033 plus the one that moved there from E08000032
+    assert len(reassigned) == 2 and reassigned['internal_migration_in'].tolist() == ['No', 'Yes']
+
+
+class StepSimulation:
+    """Stand-in for an InteractiveContext whose time steps age the population and draw deaths, emigrations,
+    internal moves, births and immigrations."""
+
+    def __init__(self, n_simulants, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self._clock = SimpleNamespace(_time=pd.Timestamp('2011-01-01'), step_size=pd.Timedelta(days=30.4375))
+        population = pd.DataFrame({'tracked': True, 'alive': 'alive', 'MSOA': self.msoas(n_simulants),
+                                   'location': 'E08000032', 'age': self.rng.uniform(0, 90, n_simulants),
+                                   'sex': self.rng.integers(1, 3, n_simulants).astype(float), 'parent_id': -1,
+                                   'entrance_time': self._clock._time, 'exit_time': pd.NaT,
+                                   'last_birth_time': pd.NaT, 'previous_MSOA_locations': ''})
+        self._population = SimpleNamespace(_population=population)
+
+    def msoas(self, n):
+        return np.array(['E0200218{}'.format(i) for i in range(6)])[self.rng.integers(0, 6, n)]
+
+    def step(self):
+        self._clock._time += self._clock.step_size
+        pop = self._population._population
+        alive = pop.index[pop['alive'] == 'alive']
+        pop.loc[alive, 'age'] += self._clock.step_size / pd.Timedelta(days=365.25)
+        for status, n in [('dead', 2), ('emigrated', 1)]:
+            exits = self.rng.choice(pop.index[pop['alive'] == 'alive'], n, replace=False)
+            pop.loc[exits, ['alive', 'exit_time']] = [status, self._clock._time]
+        movers = self.rng.choice(pop.index[pop['alive'] == 'alive'], 3, replace=False)
+        pop.loc[movers, 'previous_MSOA_locations'] = pop.loc[movers, 'MSOA']
+        pop.loc[movers, 'MSOA'] = 'E0201{:04d}'.format(len(pop))
+        mothers = self.rng.choice(pop.index[(pop['alive'] == 'alive') & (pop['sex'] == 2) & ~pop.index.isin(movers)],
+                                  2, replace=False)
+        pop.loc[mothers, 'last_birth_time'] = self._clock._time
+        new_simulants = pd.DataFrame({'tracked': True, 'alive': 'alive', 'MSOA': self.msoas(3),
+                                      'location': 'E08000032', 'age': [0.0, 0.0, 30.0], 'sex': [1.0, 2.0, 1.0],
+                                      'parent_id': list(mothers) + [-1], 'entrance_time': self._clock._time,
+                                      'exit_time': pd.NaT, 'last_birth_time': pd.NaT,
+                                      'previous_MSOA_locations': ''}, index=len(pop) + np.arange(3))
+        self._population._population = pd.concat([pop, new_simulants])
+
+
+def test_31_event_log(tmp_path):
+    output_dir = str(tmp_path / 'test_event_log')
+    output_store = OutputStore(output_dir, 'parquet', 'zstd')
+    simulation = StepSimulation(200)
+    event_log = EventLog(output_store, 'E08000032')
+    event_log.start(simulation._population._population, simulation._clock._time)
+    # only the tracked columns are kept between the steps
+    assert list(event_log._previous.columns) == EventLog.tracked_columns
+    snapshots = {}
+    for year in [1, 2]:
+        event_log.run_for(simulation, pd.Timedelta(days=365.25))
+        write_events(output_store, 'E08000032', event_log.end_year(), year, simulation._clock._time)
+        snapshots[year] = (simulation._clock._time, simulation._population._population.copy())
+    # one more step, not written
+    simulation.step()
+
+    events = output_store.read_events('E08000032')
+    assert events['event'].value_counts().to_dict() == {'birth': 48, 'internal_migration': 72, 'death': 48,
+                                                         'immigration': 24, 'emigration': 24, 'update': 48}
+    deaths = events[events['event'] == 'death']
+    assert (deaths['exit_time'] == deaths['time']).all()
+    assert output_store.years('E08000032') == [1, 2]
+
+    # the population is rebuilt at the end of each year, as read by the readers of the outputs
+    for year, (time, snapshot) in snapshots.items():
+        for population in [output_store.population_at('E08000032', time), output_store.read('E08000032', year)]:
+            pd.testing.assert_frame_equal(population.drop(columns='age'), snapshot.drop(columns='age'),
+                                          check_dtype=False, check_categorical=False)
+            assert np.allclose(population['age'], snapshot['age'])
+    assert len(output_store.read('E08000032')) == len(snapshots[2][1])
+    # and in between
+    mid_year = output_store.population_at('E08000032', pd.Timestamp('2011-07-01'))
+    assert len(mid_year) == 200 + 3 * 5 and (mid_year['alive'] != 'alive').sum() == 3 * 5
+
+
 # def test_9_simulation(self):
 #     sim = InteractiveContext('config/model_specification.yaml', setup=False)
 #     sim.configuration.update({'population': {'population_size': len(pd.read_csv('data/Testfile.csv'))}})
 #     sim.setup()
 #     sim.run()
 #     print(sim.get_population())
+
+
+def test_32_phase_timer(tmp_path):
+    output_dir = str(tmp_path / 'test_phase_timer')
+    pop = pd.DataFrame({'age': np.arange(1000) / 10, 'alive': 'alive', 'MSOA': 'E02002183'})
+    paths = []
+    for location in ['E08000032', 'E08000033']:
+        timer = PhaseTimer(location)
+        for table, cached in [('mortality', False), ('fertility', True)]:
+            with timer.phase('rate_table', table=table, cached=cached):
+                time.sleep(0.01)
+        # details can be added inside the phase, and the phase is recorded when it fails
+        with pytest.raises(ValueError):
+            with timer.phase('simulate_year', year=1) as details:
+                details['steps'] = 2
+                raise ValueError
+        # writes of the output writer are recorded with the time taken by the worker
+        for mode in ['sync', 'thread']:
+            with OutputWriter(OutputStore(output_dir), mode, timer=timer) as output_writer:
+                output_writer.write(pop, location, 1)
+        paths.append(timer.write(timing_report_path(output_dir, location)))
+
+        with open(paths[-1]) as report_file:
+            report = json.load(report_file)
+        assert report['location'] == location and report['wall_seconds'] >= 0.02
+        assert [phase['phase'] for phase in report['phases']] == ['rate_table', 'rate_table', 'simulate_year',
+                                                                   'output', 'output']
+        assert report['phases'][0]['table'] == 'mortality' and report['phases'][0]['wall_seconds'] >= 0.01
+        assert report['phases'][2]['steps'] == 2 and report['phases'][2]['year'] == 1
+        assert report['phases'][3]['path'] == OutputStore(output_dir).path(location, 1)
+        assert all(phase['peak_rss_mb'] > 0 for phase in report['phases'])
+
+    phases, summary = merge_reports(paths)
+    assert len(phases) == 10 and set(phases['location']) == {'E08000032', 'E08000033'}
+    assert summary.loc['rate_table', 'count'] == 4 and summary.loc['output', 'count'] == 4
+    assert summary.loc['rate_table', 'wall_seconds'] == pytest.approx(
+        phases.loc[phases['phase'] == 'rate_table', 'wall_seconds'].sum())
+
+
+class ProfiledPopulation:
+    """Component aging all the simulants at each time step, adding two simulants at its end and lowering the
+    mortality rate."""
+    name = 'profiled_population'
+
+    def setup(self, builder):
+        self.population_view = builder.population.get_view(['age', 'alive'])
+        builder.population.initializes_simulants(self.on_initialize_simulants, creates_columns=['age', 'alive'])
+        self.simulant_creator = builder.population.get_simulant_creator()
+        builder.value.register_value_modifier('profiled_mortality_rate', self.modify_mortality_rate)
+        builder.event.register_listener('time_step', self.on_time_step)
+        builder.event.register_listener('time_step__cleanup', self.on_time_step_cleanup)
+
+    def on_initialize_simulants(self, pop_data):
+        self.population_view.update(pd.DataFrame({'age': 0.0, 'alive': 'alive'}, index=pop_data.index))
+
+    def modify_mortality_rate(self, index, rate):
+        return rate / 2
+
+    def on_time_step(self, event):
+        self.population_view.update(self.population_view.get(event.index)['age'] + 1)
+
+    def on_time_step_cleanup(self, event):
+        self.simulant_creator(2, {'sim_state': 'time_step'})
+
+
+class ProfiledMortality:
+    """Component evaluating a mortality rate and killing three simulants at each time step."""
+    name = 'profiled_mortality'
+
+    def setup(self, builder):
+        self.mortality_rate = builder.value.register_value_producer('profiled_mortality_rate', source=self.base_rate)
+        self.population_view = builder.population.get_view(['alive'])
+        builder.event.register_listener('time_step', self.on_time_step)
+
+    def base_rate(self, index):
+        return pd.Series(0.1, index=index)
+
+    def on_time_step(self, event):
+        assert (self.mortality_rate(event.index) == 0.05).all()
+        deaths = self.population_view.get(event.index, query="alive == 'alive'").index[:3]
+        self.population_view.update(pd.Series('dead', index=deaths, name='alive'))
+
+
+def test_33_simulation_profiler(tmp_path):
+    output_dir = str(tmp_path / 'test_profiler')
+    components = [ProfiledPopulation(), ProfiledMortality()]
+    simulation = InteractiveContext(components=components, configuration={'population': {'population_size': 100}})
+    profiler = SimulationProfiler(simulation, components).install()
+    simulation.take_steps(3)
+
+    frame = profiler.to_frame()
+    assert frame['step'].tolist() == [1] * 5 + [2] * 5 + [3] * 5 and (frame['calls'] == 1).all()
+    step = frame[frame['step'] == 3].set_index(['component', 'kind', 'hook'])
+    assert step.loc[('profiled_mortality', 'listener', 'time_step.on_time_step'),
+                    ['simulants', 'updated', 'created']].tolist() == [104, 3, 0]
+    assert step.loc[('profiled_population', 'listener', 'time_step.on_time_step'),
+                    ['simulants', 'updated', 'created']].tolist() == [104, 104, 0]
+    assert step.loc[('profiled_population', 'listener', 'time_step__cleanup.on_time_step_cleanup'),
+                    ['updated', 'created']].tolist() == [2, 2]
+    assert step.loc[('profiled_mortality', 'pipeline_source', 'profiled_mortality_rate'), 'simulants'] == 104
+    assert step.loc[('profiled_population', 'pipeline_modifier', 'profiled_mortality_rate'), 'simulants'] == 104
+    # the pipeline is evaluated by the listener, whose time includes it
+    assert step.loc[('profiled_mortality', 'listener', 'time_step.on_time_step'), 'seconds'] >= \
+        step.loc[('profiled_mortality', 'pipeline_source', 'profiled_mortality_rate'), 'seconds']
+
+    summary = profiler.summary()
+    assert summary.loc['profiled_population', 'calls'] == 9 and summary.loc['profiled_mortality', 'calls'] == 6
+    assert summary.loc['profiled_population', 'created'] == 6 and (summary['steps'] == 3).all()
+
+    csv_path, json_path, trace_path = profiler.write(output_dir, 'E08000032')
+    pd.testing.assert_frame_equal(pd.read_csv(csv_path).drop(columns='time'), frame.drop(columns='time'))
+    with open(json_path) as profile_file:
+        assert len(json.load(profile_file)['steps']) == 15
+    with open(trace_path) as trace_file:
+        trace = json.load(trace_file)['traceEvents']
+    assert len(trace) == 1 + 15 and all(event['dur'] >= 0 for event in trace[1:])
+
+    # the components run unprofiled once the profiler is removed
+    profiler.uninstall()
+    simulation.take_steps(1)
+    assert len(profiler.to_frame()) == 15 and len(simulation.get_population()) == 108
+
+
+class LookupRates:
+    """Component building a lookup table of rates by sex, age and year during setup."""
+    name = 'lookup_rates'
+
+    def __init__(self, rate_table):
+        self.rate_table = rate_table
+
+    def setup(self, builder):
+        self.population_view = builder.population.get_view(['sex', 'age'])
+        builder.population.initializes_simulants(self.on_initialize_simulants, creates_columns=['sex', 'age'])
+        self.rates = builder.lookup.build_table(self.rate_table, key_columns=['sex'],
+                                                parameter_columns=['age', 'year'], value_columns=['mean_value'])
+
+    def on_initialize_simulants(self, pop_data):
+        self.population_view.update(pd.DataFrame({'sex': np.tile([1, 2], len(pop_data.index) // 2),
+                                                  'age': np.arange(len(pop_data.index)) % 90 + 0.5},
+                                                 index=pop_data.index))
+
+
+def test_34_setup_cache(tmp_path):
+    cache_dir = str(tmp_path / 'test_setup_cache')
+    ages = np.arange(0, 100)
+    rate_table = pd.DataFrame({'sex': np.repeat([1, 2], len(ages)), 'age_start': np.tile(ages, 2),
+                               'age_end': np.tile(ages + 1, 2), 'year_start': 2000, 'year_end': 2030,
+                               'mean_value': np.arange(2 * len(ages)) / 1000})
+    rates = {}
+    for run, table in [('built', rate_table), ('cached', rate_table),
+                       ('scaled', rate_table.assign(mean_value=rate_table['mean_value'] * 3))]:
+        setup_cache = SetupCache(cache_dir, max_entries=1)
+        component = LookupRates(table)
+        simulation = InteractiveContext(components=[component], configuration={'population': {'population_size': 100}},
+                                        setup=False)
+        with setup_cache.patch():
+            simulation.setup()
+        rates[run] = component.rates(simulation.get_population().index)
+        assert setup_cache.stats() == {'setup_cache_hits': 0 if run == 'built' else 1,
+                                       'setup_cache_misses': 1 if run == 'built' else 0}
+
+    population = simulation.get_population()
+    expected = rate_table.set_index(['sex', 'age_start'])['mean_value']
+    assert np.allclose(rates['built'], expected.loc[list(zip(population['sex'], population['age'] - 0.5))])
+    pd.testing.assert_series_equal(rates['cached'], rates['built'])
+    pd.testing.assert_series_equal(rates['scaled'], rates['built'] * 3)
+
+    # another structure (age bands) is another entry, the least recently used one is removed
+    wide_bands = rate_table[rate_table['age_start'] % 2 == 0].assign(age_end=lambda df: df['age_start'] + 2)
+    with SetupCache(cache_dir, max_entries=1).patch():
+        simulation = InteractiveContext(components=[LookupRates(wide_bands)],
+                                        configuration={'population': {'population_size': 100}})
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.pkl')]) == 1
+
+
+class ArchivedPopulation:
+    """Component killing simulants at random and adding a child of the first two living simulants at each time
+    step."""
+    name = 'archived_population'
+
+    def setup(self, builder):
+        columns = ['age', 'alive', 'MSOA', 'location', 'entrance_time', 'parent_id']
+        self.population_view = builder.population.get_view(columns)
+        builder.population.initializes_simulants(self.on_initialize_simulants, creates_columns=columns)
+        self.randomness = builder.randomness.get_stream('archived_deaths')
+        self.register = builder.randomness.register_simulants
+        self.simulant_creator = builder.population.get_simulant_creator()
+        self.clock = builder.time.clock()
+        builder.event.register_listener('time_step', self.on_time_step)
+        builder.event.register_listener('time_step__cleanup', self.on_time_step_cleanup)
+
+    def on_initialize_simulants(self, pop_data):
+        parent_ids = pop_data.user_data.get('parent_ids', -1)
+        population = pd.DataFrame({'age': np.arange(1, len(pop_data.index) + 1) / 7, 'alive': 'alive',
+                                   'MSOA': 'E02002183', 'location': 'E08000032',
+                                   'entrance_time': pop_data.creation_time, 'parent_id': parent_ids}, index=pop_data.index)
+        self.register(population[['entrance_time', 'age']])
+        self.population_view.update(population)
+
+    def on_time_step(self, event):
+        alive = self.population_view.get(event.index, query="alive == 'alive'").index
+        deaths = self.randomness.filter_for_probability(alive, 0.1)
+        self.population_view.update(pd.Series('dead', index=deaths, name='alive'))
+
+    def on_time_step_cleanup(self, event):
+        parents = self.population_view.get(event.index, query="alive == 'alive'").index[:2]
+        self.simulant_creator(len(parents), {'sim_state': 'time_step', 'parent_ids': list(parents)})
+
+
+def test_35_population_archiver(tmp_path):
+    output_dir = str(tmp_path / 'test_archiver')
+    # the random draws of the simulants are keyed as in the daedalus configuration
+    configuration = {'randomness': {'key_columns': ['entrance_time', 'age']}, 'population': {'population_size': 100}}
+    reference = InteractiveContext(components=[ArchivedPopulation()], configuration=configuration)
+    simulation = InteractiveContext(components=[ArchivedPopulation()], configuration=configuration)
+    output_store = OutputStore(output_dir, 'parquet')
+    archiver = PopulationArchiver(output_store, 'E08000032')
+    event_log = EventLog(output_store, 'E08000032', translate=archiver.with_simulant_ids)
+    event_log.start(simulation._population._population, simulation._clock._time)
+
+    for year in [1, 2, 3]:
+        reference.take_steps(5)
+        event_log.run_for(simulation, pd.Timedelta(days=5))
+        write_events(output_store, 'E08000032', event_log.end_year(), year, simulation._clock._time)
+        archived = archiver.compact(simulation, year)
+        event_log.resume(simulation._population._population)
+
+        # only the living simulants are left in the state table, numbered from 0
+        state_table = simulation._population._population
+        assert archived > 0 and (state_table['alive'] == 'alive').all()
+        assert state_table.index.equals(pd.RangeIndex(len(state_table)))
+        # the simulants keep their ids, random draws and parents, the archived ones are merged back
+        expected = reference.get_population()
+        population = archiver.get_population(simulation)
+        pd.testing.assert_frame_equal(population, expected, check_index_type=False)
+        assert (population['parent_id'] > -1).sum() == 2 * 5 * year
+        assert output_store.find_archive('E08000032', year) == output_store.archive_path('E08000032', year)
+        # and are logged by id
+        rebuilt = output_store.population_at('E08000032', simulation._clock._time)
+        pd.testing.assert_frame_equal(rebuilt.drop(columns='age'), expected.drop(columns='age'), check_dtype=False,
+                                      check_categorical=False, check_index_type=False)
+
+    # the archiver is saved with the checkpoints, the archive is read back after a restore
+    restored = PopulationArchiver(output_store, 'E08000032')
+    restored.restore(archiver.state())
+    pd.testing.assert_frame_equal(restored.get_population(simulation), archiver.get_population(simulation))
+    assert len(restored.get_population(simulation, archived=False)) == len(simulation._population._population)
+
+
+class RateLookup:
+    """Component building a vivarium lookup table from a rate table, for simulants of every location, ethnicity,
+    sex and age of the table."""
+    name = 'rate_lookup'
+
+    def __init__(self, rate_table):
+        self.rate_table = rate_table
+
+    def setup(self, builder):
+        self.rates = builder.lookup.build_table(self.rate_table, key_columns=['location', 'ethnicity', 'sex'],
+                                                parameter_columns=['age', 'year'], value_columns=['mean_value'])
+        self.population_view = builder.population.get_view(['location', 'ethnicity', 'sex', 'age'])
+        builder.population.initializes_simulants(self.on_initialize_simulants,
+                                                 creates_columns=['location', 'ethnicity', 'sex', 'age'])
+
+    def on_initialize_simulants(self, pop_data):
+        n = len(pop_data.index)
+        self.population_view.update(pd.DataFrame({'location': np.resize(['E08000032', 'E08000033'], n),
+                                                  'ethnicity': np.resize(['BAN', 'BAN', 'WBI', 'WBI'], n),
+                                                  'sex': np.resize([1, 2, 2, 1, 1], n),
+                                                  'age': np.arange(n) % 100 + 0.5}, index=pop_data.index))
+
+
+def test_36_compact_rate_table_lookup(tmp_path):
+    configuration = {'rate_tables': {'compact_dtypes': True, 'float32_rates': True},
+                     'scale_rates': {'method': 'constant', 'constant': {'mortality': 1}}}
+    RateTable = BaseHandler(configuration=configuration)
+    RateTable.scale_component = 'mortality'
+    RateTable.rate_table_path = str(tmp_path / 'test_rate_table') + RateTable.cache_backend.extension
+    rate_table = BaseHandler.transform_rate_table(leeds_rate_frame(), 2011, 2012, 0, 100)
+    RateTable.rate_table = rate_table
+    RateTable.cache()
+    RateTable.set_rate_table()
+    assert RateTable.rate_table['location'].dtype.name == 'category'
+    footprint = RateTable.memory_footprint()
+
+    # the rate table is handed to vivarium with strings, small integers and float32 rates, the handler drops its copy
+    # and the lookup tables give the rates of the plain table
+    scaled = RateTable.hand_over_rate_table()
+    assert RateTable.rate_table is None
+    assert scaled['location'].dtype == object and scaled['mean_value'].dtype == np.float32
+    assert all(scaled[column].dtype.itemsize <= 2 for column in ['age_start', 'age_end', 'sex', 'year_start'])
+    pd.testing.assert_frame_equal(scaled, rate_table, check_dtype=False, rtol=1e-6)
+    assert footprint == scaled.memory_usage(deep=True).sum() < rate_table.memory_usage(deep=True).sum()
+    rates = {}
+    for name, table in [('compact', scaled), ('plain', rate_table)]:
+        component = RateLookup(table)
+        simulation = InteractiveContext(components=[component], configuration={
+            'population': {'population_size': 400}, 'time': {'start': {'year': 2011}}})
+        population = simulation.get_population()
+        rates[name] = component.rates(population.index)
+    assert (rates['plain'] > 0).all()
+    pd.testing.assert_series_equal(rates['compact'], rates['plain'], rtol=1e-6)
+
+
+def test_37_internal_migration_from_bundle(tmp_path):
+    od_matrix_dir = str(tmp_path / 'test_od_matrices')
+    config = od_matrix_test_data(od_matrix_dir)
+    # men of MSOA 0 go to MSOA 3 (in E08000033), women to MSOA 1, nobody leaves MSOA 2
+    for sex, destination in [('M', 3), ('F', 1)]:
+        matrix = np.zeros((6, 6))
+        matrix[[0, 1], [destination, 0]] = 1
+        scipy.sparse.save_npz('{}/{}_16to19_prob_matrix_EW.npz'.format(od_matrix_dir, sex),
+                              scipy.sparse.coo_matrix(matrix))
+    OD_matrices = InternalMigrationMatrix(configuration=config)
+    OD_matrices.rate_table_dir = od_matrix_dir
+    OD_matrices.set_matrix_tables()
+
+    component = InternalMigration()
+    component.OD_matrices = OD_matrices
+    movers = pd.DataFrame({'MSOA': ['E02000000', 'E02000000', 'E02000001', 'E02000002', 'E02000009'],
+                           'location': 'E08000032', 'sex': [1.0, 2.0, 1.0, 1.0, 1.0], 'age': 17.5},
+                          index=[10, 11, 12, 13, 14])
+    time = pd.Timestamp('2011-02-01')
+    update = component.moves(movers, time, np.random.default_rng(0).random((2, len(movers))))
+    # the movers without destination (MSOA 2) or OD index (unknown MSOA) stay where they are
+    assert update.index.tolist() == [10, 11, 12]
+    assert update['MSOA'].tolist() == ['E02000003', 'E02000001', 'E02000000']
+    assert update['location'].tolist() == ['E08000033', 'E08000032', 'E08000032']
+    assert update['previous_MSOA_locations'].tolist() == ['E02000000', 'E02000000', 'E02000001']
+    assert (update['previous_LAD_locations'] == 'E08000032').all() and (update['internal_outmigration'] == 'Yes').all()
+    assert (update['last_outmigration_time'] == time).all()
+    # the rows are read from the memory-mapped bundle
+    assert isinstance(OD_matrices.OD_matrix_bundle.arrays('M', '16to19')['data'], np.memmap)